@@ -0,0 +1,286 @@
+"""CSC111 Project 2: Spotify Recommendation System - Recommender Benchmarks
+
+This module measures the song recommendation pipeline on synthetic song catalogs, so that changes to
+the decision tree and the recommendation code can be compared between commits without downloading the
+Kaggle dataset.
+
+For every catalog size, it times fitting the decision tree, predicting a batch of songs, looking up seed
+songs, and scoring recommendations, and records the peak memory allocated by each stage. It can also build
+the user listening graph from synthetic listening histories with a given number of edges, and time and
+measure the memory of building it and recommending from it. The results are written as JSON, and a
+previous results file can be given to compare against.
+
+Run it with, for example:
+
+    python benchmark_recommender.py --sizes 1000 10000 100000 --out results.json
+    python benchmark_recommender.py --sizes 1000 10000 100000 --compare results.json
+    python benchmark_recommender.py --sizes 1000 --graph-edges 1000000 5000000
+"""
+from __future__ import annotations
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from decision_tree import CatalogIndex, DecisionTree, recommend_songs
+from recommender_graph_v2 import Graph
+
+# the seven audio features that the recommender is trained on
+FEATURES = ['speechiness', 'tempo', 'energy', 'loudness', 'acousticness', 'danceability', 'instrumentalness']
+
+# the catalog sizes benchmarked by default
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+# the stages of the pipeline that are measured, in the order they run
+STAGES = ('fit', 'predict', 'lookup', 'recommend')
+
+# the stages of the user listening graph that are measured, in the order they run
+GRAPH_STAGES = ('graph_build', 'graph_recommend')
+
+
+def make_catalog(n_songs: int, seed: int = 0, duplicate_rate: float = 0.05) -> pd.DataFrame:
+    """Return a synthetic song catalog with n_songs rows, 'name' and 'artists' columns, and the seven
+    features in FEATURES, drawn from distributions shaped like those of the Spotify dataset.
+
+    About duplicate_rate of the songs reuse the name of an earlier song by another artist, as covers and
+    songs with common titles do.
+
+    Preconditions:
+        - n_songs >= 1
+        - 0 <= duplicate_rate < 1
+
+    >>> catalog = make_catalog(1000, seed=1)
+    >>> catalog.shape, list(catalog.columns[:2])
+    ((1000, 9), ['name', 'artists'])
+    >>> bool(catalog['tempo'].between(40, 220).all()) and bool(catalog['loudness'].between(-60, 0).all())
+    True
+    >>> make_catalog(50, seed=3).equals(make_catalog(50, seed=3))
+    True
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array([f'Song {i}' for i in range(n_songs)], dtype=object)
+    reused = np.flatnonzero(rng.random(n_songs) < duplicate_rate)
+    reused = reused[reused > 0]
+    names[reused] = names[rng.integers(0, reused)]
+
+    return pd.DataFrame({
+        'name': names,
+        'artists': [f'Artist {i}' for i in rng.integers(0, max(n_songs // 10, 1), n_songs)],
+        'speechiness': rng.beta(1.2, 12, n_songs).round(4),
+        'tempo': np.clip(rng.normal(120, 29, n_songs), 40, 220).round(3),
+        'energy': rng.beta(2.5, 1.8, n_songs).round(3),
+        'loudness': np.clip(-rng.gamma(2.2, 3.8, n_songs), -60, 0).round(3),
+        'acousticness': rng.beta(0.5, 1.2, n_songs).round(4),
+        'danceability': rng.beta(4, 3, n_songs).round(3),
+        'instrumentalness': np.where(rng.random(n_songs) < 0.7, 0, rng.beta(0.6, 0.8, n_songs)).round(4),
+    })
+
+
+def measure(stage: Callable[[], Any], trace_memory: bool = True) -> tuple[Any, float, Optional[float]]:
+    """Run stage and return its result, the seconds it took, and the peak memory in megabytes that it
+    allocated through Python and NumPy, or None if trace_memory is False.
+
+    Tracing memory slows down code that allocates many small Python objects, so the stage is timed on its
+    own and then run a second time to trace its memory.
+    """
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    if not trace_memory:
+        return result, seconds, None
+
+    tracemalloc.start()
+    try:
+        stage()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def benchmark_size(n_songs: int, params: dict[str, Any], n_queries: int = 1000, n_recommendations: int = 50,
+                   seed: int = 0, trace_memory: bool = True) -> list[dict[str, Any]]:
+    """Benchmark every stage in STAGES on a synthetic catalog of n_songs songs, and return one result per
+    stage, with its 'size', 'stage', 'seconds', 'peak_mb' and the number of 'operations' it did.
+
+    The tree is fit with the hyperparameters params on every song, with one class per song name, as
+    main.py does. predict routes n_queries songs as one batch, lookup finds n_queries seed songs after
+    building the CatalogIndex, and recommend scores the recommendations of n_recommendations seeds.
+    """
+    catalog = make_catalog(n_songs, seed)
+    x_data = catalog[FEATURES].to_numpy()
+    y_data, _ = pd.factorize(catalog['name'])
+    rng = np.random.default_rng(seed + 1)
+    queries = rng.integers(0, n_songs, n_queries)
+    seeds = rng.integers(0, n_songs, n_recommendations)
+    tree = DecisionTree(**params)
+
+    def lookup() -> CatalogIndex:
+        """Index the catalog, and look up every query song by name and artist."""
+        index = CatalogIndex(catalog, FEATURES)
+        for name, artist in zip(catalog['name'].iloc[queries], catalog['artists'].iloc[queries]):
+            index.find(name, artist)
+        return index
+
+    results = []
+    _, seconds, peak = measure(lambda: tree.fit(x_data, y_data), trace_memory)
+    results.append(('fit', seconds, peak, n_songs))
+    _, seconds, peak = measure(lambda: tree.predict(x_data[queries]), trace_memory)
+    results.append(('predict', seconds, peak, n_queries))
+    index, seconds, peak = measure(lookup, trace_memory)
+    results.append(('lookup', seconds, peak, n_queries))
+    _, seconds, peak = measure(lambda: [recommend_songs(tree, catalog['name'].iloc[row], FEATURES, catalog,
+                                                        index=index, artist=catalog['artists'].iloc[row])
+                                        for row in seeds], trace_memory)
+    results.append(('recommend', seconds, peak, n_recommendations))
+
+    return [{'size': n_songs, 'stage': stage, 'seconds': seconds, 'peak_mb': peak, 'operations': operations}
+            for stage, seconds, peak, operations in results]
+
+
+def benchmark_graph(n_edges: int, seed: int = 0, trace_memory: bool = True,
+                    graph_type: Callable[[], Any] = Graph) -> list[dict[str, Any]]:
+    """Benchmark every stage in GRAPH_STAGES on a synthetic listening history of n_edges (user, song) plays,
+    and return one result per stage, in the format of benchmark_size.
+
+    graph_build adds every play to a new graph_type() as load_song_listening_graph does, with one user per
+    50 plays, one song per 10 plays and one artist per 10 songs, and then the 50 saved songs of the current
+    user. graph_recommend asks the graph for recommendations for the current user. The peak memory of
+    graph_build is the memory the graph holds, since the names of the users, songs and artists are made
+    while it is traced. The seconds of graph_recommend include any index the graph builds on its first
+    recommendation, but its peak memory is that of a repeated recommendation.
+
+    Preconditions:
+        - n_edges >= 50
+    """
+    rng = np.random.default_rng(seed)
+    n_users, n_songs = max(n_edges // 50, 1), max(n_edges // 10, 1)
+    users, songs = rng.integers(0, n_users, n_edges).tolist(), rng.integers(0, n_songs, n_edges).tolist()
+    saved_songs = rng.choice(n_songs, 50, replace=False).tolist()
+
+    def build() -> Any:
+        """Build the listening graph of the synthetic plays and the current user's saved songs."""
+        graph = graph_type()
+        for user, song in zip(users, songs):
+            title, artist = f'Song {song}', f'Artist {song % max(n_songs // 10, 1)}'
+            graph.add_song_vertex(title, artist)
+            graph.add_user_vertex(f'user {user}', False)
+            graph.add_edge(f'user {user}', title, artist)
+
+        graph.add_user_vertex('current_user', True)
+        for song in saved_songs:
+            title, artist = f'Song {song}', f'Artist {song % max(n_songs // 10, 1)}'
+            graph.add_song_vertex(title, artist)
+            graph.add_edge('current_user', title, artist)
+        return graph
+
+    results = []
+    graph, seconds, peak = measure(build, trace_memory)
+    results.append(('graph_build', seconds, peak, n_edges))
+    _, seconds, peak = measure(lambda: graph.get_recommendations({}), trace_memory)
+    results.append(('graph_recommend', seconds, peak, 1))
+
+    return [{'size': n_edges, 'stage': stage, 'seconds': seconds, 'peak_mb': peak, 'operations': operations}
+            for stage, seconds, peak, operations in results]
+
+
+def run_benchmarks(sizes: list[int], params: dict[str, Any], n_queries: int = 1000, n_recommendations: int = 50,
+                   seed: int = 0, trace_memory: bool = True, graph_edges: tuple[int, ...] = ()) -> dict[str, Any]:
+    """Benchmark every catalog size in sizes, and the listening graph with every number of edges in
+    graph_edges, and return the results together with a description of the environment they were measured in.
+
+    >>> report = run_benchmarks([500], {'max_depth': 5, 'random_state': 0}, n_queries=20, n_recommendations=2,
+    ...                         graph_edges=(1000,))
+    >>> [(result['size'], result['stage']) for result in report['results']]
+    [(500, 'fit'), (500, 'predict'), (500, 'lookup'), (500, 'recommend'), (1000, 'graph_build'), \
+(1000, 'graph_recommend')]
+    """
+    results = []
+    for n_songs in sizes:
+        results.extend(benchmark_size(n_songs, params, n_queries, n_recommendations, seed, trace_memory))
+    for n_edges in graph_edges:
+        results.extend(benchmark_graph(n_edges, seed, trace_memory))
+
+    return {'commit': _current_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'params': params, 'seed': seed, 'trace_memory': trace_memory,
+            'results': results}
+
+
+def compare(current: dict[str, Any], previous: dict[str, Any]) -> list[str]:
+    """Return one line per result of current that previous also has, showing how its time and peak memory
+    changed, as a ratio of previous to current, so that 2.00x means twice as fast or half the memory.
+
+    >>> old = {'results': [{'size': 10, 'stage': 'fit', 'seconds': 2.0, 'peak_mb': 8.0}]}
+    >>> new = {'results': [{'size': 10, 'stage': 'fit', 'seconds': 1.0, 'peak_mb': 8.0}]}
+    >>> compare(new, old)
+    ['       10 fit       2.0000s -> 1.0000s (2.00x)   8.0MB -> 8.0MB (1.00x)']
+    """
+    previous_results = {(result['size'], result['stage']): result for result in previous['results']}
+    lines = []
+    for result in current['results']:
+        before = previous_results.get((result['size'], result['stage']))
+        if before is None:
+            continue
+        line = (f"{result['size']:>9} {result['stage']:<9} {before['seconds']:.4f}s -> {result['seconds']:.4f}s "
+                f"({before['seconds'] / max(result['seconds'], 1e-12):.2f}x)")
+        if result['peak_mb'] is not None and before['peak_mb'] is not None:
+            line += (f"   {before['peak_mb']:.1f}MB -> {result['peak_mb']:.1f}MB "
+                     f"({before['peak_mb'] / max(result['peak_mb'], 1e-12):.2f}x)")
+        lines.append(line)
+    return lines
+
+
+def _current_commit() -> Optional[str]:
+    """Return the git commit that the working directory is at, or None if it is not in a git repository."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+if __name__ == '__main__':
+    # import python_ta
+    # python_ta.check_all(config={
+    #     'extra-imports': ['argparse', 'json', 'platform', 'subprocess', 'time', 'tracemalloc', 'typing',
+    #                       'numpy', 'pandas', 'decision_tree', 'recommender_graph_v2'],
+    #     'allowed-io': ['print'],
+    #     'max-line-length': 120
+    # })
+
+    parser = argparse.ArgumentParser(description='Benchmark the song recommender on synthetic catalogs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='catalog sizes')
+    parser.add_argument('--max-depth', type=int, default=7, help='max_depth of the decision tree')
+    parser.add_argument('--min-samples-split', type=int, default=2, help='min_samples_split of the decision tree')
+    parser.add_argument('--splitter', default='sorted', help='splitter of the decision tree')
+    parser.add_argument('--queries', type=int, default=1000, help='songs predicted and looked up per size')
+    parser.add_argument('--recommendations', type=int, default=50, help='seed songs recommended for per size')
+    parser.add_argument('--graph-edges', type=int, nargs='*', default=[], help='listening graph sizes, in plays')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic catalogs')
+    parser.add_argument('--no-memory', action='store_true', help='skip the second, memory-traced run of each stage')
+    parser.add_argument('--out', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, {'max_depth': args.max_depth, 'min_samples_split': args.min_samples_split,
+                                         'splitter': args.splitter, 'random_state': args.seed},
+                            args.queries, args.recommendations, args.seed, not args.no_memory, tuple(args.graph_edges))
+
+    for row in report['results']:
+        peak_text = '' if row['peak_mb'] is None else f"  peak {row['peak_mb']:8.1f} MB"
+        print(f"{row['size']:>9} {row['stage']:<9} {row['seconds']:9.4f} s{peak_text}")
+
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print('\n'.join(compare(report, json.load(file))))
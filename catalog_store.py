@@ -0,0 +1,381 @@
+"""CSC111 Project 2: Spotify Recommendation System - Catalog Store
+
+This module converts the song catalog CSV into a typed columnar cache once, so that later loads read only
+the columns they need instead of parsing the whole CSV, lyrics included.
+
+The cache is a directory of .npy files. The audio features are stored together as one float32 matrix,
+which any number of processes can memory-map read-only and so share through the page cache. Other numeric
+columns are stored as float32 arrays, and text columns such as the song name and artists as categorical
+codes together with their categories. A JSON file records the size, modification time and hash of the CSV
+that the cache was built from, and the cache is rebuilt whenever the CSV changes.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import struct
+import time
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+# the version of the cache layout; caches written with another version are rebuilt
+FORMAT_VERSION = 2
+
+# the seven audio features that the recommender is trained on
+FEATURES = ['speechiness', 'tempo', 'energy', 'loudness', 'acousticness', 'danceability', 'instrumentalness']
+
+# the columns of the song catalog that are cached unless others are asked for
+DEFAULT_COLUMNS = ['name', 'artists'] + FEATURES
+
+# the name of the file that describes a cache and the CSV it was built from
+_METADATA_FILE = 'catalog.json'
+
+# the name of the file that holds the feature matrix
+_FEATURES_FILE = 'features'
+
+# the number of bytes reserved for the header of a .npy file written by _NpyWriter
+_NPY_HEADER_SIZE = 128
+
+
+class CatalogStore:
+    """A columnar cache of one song catalog CSV, kept in its own directory.
+
+    Instance Attributes:
+        - directory: The directory that the cache files are stored in.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     source = os.path.join(directory, 'songs.csv')
+    ...     pd.DataFrame({'name': ['a', 'b', 'a', 'a'], 'artists': ['x', 'y', 'z', 'x'],
+    ...                   'tempo': [90.5, 120.0, None, 80.0], 'lyrics': ['...'] * 4}).to_csv(source, index=False)
+    ...     store = CatalogStore(os.path.join(directory, 'cache'))
+    ...     store.is_current(source)
+    ...     report = store.build(source, ['name', 'artists', 'tempo'], chunksize=2)
+    ...     store.is_current(source)
+    ...     catalog = store.load(['name', 'tempo'])
+    False
+    True
+    >>> report['rows_read'], report['rows_missing_features'], report['rows_duplicate'], report['rows_kept']
+    (4, 1, 1, 2)
+    >>> catalog['name'].tolist(), catalog['tempo'].dtype
+    (['a', 'b'], dtype('float32'))
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     source = os.path.join(directory, 'songs.csv')
+    ...     pd.DataFrame({'name': ['a', 'b'], 'tempo': [90.5, 120.0], 'energy': [0.25, 0.5]}).to_csv(source)
+    ...     store = CatalogStore(os.path.join(directory, 'cache'))
+    ...     _ = store.build(source, ['name', 'tempo', 'energy'])
+    ...     matrix = store.feature_matrix()
+    ...     names = store.codes('name')
+    ...     print(store.feature_names(), matrix.tolist(), matrix.flags.writeable, names.tolist())
+    ...     del matrix, names  # release the memory maps before the directory is removed
+    ['tempo', 'energy'] [[90.5, 0.25], [120.0, 0.5]] False [0, 1]
+    """
+    directory: str
+
+    def __init__(self, directory: str = '.catalog') -> None:
+        """Initialize a CatalogStore that keeps its files in directory, creating it if needed."""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def metadata(self) -> Optional[dict[str, Any]]:
+        """Return the description of the cache, or None if there is no complete cache in the current format."""
+        path = os.path.join(self.directory, _METADATA_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            metadata = json.load(file)
+        return metadata if metadata['format_version'] == FORMAT_VERSION else None
+
+    def is_current(self, source: str, columns: Optional[list[str]] = None) -> bool:
+        """Return whether the cache was built from the CSV file at source as it is now, and holds every
+        column of columns.
+
+        A CSV whose size and modification time are unchanged is taken to be unchanged. If only its
+        modification time changed, as it does when the file is copied or touched, its contents are hashed
+        and compared, and the cache is kept and marked with the new time when they match.
+        """
+        metadata = self.metadata()
+        if metadata is None or any(column not in metadata['columns'] for column in columns or []):
+            return False
+        status = os.stat(source)
+        if status.st_size != metadata['size']:
+            return False
+        if status.st_mtime_ns == metadata['mtime_ns']:
+            return True
+        if file_hash(source) != metadata['hash']:
+            return False
+
+        metadata['mtime_ns'] = status.st_mtime_ns
+        self._write_metadata(metadata)
+        return True
+
+    def build(self, source: str, columns: Optional[list[str]] = None, dtypes: Optional[dict[str, str]] = None,
+              chunksize: int = 100_000) -> dict[str, Any]:
+        """Convert the given columns of the CSV file at source into this cache, replacing any cache that
+        was here, and return a report of the rows it read, kept and dropped, and how fast.
+
+        columns defaults to DEFAULT_COLUMNS. dtypes gives the type every column is read as, either
+        'float32' or 'category', and defaults to 'float32' for the columns in FEATURES and 'category' for the
+        rest. The float32 columns in FEATURES form the feature matrix, in the order of columns.
+
+        The CSV is read chunksize rows at a time, and only the given columns of it, so memory grows with the
+        chunk size and the number of distinct songs rather than with the size of the file. Rows missing a
+        feature are dropped, and so are rows repeating the name and artists of an earlier row, when both
+        are cached. Every chunk is appended to the cache files as soon as it is cleaned.
+
+        The description of the cache is written last and removed first, so an interrupted build leaves no
+        cache rather than a partial one.
+        """
+        started = time.perf_counter()
+        columns = DEFAULT_COLUMNS if columns is None else columns
+        dtypes = {column: 'float32' if column in FEATURES else 'category' for column in columns} | (dtypes or {})
+        features = [column for column in columns if column in FEATURES and dtypes[column] == 'float32']
+        text_columns = [column for column in columns if dtypes[column] == 'category']
+        other_columns = [column for column in columns if dtypes[column] == 'float32' and column not in features]
+        metadata_path = os.path.join(self.directory, _METADATA_FILE)
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+
+        status = os.stat(source)
+        digest = file_hash(source)
+        writers = {_FEATURES_FILE: _NpyWriter(self._path(_FEATURES_FILE), np.float32, len(features))}
+        writers.update({column: _NpyWriter(self._path(column), np.float32) for column in other_columns})
+        writers.update({column: _NpyWriter(self._path(f'{column}.codes'), np.int32) for column in text_columns})
+        codes = {column: {} for column in text_columns}  # the code of every value seen of each text column
+        seen_songs = set()
+        report = {'rows_read': 0, 'rows_missing_features': 0, 'rows_duplicate': 0, 'rows_kept': 0}
+
+        reader = pd.read_csv(source, usecols=columns, chunksize=chunksize,
+                             dtype={column: np.float32 if dtypes[column] == 'float32' else str for column in columns})
+        for frame in reader:
+            report['rows_read'] += len(frame)
+            complete = frame.dropna(subset=features)
+            report['rows_missing_features'] += len(frame) - len(complete)
+            if 'name' in text_columns and 'artists' in text_columns:
+                # songs are told apart by a 64-bit hash of their name and artists
+                hashes = pd.util.hash_pandas_object(complete[['name', 'artists']], index=False).to_numpy()
+                is_new = np.zeros(len(complete), dtype=bool)
+                for i, song_hash in enumerate(hashes.tolist()):
+                    is_new[i] = song_hash not in seen_songs
+                    seen_songs.add(song_hash)
+                report['rows_duplicate'] += len(complete) - int(np.count_nonzero(is_new))
+                complete = complete[is_new]
+            report['rows_kept'] += len(complete)
+
+            writers[_FEATURES_FILE].append(complete[features].to_numpy(dtype=np.float32))
+            for column in other_columns:
+                writers[column].append(complete[column].to_numpy(dtype=np.float32))
+            for column in text_columns:
+                # number the values of the chunk, then map those numbers to the codes of the whole file
+                chunk_codes, values = pd.factorize(complete[column])
+                column_codes = codes[column]
+                file_codes = np.array([column_codes.setdefault(value, len(column_codes)) for value in values] + [-1],
+                                      dtype=np.int32)
+                writers[column].append(file_codes[chunk_codes])
+
+        for writer in writers.values():
+            writer.close()
+        for column in text_columns:
+            self._save(f'{column}.categories', np.array(list(codes[column]), dtype=str))
+
+        report['seconds'] = time.perf_counter() - started
+        report['rows_per_second'] = report['rows_read'] / max(report['seconds'], 1e-12)
+        kinds = {column: 'feature' if column in features else 'float32' if column in other_columns
+                 else 'categorical' for column in columns}
+        self._write_metadata({'format_version': FORMAT_VERSION, 'source': os.path.abspath(source),
+                              'size': status.st_size, 'mtime_ns': status.st_mtime_ns, 'hash': digest,
+                              'n_rows': report['rows_kept'], 'columns': kinds, 'features': features,
+                              'ingestion': report})
+        return report
+
+    def load(self, columns: Optional[list[str]] = None) -> pd.DataFrame:
+        """Return the given columns of the cached catalog, or all of them if columns is None. Text columns
+        are returned as categoricals.
+
+        Preconditions:
+            - self.metadata() is not None
+            - columns is None or all(column in self.metadata()['columns'] for column in columns)
+        """
+        metadata = self.metadata()
+        kinds = metadata['columns']
+        data = {}
+        for column in kinds if columns is None else columns:
+            if kinds[column] == 'feature':
+                data[column] = np.array(self.feature_matrix()[:, metadata['features'].index(column)])
+            elif kinds[column] == 'categorical':
+                data[column] = pd.Categorical.from_codes(self._read(f'{column}.codes'), self.categories(column))
+            else:
+                data[column] = self._read(column)
+        return pd.DataFrame(data)
+
+    def feature_names(self) -> list[str]:
+        """Return the names of the columns of the feature matrix, in order.
+
+        Preconditions:
+            - self.metadata() is not None
+        """
+        return self.metadata()['features']
+
+    def feature_matrix(self) -> np.ndarray:
+        """Return the float32 feature matrix of the catalog, with one row per song and one column per
+        name in feature_names, memory-mapped read-only.
+
+        Only the pages that are read are loaded, and every process that maps the matrix shares the same
+        copy of it in the operating system's page cache, so opening it costs almost nothing.
+
+        Preconditions:
+            - self.metadata() is not None
+        """
+        return self._read(_FEATURES_FILE, mmap_mode='r')
+
+    def codes(self, column: str) -> np.ndarray:
+        """Return the int32 category code of every song in the text column column, memory-mapped read-only.
+        Code i stands for the value categories(column)[i], and -1 for a missing value.
+
+        Preconditions:
+            - self.metadata() is not None and self.metadata()['columns'][column] == 'categorical'
+        """
+        return self._read(f'{column}.codes', mmap_mode='r')
+
+    def categories(self, column: str) -> np.ndarray:
+        """Return the values of the text column column that its codes stand for.
+
+        Preconditions:
+            - self.metadata() is not None and self.metadata()['columns'][column] == 'categorical'
+        """
+        return self._read(f'{column}.categories')
+
+    def _path(self, name: str) -> str:
+        """Return the path of the file for name."""
+        return os.path.join(self.directory, f'{name}.npy')
+
+    def _save(self, name: str, array: np.ndarray) -> None:
+        """Write array to the file for name, under a temporary name first."""
+        path = self._path(name)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.save(file, array, allow_pickle=False)
+        os.replace(temporary_path, path)
+
+    def _read(self, name: str, mmap_mode: Optional[str] = None) -> np.ndarray:
+        """Return the array stored in the file for name, memory-mapped with mmap_mode if it is given."""
+        return np.load(self._path(name), mmap_mode=mmap_mode, allow_pickle=False)
+
+    def _write_metadata(self, metadata: dict[str, Any]) -> None:
+        """Write the description of the cache, under a temporary name first."""
+        path = os.path.join(self.directory, _METADATA_FILE)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(metadata, file)
+        os.replace(temporary_path, path)
+
+
+class _NpyWriter:
+    """A .npy file of rows that are appended a chunk at a time, whose number of rows is only known when it
+    is closed.
+
+    The file is written under a temporary name, with a header that reserves room for any number of rows,
+    and the header is filled in and the file moved into place by close.
+
+    Instance Attributes:
+        - path: The path the file is moved to when it is closed.
+        - dtype: The type of the values.
+        - n_columns: The number of columns of every row, or None for a one-dimensional array.
+        - n_rows: The number of rows appended so far.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     writer = _NpyWriter(os.path.join(directory, 'rows.npy'), np.float32, 2)
+    ...     writer.append(np.array([[1.0, 2.0]]))
+    ...     writer.append(np.array([[3.0, 4.0], [5.0, 6.0]]))
+    ...     writer.close()
+    ...     np.load(os.path.join(directory, 'rows.npy')).tolist()
+    [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+    """
+    path: str
+    dtype: np.dtype
+    n_columns: Optional[int]
+    n_rows: int
+    # Private Instance Attributes:
+    #     - _file: the temporary file being written
+    _file: Any
+
+    def __init__(self, path: str, dtype: Any, n_columns: Optional[int] = None) -> None:
+        """Start writing the file that will be moved to path."""
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n_columns = n_columns
+        self.n_rows = 0
+        self._file = open(f'{path}.{os.getpid()}.tmp', 'wb')
+        self._file.write(b'\0' * _NPY_HEADER_SIZE)
+
+    def append(self, rows: np.ndarray) -> None:
+        """Append rows to the file.
+
+        Preconditions:
+            - self.n_columns is None or rows.shape[1:] == (self.n_columns,)
+        """
+        self._file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.n_rows += len(rows)
+
+    def close(self) -> None:
+        """Fill in the header with the final shape, and move the file into place."""
+        shape = (self.n_rows,) if self.n_columns is None else (self.n_rows, self.n_columns)
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': shape})
+        header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+        self._file.seek(0)
+        self._file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self._file.close()
+        os.replace(self._file.name, self.path)
+
+
+def load_catalog(source: str, columns: Optional[list[str]] = None, directory: str = '.catalog') -> pd.DataFrame:
+    """Return the given columns of the song catalog CSV file at source, reading them from the cache in
+    directory, and building the cache first if it is missing or out of date. columns defaults to
+    DEFAULT_COLUMNS.
+    """
+    columns = DEFAULT_COLUMNS if columns is None else columns
+    store = CatalogStore(directory)
+    if not store.is_current(source, columns):
+        store.build(source, columns)
+    return store.load(columns)
+
+
+def file_hash(path: str) -> str:
+    """Return a short hexadecimal hash of the contents of the file at path."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 23), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+if __name__ == '__main__':
+    # import python_ta
+    # python_ta.check_all(config={
+    #     'extra-imports': ['hashlib', 'json', 'os', 'struct', 'time', 'typing', 'numpy', 'pandas', 'argparse'],
+    #     'allowed-io': ['CatalogStore.metadata', 'CatalogStore._save', 'CatalogStore._write_metadata',
+    #                    '_NpyWriter.__init__', 'file_hash'],
+    #     'max-line-length': 120
+    # })
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the columnar cache of a song catalog CSV.')
+    parser.add_argument('source', help='the song catalog CSV file')
+    parser.add_argument('--directory', default='.catalog', help='the directory of the cache')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='the number of rows read at a time')
+    args = parser.parse_args()
+
+    store = CatalogStore(args.directory)
+    if not store.is_current(args.source):
+        ingestion = store.build(args.source, chunksize=args.chunksize)
+        print(f"Read {ingestion['rows_read']} rows in {ingestion['seconds']:.2f} s "
+              f"({ingestion['rows_per_second']:,.0f} rows/s): kept {ingestion['rows_kept']}, dropped "
+              f"{ingestion['rows_missing_features']} missing features and {ingestion['rows_duplicate']} duplicates")
+
+    started = time.perf_counter()
+    songs = store.load()
+    print(f"Loaded {len(songs)} songs in {time.perf_counter() - started:.3f} s")
@@ -8,9 +8,18 @@ We have marked each place you to modify code with the word "TODO" in order to ru
 
 # Standard Library imports
 from __future__ import annotations
+import heapq
+import io
+import itertools
+import json
+import os
 import random
-from collections import Counter
-from typing import Any, Optional
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Iterable, Iterator, Optional, TextIO
 import python_ta
 
 # Third-Party Library imports
@@ -18,11 +27,26 @@ import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import LabelEncoder
 import graphviz
 from graphviz import Source
 
+# the split search strategies supported by DecisionTree
+SPLITTERS = ('sorted', 'histogram', 'exhaustive')
+
+# the ways DecisionTree can place bin boundaries when splitter == 'histogram'
+BINNINGS = ('quantile', 'uniform')
+
+# the record layout used by FlatTree.save and FlatTree.load
+FLAT_TREE_DTYPE = np.dtype([('feature', np.int32), ('threshold', np.float64), ('left', np.int32),
+                            ('right', np.int32), ('value', np.int64), ('start', np.int64), ('end', np.int64)])
+
+# work on fewer samples than this is never divided between worker threads
+PARALLEL_MIN_SAMPLES = 2048
+
+# information gains closer than this are treated as equal when choosing a split
+GAIN_TOLERANCE = 1e-9
+
 
 class Node:
     """A class representing a node in the decision tree.
@@ -34,28 +58,316 @@ class Node:
         - right: The right child node.
         - value: The class label or predicted value of the node. This is used only in leaf nodes.
         It is the majority class or predicted label at this node.
+        - start: The position in the tree's sample order of the first training sample that reached this node.
+        - end: The position in the tree's sample order just after the last training sample that reached this node.
     """
     feature: Optional[int]
     threshold: Optional[float]
     left: Optional[Node]
     right: Optional[Node]
     value: Optional[Any]
+    start: int
+    end: int
 
     def __init__(self, feature: Optional[int] = None, threshold: Optional[float] = None,
                  left: Optional[Node] = None, right: Optional[Node] = None,
-                 value: Optional[int] = None) -> None:
+                 value: Optional[int] = None, start: int = 0, end: int = 0) -> None:
         """Initialize a Node class."""
         self.feature = feature
         self.threshold = threshold
         self.left = left
         self.right = right
         self.value = value
+        self.start = start
+        self.end = end
 
     def is_leaf_node(self) -> None:
         """Returns whether the node is a leaf node."""
         return self.value is not None
 
 
+class FlatTree:
+    """A trained decision tree compiled into parallel NumPy arrays, indexed by node id.
+
+    The root has id 0. Leaves have feature, left and right equal to -1, and internal nodes have value
+    equal to -1, as do leaves that no training sample reached. The training samples that reached a node
+    are samples[start[node]:end[node]], so a query can read the songs in its leaf without searching the
+    catalog. The arrays hold plain numbers only, so a FlatTree is cheap to pickle, and save and load store
+    it as .npy files that can be memory-mapped.
+
+    Instance Attributes:
+        - feature: The index of the feature used to split at each node.
+        - threshold: The threshold used to split at each node. Samples with feature <= threshold go left.
+        - left: The id of the left child of each node.
+        - right: The id of the right child of each node.
+        - value: The class label predicted by each leaf.
+        - start: The position in samples of the first training sample that reached each node.
+        - end: The position in samples just after the last training sample that reached each node.
+        - samples: The ids of the training samples, ordered so that the samples of every node are contiguous.
+
+    Representation Invariants:
+        - self.feature.shape == self.threshold.shape == self.left.shape == self.right.shape == self.value.shape
+        - self.feature.shape == self.start.shape == self.end.shape
+        - all((self.feature == -1) == (self.left == -1))
+        - all((self.left == -1) == (self.right == -1))
+        - all(0 <= self.start <= self.end <= len(self.samples))
+    """
+    feature: np.ndarray
+    threshold: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    value: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    samples: np.ndarray
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, left: np.ndarray, right: np.ndarray,
+                 value: np.ndarray, start: np.ndarray, end: np.ndarray, samples: Optional[np.ndarray] = None) -> None:
+        """Initialize a FlatTree from its node arrays."""
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.start = start
+        self.end = end
+        self.samples = np.zeros(0, dtype=np.int64) if samples is None else samples
+
+    @classmethod
+    def from_node(cls, root: Node, samples: Optional[np.ndarray] = None) -> FlatTree:
+        """Compile the linked tree rooted at root, numbering the nodes in depth-first preorder. samples is
+        the order of the training samples that the start and end of every node refer to.
+
+        >>> tree = Node(feature=1, threshold=0.5, left=Node(value=3),
+        ...             right=Node(feature=0, threshold=2.0, left=Node(value=4), right=Node(value=5)))
+        >>> flat = FlatTree.from_node(tree)
+        >>> flat.feature.tolist(), flat.left.tolist(), flat.right.tolist(), flat.value.tolist()
+        ([1, -1, 0, -1, -1], [1, -1, 3, -1, -1], [2, -1, 4, -1, -1], [-1, 3, -1, 4, 5])
+        >>> flat.predict(np.array([[0.0, 0.2], [1.0, 0.9], [3.0, 0.9]])).tolist()
+        [3, 4, 5]
+        >>> flat.predict_one(np.array([3.0, 0.9]))
+        5
+        """
+        nodes = []
+        ids = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            ids[id(node)] = len(nodes)
+            nodes.append(node)
+            if not (node.is_leaf_node() or node.feature is None):
+                stack.append(node.right)
+                stack.append(node.left)
+
+        n_nodes = len(nodes)
+        flat = cls(np.full(n_nodes, -1, dtype=np.int32), np.zeros(n_nodes), np.full(n_nodes, -1, dtype=np.int32),
+                   np.full(n_nodes, -1, dtype=np.int32), np.full(n_nodes, -1, dtype=np.int64),
+                   np.array([node.start for node in nodes], dtype=np.int64),
+                   np.array([node.end for node in nodes], dtype=np.int64), samples)
+        for i, node in enumerate(nodes):
+            if node.is_leaf_node() or node.feature is None:
+                flat.value[i] = -1 if node.value is None else node.value
+            else:
+                flat.feature[i] = node.feature
+                flat.threshold[i] = node.threshold
+                flat.left[i] = ids[id(node.left)]
+                flat.right[i] = ids[id(node.right)]
+
+        return flat
+
+    def to_node(self) -> Node:
+        """Rebuild the linked tree that this tree was compiled from.
+
+        Empty leaves, stored with value -1, get back a value of None.
+
+        >>> tree = Node(feature=1, threshold=0.5, left=Node(value=3), right=Node(value=4))
+        >>> rebuilt = FlatTree.from_node(tree).to_node()
+        >>> rebuilt.feature, rebuilt.threshold, rebuilt.left.value, rebuilt.right.value
+        (1, 0.5, 3, 4)
+        >>> empty = FlatTree.from_node(Node(feature=0, threshold=1.0, left=Node(value=2), right=Node())).to_node()
+        >>> empty.left.value, empty.right.value
+        (2, None)
+        """
+        nodes = [Node(value=None if self.value.item(i) < 0 else self.value.item(i),
+                      start=self.start.item(i), end=self.end.item(i))
+                 if self.feature.item(i) < 0 else
+                 Node(feature=self.feature.item(i), threshold=self.threshold.item(i),
+                      start=self.start.item(i), end=self.end.item(i))
+                 for i in range(len(self.feature))]
+        for i, node in enumerate(nodes):
+            if node.feature is not None:
+                node.left, node.right = nodes[self.left.item(i)], nodes[self.right.item(i)]
+        return nodes[0]
+
+    def apply(self, x_data: np.ndarray) -> np.ndarray:
+        """Return the id of the leaf that each row of x_data reaches.
+
+        All rows are routed together, one level of the tree at a time, so the number of NumPy operations
+        depends on the depth of the tree and not on the number of rows.
+        """
+        nodes = np.zeros(len(x_data), dtype=np.int64)
+        active = np.flatnonzero(self.feature[nodes] >= 0)
+
+        while active.size > 0:
+            current = nodes[active]
+            goes_left = x_data[active, self.feature[current]] <= self.threshold[current]
+            nodes[active] = np.where(goes_left, self.left[current], self.right[current])
+            active = active[self.feature[nodes[active]] >= 0]
+
+        return nodes
+
+    def predict(self, x_data: np.ndarray) -> np.ndarray:
+        """Predict the class label of every row of x_data."""
+        return self.value[self.apply(x_data)]
+
+    def members(self, node: int) -> np.ndarray:
+        """Return the ids of the training samples that reached the node with id node."""
+        return self.samples[self.start[node]:self.end[node]]
+
+    def predict_one(self, x: np.ndarray) -> int:
+        """Predict the class label of a single sample x, without the overhead of routing a batch."""
+        node = 0
+        feature = self.feature.item(0)
+        while feature >= 0:
+            if x[feature] <= self.threshold.item(node):
+                node = self.left.item(node)
+            else:
+                node = self.right.item(node)
+            feature = self.feature.item(node)
+
+        return self.value.item(node)
+
+    def save(self, file: str) -> None:
+        """Save the nodes of this tree to file as a single structured .npy array, and its sample order
+        next to it, to the same path with the extension .samples.npy.
+
+        Preconditions:
+            - file.endswith('.npy')
+        """
+        np.save(file, self.to_records())
+        np.save(_samples_file(file), self.samples)
+
+    @classmethod
+    def load(cls, file: str, mmap_mode: Optional[str] = None) -> FlatTree:
+        """Load a tree saved by save. With mmap_mode='r', the arrays are read-only views of memory maps,
+        which any number of processes can share.
+
+        Preconditions:
+            - file.endswith('.npy')
+        """
+        return cls.from_records(np.load(file, mmap_mode=mmap_mode), np.load(_samples_file(file), mmap_mode=mmap_mode))
+
+    def to_records(self) -> np.ndarray:
+        """Return the nodes of this tree as one structured array of FLAT_TREE_DTYPE, one record per node.
+
+        >>> flat = FlatTree.from_node(Node(feature=0, threshold=0.5, left=Node(value=3), right=Node(value=4)))
+        >>> rebuilt = FlatTree.from_records(flat.to_records(), flat.samples)
+        >>> rebuilt.left.tolist(), rebuilt.value.tolist()
+        ([1, -1, -1], [-1, 3, 4])
+        """
+        records = np.empty(len(self.feature), dtype=FLAT_TREE_DTYPE)
+        for field in FLAT_TREE_DTYPE.names:
+            records[field] = getattr(self, field)
+        return records
+
+    @classmethod
+    def from_records(cls, records: np.ndarray, samples: np.ndarray, copy: bool = False) -> FlatTree:
+        """Return the tree whose nodes are records, as returned by to_records, with the given sample order.
+        The node arrays are views of the fields of records, or contiguous copies of them if copy is True.
+        """
+        return cls(*(records[field].copy() if copy else records[field] for field in FLAT_TREE_DTYPE.names),
+                   samples=samples)
+
+
+def _samples_file(file: str) -> str:
+    """Return the file that FlatTree.save stores the sample order of a tree saved to file in."""
+    return file[:-len('.npy')] + '.samples.npy'
+
+
+class FitStats:
+    """Counts and timings recorded while a DecisionTree is fit with collect_stats=True, per depth of the tree.
+
+    Every entry of levels describes the nodes at one depth: how many there were ('nodes'), how many of them
+    were split ('splits'), the number of training samples they held ('samples'), the number of candidate
+    thresholds scored while searching for their splits ('thresholds'), and the seconds spent counting their
+    labels and checking the stopping criteria ('entropy_seconds'), searching for their best splits
+    ('best_split_seconds') and partitioning their samples ('split_seconds').
+
+    Instance Attributes:
+        - levels: The counts and timings of every depth, where levels[d] describes the nodes at depth d.
+        - leaf_sizes: The number of training samples in every leaf of the fitted tree, in preorder.
+
+    >>> stats = FitStats()
+    >>> _ = stats.record(1, time.perf_counter(), 'split_seconds', nodes=2, splits=1)
+    >>> [level['nodes'] for level in stats.levels], stats.levels[1]['splits']
+    ([0, 2], 1)
+    >>> stats.leaf_sizes = np.array([1, 3, 3, 8])
+    >>> stats.to_dict()['leaf_sizes']
+    {'count': 4, 'min': 1, 'median': 3.0, 'mean': 3.75, 'max': 8, 'histogram': {'1': 1, '2-3': 2, '8-15': 1}}
+    """
+    levels: list[dict[str, float]]
+    leaf_sizes: np.ndarray
+
+    def __init__(self) -> None:
+        """Initialize an empty FitStats."""
+        self.levels = []
+        self.leaf_sizes = np.zeros(0, dtype=np.int64)
+
+    def record(self, depth: int, timer: float, phase: str, **counts: int) -> float:
+        """Add the seconds since timer to the phase timing of depth, and counts to its counts, and return the
+        current time, so that the next phase can be timed from it.
+
+        Preconditions:
+            - phase in {'entropy_seconds', 'best_split_seconds', 'split_seconds'}
+            - all(key in {'nodes', 'splits', 'samples', 'thresholds'} for key in counts)
+        """
+        now = time.perf_counter()
+        while len(self.levels) <= depth:
+            self.levels.append({'depth': len(self.levels), 'nodes': 0, 'splits': 0, 'samples': 0, 'thresholds': 0,
+                                'entropy_seconds': 0.0, 'best_split_seconds': 0.0, 'split_seconds': 0.0})
+        level = self.levels[depth]
+        level[phase] += now - timer
+        for key, count in counts.items():
+            level[key] += int(count)
+        return now
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return these stats as a dictionary of JSON types, with the leaf sizes summarized by their count,
+        minimum, median, mean and maximum, and a histogram of how many leaves have 1, 2-3, 4-7, ... samples.
+        """
+        sizes = self.leaf_sizes
+        summary = {'count': len(sizes)}
+        if len(sizes) > 0:
+            # bucket b > 0 holds the leaves with 2 ** (b - 1) to 2 ** b - 1 samples, and bucket 0 the empty ones
+            buckets = np.bincount(np.where(sizes > 0, np.log2(np.maximum(sizes, 1)).astype(np.int64) + 1, 0))
+            summary.update({'min': int(sizes.min()), 'median': float(np.median(sizes)), 'mean': float(sizes.mean()),
+                            'max': int(sizes.max()),
+                            'histogram': {_bucket_name(b): int(count) for b, count in enumerate(buckets.tolist())
+                                          if count > 0}})
+        return {'levels': [dict(level) for level in self.levels], 'leaf_sizes': summary}
+
+    def to_json(self, file: Optional[str] = None) -> str:
+        """Return these stats as a JSON string, and also write it to file if it is given."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if file is not None:
+            with open(file, 'w') as out:
+                out.write(text)
+        return text
+
+
+def _bucket_name(bucket: int) -> str:
+    """Return the range of leaf sizes that bucket of the FitStats leaf size histogram holds."""
+    return str(bucket) if bucket <= 1 else f'{2 ** (bucket - 1)}-{2 ** bucket - 1}'
+
+
+def _count_thresholds(buffers: _TrainingBuffers, start: int, end: int, feat_idxs: np.ndarray) -> int:
+    """Return the number of candidate thresholds of the features feat_idxs at the node
+    buffers.samples[start:end], which is the number of distinct values each of them takes there.
+    """
+    x_node = buffers.x_data[buffers.samples[start:end]]
+    return sum(len(np.unique(x_node[:, feat_idx])) for feat_idx in feat_idxs)
+
+
 class DecisionTree:
     """A class representing a decision tree that manages the song recommendation system.
 
@@ -64,70 +376,992 @@ class DecisionTree:
         - max_depth: The maximum depth of the decision tree. Limits the tree's growth to prevent overfitting.
         - n_features: The number of features to consider when looking for the best split.
         If None, all features are considered.
+        - splitter: The strategy used to search for the best split. 'sorted' sorts each candidate feature
+        once per node and sweeps every threshold in a single pass, 'histogram' only considers the boundaries
+        of at most max_bins bins per feature, and 'exhaustive' re-splits the data for every candidate
+        threshold (slow, kept as a reference implementation).
+        - max_bins: The maximum number of bins per feature when splitter == 'histogram'.
+        - binning: How bin boundaries are placed when splitter == 'histogram', either at quantiles of the
+        feature ('quantile') or evenly between its minimum and maximum ('uniform').
+        - bin_thresholds: For every feature, the upper cut point of each of its bins: the cut points between
+        consecutive bins, which need not be training values, followed by the largest training value.
+        Only set after fitting with splitter == 'histogram'.
+        - n_jobs: The number of threads fit uses, or -1 to use every CPU. The nodes of every level are divided
+        between the threads in ranges with about as many samples each, which are searched and partitioned in
+        parallel, and a level with a single node has its features searched in parallel instead. The trained
+        tree does not depend on n_jobs.
+        - random_state: The seed for choosing the features considered at each node. If None, a seed is
+        drawn from NumPy's global random state at the start of every fit.
+        - max_leaf_nodes: The maximum number of leaves, or None for no limit.
+        - time_budget: The number of seconds after which fit stops splitting nodes, or None for no limit.
+        If either max_leaf_nodes or time_budget is set, the tree is grown best-first: the leaf whose split
+        has the highest information gain is always split next, so a tree cut short by either limit still
+        has the most informative splits. Without limits, best-first growth gives the same tree.
         - root: The root node of the decision tree.
+        - flat_tree: The trained tree compiled into arrays, which predict uses.
+        - fit_report: A summary of the last fit: the number of nodes split ('nodes_expanded'), the number of
+        leaves that could have been split but were not because a limit was reached ('nodes_skipped'), the
+        number of leaves ('leaves'), the limit that stopped growth or None ('stopped_by'), and the time fit
+        took in seconds ('seconds'). partial_fit recounts the nodes and leaves of the updated tree, keeps
+        'nodes_skipped' and 'stopped_by', and reports its own time.
+        - collect_stats: Whether fit records per-depth counts and timings in stats. Off by default, since
+        timing every phase of every level has a small cost.
+        - stats: The counts and timings recorded by the last fit, or None if collect_stats was False or
+        the tree has been updated by partial_fit since.
+
+    Representation Invariants:
+        - self.splitter in SPLITTERS
+        - self.binning in BINNINGS
+        - 2 <= self.max_bins <= 256
+        - self.n_jobs == -1 or self.n_jobs >= 1
+        - self.max_leaf_nodes is None or self.max_leaf_nodes >= 2
+        - self.time_budget is None or self.time_budget > 0
     """
     min_samples_split: int
     max_depth: int
     n_features: Optional[int]
+    splitter: str
+    max_bins: int
+    binning: str
+    bin_thresholds: Optional[list[np.ndarray]]
+    n_jobs: int
+    random_state: Optional[int]
+    max_leaf_nodes: Optional[int]
+    time_budget: Optional[float]
     root: Optional[Node]
-
-    def __init__(self, min_samples_split: int = 2, max_depth: int = 5, n_features: Optional[int] = None) -> None:
+    flat_tree: Optional[FlatTree]
+    fit_report: Optional[dict[str, Any]]
+    collect_stats: bool
+    stats: Optional[FitStats]
+    # Private Instance Attributes:
+    #     - _x_train: the matrix the tree was grown on, which is binned for the histogram splitter, or None
+    #       if the tree was not fitted in this session
+    #     - _y_train: the labels the tree was grown on
+    #     - _sample_ids: the id of every row of _x_train
+    #     - _train_order: the rows of _x_train in the sample order of flat_tree
+    #     - _seed: the seed of the features chosen at every node
+    _x_train: Optional[_GrowableRows]
+    _y_train: Optional[_GrowableRows]
+    _sample_ids: Optional[_GrowableRows]
+    _train_order: Optional[np.ndarray]
+    _seed: int
+
+    def __init__(self, min_samples_split: int = 2, max_depth: int = 5, n_features: Optional[int] = None,
+                 splitter: str = 'sorted', max_bins: int = 255, binning: str = 'quantile', n_jobs: int = 1,
+                 random_state: Optional[int] = None, max_leaf_nodes: Optional[int] = None,
+                 time_budget: Optional[float] = None, collect_stats: bool = False) -> None:
         """Initializes a DecisionTree class."""
+        if splitter not in SPLITTERS:
+            raise ValueError(f"Unknown splitter '{splitter}', expected one of {SPLITTERS}.")
+        if binning not in BINNINGS:
+            raise ValueError(f"Unknown binning '{binning}', expected one of {BINNINGS}.")
+        if not 2 <= max_bins <= 256:
+            raise ValueError(f"max_bins must be between 2 and 256, got {max_bins}.")
+        if n_jobs != -1 and n_jobs < 1:
+            raise ValueError(f"n_jobs must be -1 or at least 1, got {n_jobs}.")
+        if max_leaf_nodes is not None and max_leaf_nodes < 2:
+            raise ValueError(f"max_leaf_nodes must be at least 2, got {max_leaf_nodes}.")
+        if time_budget is not None and time_budget <= 0:
+            raise ValueError(f"time_budget must be positive, got {time_budget}.")
         self.min_samples_split = min_samples_split
         self.max_depth = max_depth
         self.n_features = n_features
+        self.splitter = splitter
+        self.max_bins = max_bins
+        self.binning = binning
+        self.bin_thresholds = None
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.max_leaf_nodes = max_leaf_nodes
+        self.time_budget = time_budget
         self.root = None
+        self.flat_tree = None
+        self.fit_report = None
+        self.collect_stats = collect_stats
+        self.stats = None
+        self._x_train = None
+        self._y_train = None
+        self._sample_ids = None
+        self._train_order = None
+        self._seed = 0
+
+    def get_params(self) -> dict[str, Any]:
+        """Return the hyperparameters this tree was initialized with, as keyword arguments for DecisionTree."""
+        return {'min_samples_split': self.min_samples_split, 'max_depth': self.max_depth,
+                'n_features': self.n_features, 'splitter': self.splitter, 'max_bins': self.max_bins,
+                'binning': self.binning, 'n_jobs': self.n_jobs, 'random_state': self.random_state,
+                'max_leaf_nodes': self.max_leaf_nodes, 'time_budget': self.time_budget,
+                'collect_stats': self.collect_stats}
+
+    def fit(self, x_data: np.ndarray, y_data: np.ndarray, sample_ids: Optional[np.ndarray] = None) -> None:
+        """Fits a decision tree to the dataset.
+
+        With splitter == 'histogram', x_data is first quantized into a uint8 matrix of bin indices, which the
+        tree is grown on instead of the original features.
+
+        Every leaf records the ids of the training samples that reached it (see leaf_members). sample_ids
+        gives the id of every row of x_data, such as its row position in the song catalog, and defaults to
+        the row positions in x_data.
+
+        >>> rng = np.random.default_rng(7)
+        >>> x = rng.integers(0, 40, size=(400, 3)).astype(float)  # fewer unique values than bins
+        >>> y = rng.integers(0, 5, size=400)
+        >>> exact, binned = DecisionTree(max_depth=4), DecisionTree(max_depth=4, splitter='histogram')
+        >>> exact.fit(x, y)
+        >>> binned.fit(x, y)
+        >>> bool(np.all(exact.predict(x) == binned.predict(x)))
+        True
+        >>> small = DecisionTree(max_depth=4, max_leaf_nodes=5)
+        >>> small.fit(x, y)
+        >>> small.fit_report['leaves'], small.fit_report['nodes_expanded'], small.fit_report['stopped_by']
+        (5, 4, 'max_leaf_nodes')
+        >>> traced = DecisionTree(max_depth=4, collect_stats=True)
+        >>> traced.fit(x, y)
+        >>> [level['nodes'] for level in traced.stats.levels]
+        [1, 2, 4, 8, 16]
+        >>> int(traced.stats.leaf_sizes.sum()), traced.stats.levels[0]['samples']
+        (400, 400)
+        """
+        started = time.perf_counter()
+        if self.splitter == 'histogram':
+            x_data, self.bin_thresholds = bin_features(x_data, self.max_bins, self.binning)
+        self.fit_prepared(x_data, y_data, sample_ids, started)
+
+    def fit_prepared(self, x_data: np.ndarray, y_data: np.ndarray, sample_ids: Optional[np.ndarray] = None,
+                     started: Optional[float] = None, presorted: Optional[np.ndarray] = None) -> None:
+        """Fit this tree like fit does, on training data that has already been prepared for its splitter.
+
+        This lets callers that fit many trees on the same rows, such as cross_validate_grid, bin or sort
+        the rows once. For the histogram splitter, x_data holds bin indices computed with
+        self.bin_thresholds, which are kept as they are. For the sorted splitter, presorted can give the
+        indices of the rows of x_data sorted by every feature, one row per feature as
+        np.argsort(x_data, axis=0).T gives them, so that they are not sorted again. started is the
+        time.perf_counter() reading that fit_report['seconds'] counts from, and defaults to now.
+
+        Preconditions:
+            - self.splitter != 'histogram' or self.bin_thresholds is not None
+            - self.splitter != 'histogram' or x_data was binned with self.bin_thresholds
+            - presorted is None or presorted.shape == (x_data.shape[1], x_data.shape[0])
+
+        >>> rng = np.random.default_rng(3)
+        >>> x, y = rng.random((300, 3)), rng.integers(0, 4, size=300)
+        >>> binned = DecisionTree(max_depth=4, splitter='histogram', random_state=0)
+        >>> binned.fit(x, y)
+        >>> reused = DecisionTree(max_depth=4, splitter='histogram', random_state=0)
+        >>> x_binned, reused.bin_thresholds = bin_features(x)
+        >>> reused.fit_prepared(x_binned, y)
+        >>> bool(np.all(reused.predict(x) == binned.predict(x)))
+        True
+        >>> exact, presorted = DecisionTree(max_depth=4, random_state=0), DecisionTree(max_depth=4, random_state=0)
+        >>> exact.fit(x, y)
+        >>> presorted.fit_prepared(x, y, presorted=np.argsort(x, axis=0, kind='stable').T)
+        >>> bool(np.all(presorted.predict(x) == exact.predict(x)))
+        True
+        """
+        started = time.perf_counter() if started is None else started
 
-    def fit(self, x_data: np.ndarray, y_data: np.ndarray) -> None:
-        """Fits a decision tree to the dataset."""
         # check that self.n_features is not more than the actual number of features
         self.n_features = x_data.shape[1] if not self.n_features else min(x_data.shape[1], self.n_features)
-        self.root = self._grow_tree(x_data, y_data)  # builds a decision tree based on the training data
 
-    def _grow_tree(self, x_data: np.ndarray, y_data: np.ndarray, depth: int = 0) -> Node:
-        """Recursively grows the decision tree."""
-        n_samples, n_feats = x_data.shape  # get the number of samples and the number of features in the current node
-        n_labels = len(np.unique(y_data))  # get the number of unique labels in the target variable
+        seed = self.random_state if self.random_state is not None else np.random.randint(2 ** 31)
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
 
-        # check the stopping criteria
-        if depth >= self.max_depth or n_labels == 1 or n_samples < self.min_samples_split:
-            # stop growing and return the most common label at this node
-            leaf_value = self._most_common_label(y_data)
-            return Node(value=leaf_value)
+        with ThreadPoolExecutor(n_jobs) if n_jobs > 1 else nullcontext() as pool:
+            buffers = _TrainingBuffers(x_data, y_data, self.splitter, seed, pool, presorted, n_jobs)
+            buffers.stats = FitStats() if self.collect_stats else None
+            if self.max_leaf_nodes is None and self.time_budget is None:
+                # builds a decision tree based on the training data
+                self.root = self._grow_tree(buffers)
+                nodes_skipped, stopped_by = 0, None
+            else:
+                self.root, nodes_skipped, stopped_by = self._grow_best_first(buffers, started)
+
+        sample_ids = np.arange(len(y_data)) if sample_ids is None else np.asarray(sample_ids)
+        self._x_train, self._y_train = _GrowableRows(x_data), _GrowableRows(np.asarray(y_data))
+        self._sample_ids, self._train_order, self._seed = _GrowableRows(sample_ids), buffers.samples, seed
+        self.flat_tree = FlatTree.from_node(self.root, sample_ids[buffers.samples])
+
+        n_leaves = int(np.count_nonzero(self.flat_tree.feature < 0))
+        self.stats = buffers.stats
+        if self.stats is not None:
+            self.stats.leaf_sizes = (self.flat_tree.end - self.flat_tree.start)[self.flat_tree.feature < 0]
+        self.fit_report = {'nodes_expanded': len(self.flat_tree.feature) - n_leaves, 'nodes_skipped': nodes_skipped,
+                           'leaves': n_leaves, 'stopped_by': stopped_by, 'seconds': time.perf_counter() - started}
+
+    def partial_fit(self, x_data: np.ndarray, y_data: np.ndarray, sample_ids: Optional[np.ndarray] = None) -> None:
+        """Add new training samples to a fitted tree, without refitting it from scratch.
+
+        Every new sample is routed to its leaf, and only the leaves that gained samples are grown again, on
+        their old and new samples together, with the same stopping criteria as fit. A leaf that stays too
+        small, pure or deep just updates its label, and the rest of the tree is kept as it is. The training
+        rows are kept in a buffer that grows by doubling, so only the new rows are written, and the nodes and
+        sample order around the regrown leaves are moved as whole slices, so the cost depends on the new
+        samples and the leaves they reach rather than on the whole training set. The histogram splitter
+        keeps the bins of the first fit. sample_ids gives the ids of the new samples, and
+        defaults to the row positions that follow the existing training samples.
+
+        The tree can differ from one fitted on all the samples at once, since the splits above the leaves
+        were chosen without the new samples. A tree with max_leaf_nodes or time_budget set keeps its shape,
+        so that it stays within its limits, and its reached leaves only update their labels.
+
+        fit_report is updated to count the nodes and leaves of the new tree, and stats, which described the
+        levels grown by fit, is cleared.
 
-        # only select unique features
-        feat_idxs = np.random.choice(n_feats, self.n_features, replace=False)
+        Preconditions:
+            - x_data.shape[1] == self._x_train.view().shape[1]
+
+        Raise a ValueError if this tree was not fitted with fit, which keeps the training data, in this
+        session.
+
+        >>> rng = np.random.default_rng(13)
+        >>> x = rng.random((4000, 4))
+        >>> y = (x[:, 0] > 0.5) + 2 * (x[:, 1] > 0.3) + (rng.random(4000) < 0.1)  # with 10% label noise
+        >>> incremental, refit = DecisionTree(max_depth=5, random_state=0), DecisionTree(max_depth=5, random_state=0)
+        >>> incremental.fit(x[:3000], y[:3000])
+        >>> incremental.partial_fit(x[3000:], y[3000:])
+        >>> refit.fit(x, y)
+        >>> x_test = rng.random((2000, 4))
+        >>> y_test = (x_test[:, 0] > 0.5) + 2 * (x_test[:, 1] > 0.3)
+        >>> drift = accuracy_score(y_test, refit.predict(x_test)) - accuracy_score(y_test, incremental.predict(x_test))
+        >>> abs(drift) < 0.02
+        True
+        >>> sorted(incremental.flat_tree.samples.tolist()) == list(range(4000))
+        True
+        >>> incremental.fit_report['leaves'] == int(np.count_nonzero(incremental.flat_tree.feature < 0))
+        True
+        >>> before = incremental.flat_tree.to_records()
+        >>> incremental.partial_fit(np.empty((0, 4)), np.empty(0, dtype=int))
+        >>> bool(np.array_equal(incremental.flat_tree.to_records(), before))
+        True
+        """
+        if self._x_train is None:
+            raise ValueError("partial_fit needs a tree fitted with fit in this session.")
+        if len(y_data) == 0:
+            return
+        started = time.perf_counter()
+
+        n_old = self._x_train.size
+        x_grown = _apply_bins(x_data, self.bin_thresholds) if self.splitter == 'histogram' else x_data
+        self._x_train.append(x_grown)
+        self._y_train.append(np.asarray(y_data))
+        self._sample_ids.append(np.arange(n_old, n_old + len(y_data)) if sample_ids is None
+                                else np.asarray(sample_ids))
+
+        # group the new rows by the id of the leaf they reach, in preorder
+        leaves = self.flat_tree.apply(x_data)
+        by_leaf = np.argsort(leaves, kind='stable')
+        firsts = np.flatnonzero(np.diff(leaves[by_leaf], prepend=-1))
+        reached = leaves[by_leaf][firsts]
+
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        with ThreadPoolExecutor(n_jobs) if n_jobs > 1 else nullcontext() as pool:
+            parents = _parent_ids(self.flat_tree)
+            subtrees = [self._regrow_leaf(leaf, new_rows, parents, pool)
+                        for leaf, new_rows in zip(reached.tolist(), np.split(n_old + by_leaf, firsts[1:]))]
+
+        self._splice_subtrees(reached, subtrees)
+        self.stats = None
+
+        n_leaves = int(np.count_nonzero(self.flat_tree.feature < 0))
+        self.fit_report = {**self.fit_report, 'nodes_expanded': len(self.flat_tree.feature) - n_leaves,
+                           'leaves': n_leaves, 'seconds': time.perf_counter() - started}
+
+    def _regrow_leaf(self, leaf: int, new_rows: np.ndarray, parents: np.ndarray,
+                     pool: Optional[Executor]) -> tuple[Node, np.ndarray]:
+        """Grow the leaf of flat_tree with id leaf again, for partial_fit, on its rows of _x_train and the
+        new_rows that reach it, and return the root of its new subtree together with those rows in the
+        sample order of the subtree. parents holds the id of the parent of every node, as _parent_ids returns.
+
+        The subtree is grown at the depth and position of the leaf, so it chooses the features fit would
+        choose there. A leaf that stays too deep, small or pure, or any leaf of a tree with max_leaf_nodes or
+        time_budget set, only updates its label, without copying its rows.
+        """
+        rows = np.concatenate([self._train_order[self.flat_tree.start[leaf]:self.flat_tree.end[leaf]], new_rows])
+        y_train = self._y_train.view()
+
+        # the path from the root gives the depth and position of the leaf
+        path, node = [], leaf
+        while parents[node] >= 0:
+            path.append(int(self.flat_tree.right[parents[node]] == node))
+            node = parents[node]
+        has_limits = self.max_leaf_nodes is not None or self.time_budget is not None
+        if has_limits or self._stops_growing(y_train[rows], len(path)):
+            return Node(value=self._most_common_label(y_train[rows]), start=0, end=len(rows)), rows
+
+        position = 1
+        for went_right in reversed(path):
+            position = 2 * position + went_right
+
+        buffers = _TrainingBuffers(self._x_train.view()[rows], y_train[rows], self.splitter, self._seed, pool,
+                                   n_threads=os.cpu_count() if self.n_jobs == -1 else self.n_jobs)
+        subtree = self._grow_tree(buffers, len(path), position)
+        return subtree, rows[buffers.samples]
+
+    def _splice_subtrees(self, leaves: np.ndarray, subtrees: list[tuple[Node, np.ndarray]]) -> None:
+        """Replace every leaf of flat_tree in leaves by the subtree with the rows of _x_train that
+        _regrow_leaf returned for it, and update the sample order and root to match.
+
+        The nodes of flat_tree are numbered in preorder, and every subtree is put in place of its leaf in
+        preorder too, so a node's new id and range only depend on the nodes and samples that the leaves
+        before it gained. The nodes and samples around the leaves are moved as whole slices, so only the
+        regrown leaves are rebuilt.
+
+        Preconditions:
+            - leaves is sorted and holds the ids of leaves of flat_tree
+            - len(subtrees) == len(leaves)
+        """
+        flat = self.flat_tree
+        n_nodes = len(flat.feature)
+        sub_records = [FlatTree.from_node(subtree).to_records() for subtree, _ in subtrees]
+        nodes_before = np.concatenate(([0], np.cumsum([len(records) - 1 for records in sub_records],
+                                                      dtype=np.int64)))
+        rows_before = np.concatenate(([0], np.cumsum([len(rows) for _, rows in subtrees]
+                                                     - (flat.end[leaves] - flat.start[leaves]), dtype=np.int64)))
+
+        # a node's samples end where the samples of its last descendant in preorder end
+        last = np.arange(n_nodes)
+        internal = np.flatnonzero(flat.feature >= 0)
+        while internal.size > 0:
+            last[internal] = flat.right[last[internal]]
+            internal = internal[flat.feature[last[internal]] >= 0]
+
+        records = flat.to_records()
+        records['start'] += rows_before[np.searchsorted(leaves, np.arange(n_nodes))]
+        records['end'] += rows_before[np.searchsorted(leaves, last + 1)]
+        for child in ('left', 'right'):
+            has_child = records[child] >= 0
+            records[child][has_child] += nodes_before[np.searchsorted(leaves, records[child][has_child])]
+
+        node_pieces, order_pieces, sample_pieces = [], [], []
+        previous_node, previous_row = 0, 0
+        sample_ids = self._sample_ids.view()
+        for k, (leaf, (_, rows)) in enumerate(zip(leaves.tolist(), subtrees)):
+            subtree_records = sub_records[k]
+            for child in ('left', 'right'):
+                has_child = subtree_records[child] >= 0
+                subtree_records[child][has_child] += leaf + nodes_before[k]
+            subtree_records['start'] += records['start'][leaf]
+            subtree_records['end'] += records['start'][leaf]
+            node_pieces += [records[previous_node:leaf], subtree_records]
+            order_pieces += [self._train_order[previous_row:flat.start[leaf]], rows]
+            sample_pieces += [flat.samples[previous_row:flat.start[leaf]], sample_ids[rows]]
+            previous_node, previous_row = leaf + 1, flat.end[leaf]
+
+        self._train_order = np.concatenate(order_pieces + [self._train_order[previous_row:]])
+        samples = np.concatenate(sample_pieces + [flat.samples[previous_row:]])
+        self.flat_tree = FlatTree.from_records(np.concatenate(node_pieces + [records[previous_node:]]), samples,
+                                               copy=True)
+        self.root = self.flat_tree.to_node()
+
+    def fit_stream(self, chunks: Iterable[tuple[np.ndarray, ...]], sketch_capacity: int = 4096) -> None:
+        """Fit the tree to training data that arrives in chunks, without holding all of it in memory.
+
+        chunks yields (x_chunk, y_chunk) or (x_chunk, y_chunk, ids_chunk) tuples, and must yield the same
+        chunks every time it is iterated over, like a list of chunks or a CsvChunks reader does, since the data
+        is read once to place the bins and then once per level of the tree. ids_chunk gives the sample ids
+        of the rows, which default to their positions in the stream.
+
+        The bin thresholds come from a QuantileSketch of every feature, which is exact when no feature has
+        more than sketch_capacity unique values, and the tree is grown level by level with the histogram
+        splitter: every pass counts the (bin, class) pairs of each node that is being split, chunk by chunk,
+        and the splits are chosen from those counts as fit chooses them. Memory grows with the number of
+        these counts and the ids stored in the leaves, rather than with the size of the feature matrix.
+        When the sketch is exact, the tree is the same as the one fit grows on all the chunks at once.
+
+        Raise a ValueError unless splitter == 'histogram' and none of max_leaf_nodes, time_budget and
+        collect_stats is set, or if chunks yields no samples or different samples on different passes.
+
+        >>> rng = np.random.default_rng(21)
+        >>> x = rng.integers(0, 30, size=(3000, 4)) / 10
+        >>> y = (x[:, 0] > 1.5).astype(int) + (x[:, 2] > 2.0) + (rng.random(3000) < 0.2)
+        >>> chunks = [(x[i:i + 700], y[i:i + 700]) for i in range(0, 3000, 700)]
+        >>> streamed = DecisionTree(max_depth=5, splitter='histogram', random_state=0)
+        >>> streamed.fit_stream(chunks)
+        >>> in_memory = DecisionTree(max_depth=5, splitter='histogram', random_state=0)
+        >>> in_memory.fit(x, y)
+        >>> all(np.array_equal(getattr(streamed.flat_tree, field), getattr(in_memory.flat_tree, field))
+        ...     for field in FLAT_TREE_DTYPE.names + ('samples',))
+        True
+        """
+        if self.splitter != 'histogram':
+            raise ValueError(f"fit_stream needs splitter='histogram', got '{self.splitter}'.")
+        if self.max_leaf_nodes is not None or self.time_budget is not None:
+            raise ValueError("fit_stream does not support max_leaf_nodes or time_budget.")
+        if self.collect_stats:
+            raise ValueError("fit_stream does not support collect_stats.")
+        started = time.perf_counter()
+
+        # the first pass places the bins, and counts the samples and classes
+        sketch, n_rows, n_labels = None, 0, 0
+        for chunk in chunks:
+            x_chunk, y_chunk = chunk[0], np.asarray(chunk[1])
+            if len(y_chunk) == 0:
+                continue
+            sketch = QuantileSketch(x_chunk.shape[1], sketch_capacity) if sketch is None else sketch
+            sketch.update(x_chunk)
+            n_rows += len(y_chunk)
+            n_labels = max(n_labels, int(np.max(y_chunk)) + 1)
+        if sketch is None:
+            raise ValueError("fit_stream needs chunks that yield at least one sample.")
+
+        self.bin_thresholds = sketch.bin_thresholds(self.max_bins, self.binning)
+        self.n_features = sketch.n_columns if not self.n_features else min(sketch.n_columns, self.n_features)
+        seed = self.random_state if self.random_state is not None else np.random.randint(2 ** 31)
+
+        self.root, samples = self._grow_streaming(chunks, n_rows, n_labels, seed)
+        self.flat_tree = FlatTree.from_node(self.root, samples)
+        self._x_train, self._y_train, self._sample_ids, self._train_order, self._seed = None, None, None, None, seed
+        self.stats = None
+
+        n_leaves = int(np.count_nonzero(self.flat_tree.feature < 0))
+        self.fit_report = {'nodes_expanded': len(self.flat_tree.feature) - n_leaves, 'nodes_skipped': 0,
+                           'leaves': n_leaves, 'stopped_by': None, 'seconds': time.perf_counter() - started}
+
+    def _grow_streaming(self, chunks: Iterable[tuple[np.ndarray, ...]], n_rows: int, n_labels: int,
+                        seed: int) -> tuple[Node, np.ndarray]:
+        """Grow the tree for fit_stream, one pass over chunks per level, and return its root and the ids of
+        its training samples in the order that the start and end of every node refer to.
+
+        Nodes are numbered in the order they are created, and the split nodes route the rows of a chunk on
+        the bin index of their feature, as _route_binned does.
+        """
+        n_feats, n_slots = len(self.bin_thresholds), self.n_features
+        n_bins = max(len(column_thresholds) for column_thresholds in self.bin_thresholds)
+        if (n_rows + 1) * n_slots * n_bins * n_labels >= 2 ** 63:
+            raise ValueError("Too many samples and classes to count the (bin, class) pairs of every node.")
+        nodes, positions = [Node()], [1]
+        routes = {'feature': [-1], 'bin': [0], 'left': [-1], 'right': [-1]}
+        frontier, depth = [0], 0
+
+        while frontier:
+            splittable = depth < self.max_depth
+            feat_idxs = np.array([np.random.default_rng([seed, positions[i]]).choice(n_feats, n_slots, replace=False)
+                                  for i in frontier]) if splittable else None
+            frontier_index = np.full(len(nodes), -1, dtype=np.int64)
+            frontier_index[frontier] = np.arange(len(frontier))
+            route_arrays = {key: np.array(values) for key, values in routes.items()}
+
+            # count the classes of every frontier node, and the (feature, bin, class) triples it could split on
+            label_counts, pair_counts = _SparseCounts(), _SparseCounts(track_first=False)
+            for binned, y_chunk, _, offset in self._stream_chunks(chunks, n_rows):
+                node_index = frontier_index[_route_binned(binned, route_arrays)]
+                rows = np.flatnonzero(node_index >= 0)
+                node_index, y_rows = node_index[rows], y_chunk[rows]
+                keys, first, counts = np.unique(node_index * n_labels + y_rows, return_index=True,
+                                                return_counts=True)
+                label_counts.add(keys, counts, offset + rows[first])
+                for slot in range(n_slots) if splittable else ():
+                    bins = binned[rows, feat_idxs[node_index, slot]].astype(np.int64)
+                    keys, counts = np.unique(((node_index * n_slots + slot) * n_bins + bins) * n_labels + y_rows,
+                                             return_counts=True)
+                    pair_counts.add(keys, counts)
+
+            label_keys, label_totals, label_first = label_counts.result()
+            pair_keys, pair_totals, _ = pair_counts.result()
+            node_starts = np.searchsorted(label_keys // n_labels, np.arange(len(frontier) + 1))
+            cell_starts = np.searchsorted(pair_keys // (n_bins * n_labels), np.arange(len(frontier) * n_slots + 1))
+
+            next_frontier = []
+            for i, node_id in enumerate(frontier):
+                labels = label_keys[node_starts[i]:node_starts[i + 1]] % n_labels
+                totals = label_totals[node_starts[i]:node_starts[i + 1]]
+                node = nodes[node_id]
+                node.end = int(np.sum(totals))
+                if not (splittable and len(labels) > 1 and node.end >= self.min_samples_split):
+                    # stop growing and keep the most common label, ties going to the label that occurs first
+                    if node.end > 0:
+                        most_common = np.flatnonzero(totals == np.max(totals))
+                        first = label_first[node_starts[i]:node_starts[i + 1]]
+                        node.value = labels[most_common[np.argmin(first[most_common])]].item()
+                    continue
+
+                parent_entropy = _label_entropy(totals)
+                sweeps = []
+                for slot in range(n_slots):
+                    cells = slice(cell_starts[i * n_slots + slot], cell_starts[i * n_slots + slot + 1])
+                    pair_bins = pair_keys[cells] // n_labels % n_bins
+                    local_labels = np.searchsorted(labels, pair_keys[cells] % n_labels)
+                    sweeps.append(self._sweep_bin_counts(pair_bins, local_labels, pair_totals[cells],
+                                                         len(labels), parent_entropy))
+                best = _first_best(np.array([gain for gain, _ in sweeps]))
+                feature, split_bin = int(feat_idxs[i, best]), sweeps[best][1]
+
+                node.feature, node.threshold = feature, self.bin_thresholds[feature][split_bin].item()
+                node.left, node.right = Node(), Node()
+                routes['feature'][node_id], routes['bin'][node_id] = feature, split_bin
+                routes['left'][node_id], routes['right'][node_id] = len(nodes), len(nodes) + 1
+                for child, position in ((node.left, 2 * positions[node_id]), (node.right, 2 * positions[node_id] + 1)):
+                    next_frontier.append(len(nodes))
+                    nodes.append(child)
+                    positions.append(position)
+                    for key, value in (('feature', -1), ('bin', 0), ('left', -1), ('right', -1)):
+                        routes[key].append(value)
+
+            frontier = next_frontier
+            depth += 1
+
+        # a last pass puts the ids of the samples of every leaf together, in stream order
+        route_arrays = {key: np.array(values) for key, values in routes.items()}
+        leaves, ids = [], []
+        for binned, _, ids_chunk, _ in self._stream_chunks(chunks, n_rows):
+            leaves.append(_route_binned(binned, route_arrays))
+            ids.append(ids_chunk)
+        leaves, ids = np.concatenate(leaves), np.concatenate(ids)
+
+        # the children of a node were created after it, so every node's range can be set from its parent's
+        nodes[0].start, nodes[0].end = 0, n_rows
+        for node in nodes:
+            if node.feature is not None:
+                node.left.start, node.left.end = node.start, node.start + node.left.end
+                node.right.start, node.right.end = node.left.end, node.end
+        leaf_starts = np.array([node.start for node in nodes], dtype=np.int64)
+        return nodes[0], ids[np.argsort(leaf_starts[leaves], kind='stable')]
+
+    def _stream_chunks(self, chunks: Iterable[tuple[np.ndarray, ...]],
+                       n_rows: int) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, int]]:
+        """Yield the binned features, labels and sample ids of every chunk, and the position in the stream
+        of its first row. Raise a ValueError if chunks does not yield n_rows samples.
+        """
+        offset = 0
+        for chunk in chunks:
+            y_chunk = np.asarray(chunk[1])
+            if len(y_chunk) == 0:
+                continue
+            ids_chunk = np.arange(offset, offset + len(y_chunk)) if len(chunk) < 3 else np.asarray(chunk[2])
+            yield _apply_bins(np.asarray(chunk[0]), self.bin_thresholds), y_chunk, ids_chunk, offset
+            offset += len(y_chunk)
+        if offset != n_rows:
+            raise ValueError(f"chunks yielded {offset} samples after yielding {n_rows}; fit_stream needs chunks "
+                             f"that yield the same samples every time they are iterated over.")
+
+    def _grow_tree(self, buffers: _TrainingBuffers, depth: int = 0, position: int = 1) -> Node:
+        """Grow the decision tree on all of buffers.samples, one level at a time, and return its root.
+
+        All the nodes of a level are handled together: their labels are counted in one pass, the thresholds
+        of each feature are scored for every node that considers it in one sweep, and every node that splits
+        is partitioned in the same step. The number of NumPy operations grows with the depth of the tree
+        rather than its number of nodes, and there is no recursion, so deep trees such as max_depth=30 are
+        practical.
+
+        The root is at the given depth and position, and the children of the node at position p are at
+        positions 2p and 2p + 1. The features considered at each node are drawn from a generator seeded by
+        its position, so the tree does not depend on which thread scores which feature.
+
+        >>> rng = np.random.default_rng(5)
+        >>> x, y = rng.normal(size=(6000, 5)).round(2), rng.integers(0, 300, size=6000)
+        >>> serial = DecisionTree(max_depth=6, n_features=3, random_state=1)
+        >>> threaded = DecisionTree(max_depth=6, n_features=3, random_state=1, n_jobs=4)
+        >>> serial.fit(x, y)
+        >>> threaded.fit(x, y)
+        >>> all(np.array_equal(getattr(serial.flat_tree, field), getattr(threaded.flat_tree, field))
+        ...     for field in FLAT_TREE_DTYPE.names)
+        True
+        >>> deep = DecisionTree(max_depth=30, random_state=0)
+        >>> deep.fit(x, y)
+        >>> bool(np.mean(deep.predict(x) == y) > 0.95)
+        True
+        """
+        n_feats = buffers.x_data.shape[1]
+        stats = buffers.stats
+        root = Node(start=0, end=len(buffers.samples))
+        level, level_positions = [root], [position]
+
+        while level:
+            timer = time.perf_counter() if stats is not None else 0.0
+            starts = np.array([node.start for node in level], dtype=np.int64)
+            ends = np.array([node.end for node in level], dtype=np.int64)
+            segments, positions = _segment_positions(starts, ends)
+            labels = _LevelLabels(buffers.y_data[buffers.samples[positions]], segments, len(level))
+
+            # check the stopping criteria of every node of the level at once
+            splits = (depth < self.max_depth) & (labels.n_classes > 1) & (ends - starts >= self.min_samples_split)
+            if stats is not None:
+                timer = stats.record(depth, timer, 'entropy_seconds', nodes=len(level), samples=len(positions),
+                                     splits=int(np.count_nonzero(splits)))
+            for i in np.flatnonzero(~splits):
+                # stop growing and keep the most common label at this node
+                level[i].value = None if ends[i] == starts[i] else labels.majority.item(i)
+
+            to_split = np.flatnonzero(splits)
+            if len(to_split) == 0:
+                break
+
+            # only select unique features
+            feat_idxs = np.array([np.random.default_rng([buffers.seed, level_positions[i]])
+                                  .choice(n_feats, self.n_features, replace=False) for i in to_split])
+
+            # find the best split of every node, then split them all
+            if self.splitter == 'exhaustive':
+                best_splits = [self._best_split(buffers, starts[i], ends[i], list(feats))
+                               for i, feats in zip(to_split, feat_idxs)]
+                best_features = np.array([feature for feature, _ in best_splits])
+                best_thresholds = np.array([threshold for _, threshold in best_splits], dtype=float)
+                n_thresholds = 0 if stats is None else sum(_count_thresholds(buffers, starts[i], ends[i], feats)
+                                                           for i, feats in zip(to_split, feat_idxs))
+            else:
+                buffers.local_labels[buffers.samples[positions]] = labels.keys
+                best_features, best_thresholds, n_thresholds = self._best_splits(
+                    buffers, starts[to_split], ends[to_split], feat_idxs, labels, to_split, buffers.pool)
+            if stats is not None:
+                timer = stats.record(depth, timer, 'best_split_seconds', thresholds=n_thresholds)
+
+            mids = self._partition_level(buffers, starts[to_split], ends[to_split], best_features, best_thresholds,
+                                         buffers.pool)
+            if stats is not None:
+                stats.record(depth, timer, 'split_seconds')
+
+            next_level, next_positions = [], []
+            for i, feature, threshold, mid in zip(to_split, best_features.tolist(), best_thresholds.tolist(),
+                                                  mids.tolist()):
+                node = level[i]
+                if self.splitter == 'histogram':  # map the bin index back to a value of the original feature
+                    threshold = self.bin_thresholds[feature][int(threshold)]
+                node.feature, node.threshold = feature, threshold
+                node.left, node.right = Node(start=node.start, end=mid), Node(start=mid, end=node.end)
+                next_level.extend([node.left, node.right])
+                next_positions.extend([2 * level_positions[i], 2 * level_positions[i] + 1])
+
+            level, level_positions = next_level, next_positions
+            depth += 1
+
+        return root
+
+    def _best_splits(self, buffers: _TrainingBuffers, starts: np.ndarray, ends: np.ndarray, feat_idxs: np.ndarray,
+                     labels: _LevelLabels, level_indices: np.ndarray,
+                     pool: Optional[Executor] = None) -> tuple[np.ndarray, np.ndarray, int]:
+        """Return the best feature and threshold of every node buffers.samples[starts[i]:ends[i]] of a level,
+        considering the features feat_idxs[i] of each, with the same rule as _best_split, and the number of
+        thresholds that were scored.
+
+        labels counts the labels of the whole level, buffers.local_labels holds the key of every sample
+        in labels, and level_indices gives the index in the level of every node being split. For the
+        histogram splitter, the thresholds are bin indices.
+
+        With a pool, the nodes are divided into ranges by _node_ranges, which are searched in parallel, or if
+        there is only one range, its features are searched in parallel. Every node's split only depends on
+        its own samples, so the result does not depend on how the nodes are divided.
+        """
+        ranges = _node_ranges(ends - starts, buffers.n_threads) if pool is not None else [slice(0, len(starts))]
+        if len(ranges) > 1:
+            results = _run_parallel(pool, [lambda nodes=nodes: self._best_splits(
+                buffers, starts[nodes], ends[nodes], feat_idxs[nodes], labels, level_indices[nodes])
+                for nodes in ranges])
+            return (np.concatenate([features for features, _, _ in results]),
+                    np.concatenate([thresholds for _, thresholds, _ in results]),
+                    sum(n_thresholds for _, _, n_thresholds in results))
+        n_nodes = len(starts)
+
+        def sweep(feat_idx: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+            """Return the nodes that consider feat_idx, the best gain and threshold of each, and the number of
+            thresholds scored.
+            """
+            nodes = np.flatnonzero(np.any(feat_idxs == feat_idx, axis=1))
+            segments, positions = _segment_positions(starts[nodes], ends[nodes])
+            if self.splitter == 'histogram':
+                rows = buffers.samples[positions]
+                pairs, item_counts = np.unique((segments * 256 + buffers.x_data[rows, feat_idx]) * len(labels.counts)
+                                               + buffers.local_labels[rows], return_counts=True)
+                keys, segment_bins = pairs % len(labels.counts), pairs // len(labels.counts)
+                segments, values = segment_bins // 256, segment_bins % 256
+            else:
+                rows = buffers.sorted_samples[feat_idx, positions]
+                keys, item_counts, values = buffers.local_labels[rows], np.ones(len(rows), dtype=np.int64), \
+                    buffers.x_data[rows, feat_idx]
+            gains, thresholds, n_thresholds = _sweep_segments(segments, values, keys, item_counts, labels,
+                                                              level_indices[nodes])
+            return nodes, gains, thresholds, n_thresholds
+
+        features = np.unique(feat_idxs).tolist()
+        if pool is not None and np.sum(ends - starts) >= PARALLEL_MIN_SAMPLES:
+            sweeps = _run_parallel(pool, [lambda f=feat_idx: sweep(f) for feat_idx in features])
+        else:
+            sweeps = [sweep(feat_idx) for feat_idx in features]
+
+        # the gain and threshold of every node and feature, in the order of each node's feat_idxs
+        gains = np.empty(feat_idxs.shape)
+        thresholds = np.empty(feat_idxs.shape)
+        for feat_idx, (nodes, feature_gains, feature_thresholds, _) in zip(features, sweeps):
+            columns = np.argmax(feat_idxs[nodes] == feat_idx, axis=1)
+            gains[nodes, columns] = feature_gains
+            thresholds[nodes, columns] = feature_thresholds
+
+        best = np.argmax(gains >= np.max(gains, axis=1, keepdims=True) - GAIN_TOLERANCE, axis=1)
+        rows = np.arange(n_nodes)
+        return feat_idxs[rows, best], thresholds[rows, best], sum(n_thresholds for *_, n_thresholds in sweeps)
+
+    def _partition_level(self, buffers: _TrainingBuffers, starts: np.ndarray, ends: np.ndarray,
+                         features: np.ndarray, thresholds: np.ndarray, pool: Optional[Executor] = None) -> np.ndarray:
+        """Partition every node buffers.samples[starts[i]:ends[i]] of a level like _partition, on the
+        feature features[i] and threshold thresholds[i], and return the position where each node's
+        right half begins.
+
+        With a pool, the nodes are divided into ranges by _node_ranges, which are partitioned in parallel.
+        Every node only moves the samples in its own range of the buffers, so no locking is needed.
+        """
+        ranges = _node_ranges(ends - starts, buffers.n_threads) if pool is not None else [slice(0, len(starts))]
+        if len(ranges) > 1:
+            return np.concatenate(_run_parallel(pool, [lambda nodes=nodes: self._partition_level(
+                buffers, starts[nodes], ends[nodes], features[nodes], thresholds[nodes]) for nodes in ranges]))
+
+        segments, positions = _segment_positions(starts, ends)
+        rows = buffers.samples[positions]
+        goes_left = buffers.x_data[rows, features[segments]] <= thresholds[segments]
+        mids = starts + np.bincount(segments, weights=goes_left, minlength=len(starts)).astype(np.int64)
+        segment_starts = np.flatnonzero(np.append(True, segments[1:] != segments[:-1]))
+
+        def targets(in_left: np.ndarray) -> np.ndarray:
+            """Return where every position goes when each node's left samples are moved to its front, keeping
+            the order within each half.
+            """
+            left_rank = _segmented_cumsum(in_left.astype(np.int64), segment_starts) - in_left
+            right_rank = (positions - starts[segments]) - left_rank
+            return np.where(in_left, starts[segments] + left_rank, mids[segments] + right_rank)
+
+        if buffers.sorted_samples is not None:
+            buffers.goes_left[rows] = goes_left
+            for sorted_samples in buffers.sorted_samples:
+                sorted_rows = sorted_samples[positions]
+                sorted_samples[targets(buffers.goes_left[sorted_rows])] = sorted_rows
+
+        buffers.samples[targets(goes_left)] = rows
+        return mids
+
+    def _stops_growing(self, y_node: np.ndarray, depth: int) -> bool:
+        """Return whether a node with the labels y_node at the given depth is a leaf, because it is too deep,
+        too small or pure.
+        """
+        n_labels = len(np.unique(y_node))  # get the number of unique labels in the target variable
+        return depth >= self.max_depth or n_labels == 1 or len(y_node) < self.min_samples_split
+
+    def _grow_best_first(self, buffers: _TrainingBuffers, started: float) -> tuple[Node, int, Optional[str]]:
+        """Grow the decision tree on buffers.samples by always splitting the leaf whose best split has the
+        highest information gain, until no leaf can be split, the tree has max_leaf_nodes leaves, or
+        time_budget seconds have passed since started.
+
+        Return the root, the number of leaves that could still have been split, and the limit that stopped
+        growth ('max_leaf_nodes' or 'time_budget'), or None if no limit was reached. The time budget is checked
+        before every split, so fit can only overrun it by the time to split one node and its children.
+
+        Leaves are split with the same rule as _grow_tree, and ties in gain go to the leaf nearer the top
+        and then further left, so without limits the tree is the same as the one _grow_tree grows.
+
+        >>> rng = np.random.default_rng(15)
+        >>> x, y = rng.normal(size=(1000, 4)).round(1), rng.integers(0, 20, size=1000)
+        >>> depth_first = DecisionTree(max_depth=6, random_state=0)
+        >>> best_first = DecisionTree(max_depth=6, random_state=0, max_leaf_nodes=10 ** 6)
+        >>> depth_first.fit(x, y)
+        >>> best_first.fit(x, y)
+        >>> all(np.array_equal(getattr(depth_first.flat_tree, field), getattr(best_first.flat_tree, field))
+        ...     for field in FLAT_TREE_DTYPE.names)
+        True
+        """
+        n_feats = buffers.x_data.shape[1]
+        stats = buffers.stats
+        heap = []  # the leaves that can be split, as (-gain, position, node, depth, feature, threshold)
+
+        def add_leaf(node: Node, depth: int, position: int) -> None:
+            """Label node as a leaf, and queue its best split if it can be split."""
+            timer = time.perf_counter() if stats is not None else 0.0
+            y_node = buffers.y_data[buffers.samples[node.start:node.end]]
+            node.value = self._most_common_label(y_node)
+            stops = self._stops_growing(y_node, depth)
+            if stats is not None:
+                timer = stats.record(depth, timer, 'entropy_seconds', nodes=1, samples=len(y_node))
+            if stops:
+                return
+
+            node_rng = np.random.default_rng([buffers.seed, position])
+            feat_idxs = node_rng.choice(n_feats, self.n_features, replace=False)
+            feature, threshold = self._best_split(buffers, node.start, node.end, feat_idxs)
+            x_column = buffers.x_data[buffers.samples[node.start:node.end], feature]
+            gain = self._information_gain(y_node, x_column, threshold)
+            heapq.heappush(heap, (-gain, position, node, depth, feature, threshold))
+            if stats is not None:
+                stats.record(depth, timer, 'best_split_seconds',
+                             thresholds=_count_thresholds(buffers, node.start, node.end, feat_idxs))
+
+        root = Node(start=0, end=len(buffers.samples))
+        add_leaf(root, 0, 1)
+        n_leaves, stopped_by = 1, None
+
+        while heap:
+            if self.max_leaf_nodes is not None and n_leaves >= self.max_leaf_nodes:
+                stopped_by = 'max_leaf_nodes'
+                break
+            if self.time_budget is not None and time.perf_counter() - started >= self.time_budget:
+                stopped_by = 'time_budget'
+                break
+
+            _, position, node, depth, feature, threshold = heapq.heappop(heap)
+            timer = time.perf_counter() if stats is not None else 0.0
+            mid = self._partition(buffers, node.start, node.end, feature, threshold)
+            if stats is not None:
+                stats.record(depth, timer, 'split_seconds', splits=1)
+            node.left, node.right = Node(start=node.start, end=mid), Node(start=mid, end=node.end)
+            add_leaf(node.left, depth + 1, 2 * position)
+            add_leaf(node.right, depth + 1, 2 * position + 1)
+
+            if self.splitter == 'histogram':  # map the bin index back to a value of the original feature
+                threshold = self.bin_thresholds[feature][threshold]
+            node.feature, node.threshold, node.value = feature, threshold, None
+            n_leaves += 1
+
+        return root, len(heap), stopped_by
+
+    def _best_split(self, buffers: _TrainingBuffers, start: int, end: int,
+                    feat_idxs: list[int]) -> tuple[Optional[int], Optional[float]]:
+        """Find the best threshold among all possible thresholds for the samples buffers.samples[start:end].
+
+        Every feature is sorted once per fit and all of its thresholds are scored in one sweep, which picks
+        the same split as _best_split_exhaustive in O(n) instead of O(n^2) time per feature. Gains that
+        agree to within GAIN_TOLERANCE are ties, which go to the first feature in feat_idxs and then to
+        the lowest threshold.
+
+        >>> rng = np.random.default_rng(111)
+        >>> x = rng.normal(size=(300, 4)).round(1)
+        >>> y = rng.integers(0, 6, size=300)
+        >>> tree = DecisionTree()
+        >>> buffers = _TrainingBuffers(x, y, 'sorted')
+        >>> tree._best_split(buffers, 0, 300, [2, 0, 3, 1]) == tree._best_split_exhaustive(x, y, [2, 0, 3, 1])
+        True
+        >>> songs = rng.permutation(300)  # one class per song, where mathematically tied gains are common
+        >>> buffers = _TrainingBuffers(x, songs, 'sorted')
+        >>> tree._best_split(buffers, 0, 300, [1, 3]) == tree._best_split_exhaustive(x, songs, [1, 3])
+        True
+        """
+        samples = buffers.samples[start:end]
+        y_node = buffers.y_data[samples]
+
+        if self.splitter == 'exhaustive':
+            return self._best_split_exhaustive(buffers.x_data[samples], y_node, feat_idxs)
+
+        # relabel the classes present at this node 0, 1, 2, ..., so that the sweeps count classes in arrays the
+        # size of the node rather than of the whole label space
+        _, local_labels, counts = np.unique(y_node, return_inverse=True, return_counts=True)
+        buffers.local_labels[samples] = local_labels.reshape(-1)
+        parent_entropy = _label_entropy(counts)
+
+        def sweep(feat_idx: int) -> tuple[float, float]:
+            """Return the best gain and threshold of the feature feat_idx."""
+            if self.splitter == 'histogram':
+                return self._sweep_bins(buffers.x_data[samples, feat_idx], buffers.local_labels[samples],
+                                        parent_entropy)
+            sorted_samples = buffers.sorted_samples[feat_idx, start:end]
+            return self._sweep_thresholds(buffers.x_data[sorted_samples, feat_idx],
+                                          buffers.local_labels[sorted_samples], parent_entropy)
+
+        if buffers.pool is not None and end - start >= PARALLEL_MIN_SAMPLES:
+            sweeps = _run_parallel(buffers.pool, [lambda f=feat_idx: sweep(f) for feat_idx in feat_idxs])
+        else:
+            sweeps = [sweep(feat_idx) for feat_idx in feat_idxs]
 
-        # find the best split
-        best_feature, best_threshold = self._best_split(x_data, y_data, feat_idxs)
+        best = _first_best(np.array([gain for gain, _ in sweeps]))
+        return feat_idxs[best], sweeps[best][1]
 
-        # create child nodes
-        left_idxs, right_idxs = self._split(x_data[:, best_feature], best_threshold)
-        left = self._grow_tree(x_data[left_idxs, :], y_data[left_idxs], depth + 1)
-        right = self._grow_tree(x_data[right_idxs, :], y_data[right_idxs], depth + 1)
+    def _sweep_thresholds(self, x_sorted: np.ndarray, y_sorted: np.ndarray,
+                          parent_entropy: float) -> tuple[float, float]:
+        """Return the highest information gain over all thresholds of a feature, and the lowest
+        threshold that achieves it.
 
-        return Node(feature=best_feature, threshold=best_threshold, left=left, right=right)
+        The samples are sorted by the feature, so moving a threshold from one unique value to the next
+        only moves samples from the right child to the left child. The class counts on each side, and so
+        both child entropies, are then running sums over the sorted samples.
 
-    def _best_split(self, x_data: np.ndarray, y_data: np.ndarray,
-                    feat_idxs: list[int]) -> tuple[Optional[int], Optional[float]]:
-        """Find the best threshold among all possible thresholds."""
-        best_gain = -1
-        split_idx, split_threshold = None, None
+        The labels must be relabelled to the classes present, as _best_split does, since the class counts
+        are held in an array as long as the largest label.
+
+        Preconditions:
+            - x_sorted.size == y_sorted.size
+            - y_sorted.size > 0
+            - np.max(y_sorted) < y_sorted.size
+            - np.all(x_sorted[:-1] <= x_sorted[1:])
+        """
+        # the threshold x_sorted[i] is only evaluated at the last sample of each run of equal values
+        boundaries = np.flatnonzero(np.append(x_sorted[1:] != x_sorted[:-1], True))
+
+        # seen[i] is the number of samples before position i that share the label of sample i
+        totals = np.bincount(y_sorted)
+        seen = _occurrences_before(y_sorted)
+        remaining = totals[y_sorted] - seen
+
+        # sum of c * log2(c) over the class counts c of each child, updated one sample at a time
+        left_sum = np.cumsum(_xlog2x(seen + 1) - _xlog2x(seen))
+        right_sum = np.sum(_xlog2x(totals)) - np.cumsum(_xlog2x(remaining) - _xlog2x(remaining - 1))
+        left_classes = np.cumsum(seen == 0)
+        right_classes = np.count_nonzero(totals) - np.cumsum(remaining == 1)
+
+        gains = _split_gains(parent_entropy, boundaries + 1, left_sum[boundaries], right_sum[boundaries],
+                             left_classes[boundaries], right_classes[boundaries])
+
+        best = _first_best(gains)
+        return gains[best], x_sorted[boundaries[best]]
+
+    def _sweep_bins(self, x_binned: np.ndarray, y_data: np.ndarray, parent_entropy: float) -> tuple[float, int]:
+        """Return the highest information gain over the bin boundaries of a binned feature, and the lowest
+        bin index that achieves it.
+
+        The samples are summarized as a histogram of (bin, class) counts, and moving a threshold past a bin
+        moves that bin's class counts from the right child to the left child. Only the (bin, class) pairs that
+        occur are stored, and as in _sweep_thresholds, the labels must be relabelled to the classes present.
+
+        Preconditions:
+            - x_binned.size == y_data.size
+            - y_data.size > 0
+            - np.max(y_data) < y_data.size
+        """
+        n_labels = int(np.max(y_data)) + 1
+        pairs, pair_counts = np.unique(x_binned.astype(np.int64) * n_labels + y_data, return_counts=True)
+        return self._sweep_bin_counts(pairs // n_labels, pairs % n_labels, pair_counts, n_labels, parent_entropy)
+
+    def _sweep_bin_counts(self, pair_bins: np.ndarray, pair_labels: np.ndarray, pair_counts: np.ndarray,
+                          n_labels: int, parent_entropy: float) -> tuple[float, int]:
+        """Return the highest information gain over the bin boundaries of a binned feature, and the lowest
+        bin index that achieves it, from the number of samples pair_counts[i] in every (bin, class) pair
+        (pair_bins[i], pair_labels[i]) that occurs, as _sweep_bins does.
+
+        Preconditions:
+            - the pairs are sorted by bin and have no repeats
+            - 0 <= np.min(pair_labels) and np.max(pair_labels) < n_labels
+        """
+        # the pairs are ordered by bin, so each bin's pairs are a contiguous run starting at bin_starts
+        bins, bin_starts = np.unique(pair_bins, return_index=True)
+
+        # seen[i] is the number of samples in earlier bins that share the label of pair i
+        totals = np.bincount(pair_labels, weights=pair_counts, minlength=n_labels).astype(np.int64)
+        seen = _occurrences_before(pair_labels, pair_counts)
+        remaining = totals[pair_labels] - seen
+
+        # sum of c * log2(c) over the class counts c of each child, updated one bin at a time
+        left_sum = np.cumsum(np.add.reduceat(_xlog2x(seen + pair_counts) - _xlog2x(seen), bin_starts))
+        right_sum = np.sum(_xlog2x(totals)) - np.cumsum(
+            np.add.reduceat(_xlog2x(remaining) - _xlog2x(remaining - pair_counts), bin_starts))
+        left_classes = np.cumsum(np.add.reduceat((seen == 0).astype(np.int64), bin_starts))
+        right_classes = np.count_nonzero(totals) - np.cumsum(
+            np.add.reduceat((remaining == pair_counts).astype(np.int64), bin_starts))
+        n_left = np.cumsum(np.add.reduceat(pair_counts, bin_starts))
+
+        gains = _split_gains(parent_entropy, n_left, left_sum, right_sum, left_classes, right_classes)
+
+        best = _first_best(gains)
+        return gains[best], int(bins[best])
+
+    def _best_split_exhaustive(self, x_data: np.ndarray, y_data: np.ndarray,
+                               feat_idxs: list[int]) -> tuple[Optional[int], Optional[float]]:
+        """Find the best threshold by computing the information gain of every threshold from scratch."""
+        feature_gains, feature_thresholds = [], []
 
         for feat_idx in feat_idxs:
             x_column = x_data[:, feat_idx]
             thresholds = np.unique(x_column)
 
-            for threshold in thresholds:
-                # calculate the information gain
-                gain = self._information_gain(y_data, x_column, threshold)
-
-                if gain > best_gain:
-                    best_gain = gain
-                    split_idx = feat_idx
-                    split_threshold = threshold
+            # calculate the information gain of every threshold
+            gains = np.array([self._information_gain(y_data, x_column, threshold) for threshold in thresholds])
+            best = _first_best(gains)
+            feature_gains.append(gains[best])
+            feature_thresholds.append(thresholds[best])
 
-        return split_idx, split_threshold
+        best = _first_best(np.array(feature_gains))
+        return feat_idxs[best], feature_thresholds[best]
 
     def _information_gain(self, y_data: np.ndarray, x_column: np.ndarray, threshold: float) -> float:
         """Compute the information gain from splitting a dataset at a given threshold.
@@ -161,140 +1395,1429 @@ class DecisionTree:
         Preconditions:
             - X.column.size > 0
         """
-        left_idxs = np.argwhere(x_column <= split_threshold).flatten()
-        right_idxs = np.argwhere(x_column > split_threshold).flatten()
-        return left_idxs, right_idxs
+        goes_left = x_column <= split_threshold
+        return np.flatnonzero(goes_left), np.flatnonzero(~goes_left)
+
+    def _partition(self, buffers: _TrainingBuffers, start: int, end: int, feature: int, threshold: float) -> int:
+        """Reorder buffers.samples[start:end] so that the samples whose feature is at most threshold come
+        first, and return the position where the remaining samples begin.
+
+        The per-feature sorted orders are partitioned the same way, and stay sorted within each half.
+        """
+        samples = buffers.samples[start:end]
+        goes_left = buffers.x_data[samples, feature] <= threshold
+        mid = start + int(np.count_nonzero(goes_left))
+
+        if buffers.sorted_samples is not None:
+            buffers.goes_left[samples] = goes_left
+            for sorted_samples in buffers.sorted_samples[:, start:end]:
+                in_left = buffers.goes_left[sorted_samples]
+                sorted_samples[:] = np.concatenate((sorted_samples[in_left], sorted_samples[~in_left]))
+
+        samples[:] = np.concatenate((samples[goes_left], samples[~goes_left]))
+        return mid
 
     def _entropy(self, y_data: np.ndarray) -> float:
         """Calculate the entropy of a given set of labels.
 
         The entropy is a measure of the impurity or uncertainty in the labels.
         It ranges from 0 (no uncertainty) to log2(n) (maximum uncertainty).
+
+        Only the labels present are counted, so this costs as much as the number of labels, however large
+        the label ids are.
+
+        >>> round(DecisionTree()._entropy(np.array([0, 0, 10 ** 12, 10 ** 12])), 6)
+        1.0
         """
-        hist = np.bincount(y_data)
-        prob = hist / len(y_data)
-        return -np.sum(prob * np.log2(prob + 1e-9))
+        _, counts = np.unique(y_data, return_counts=True)
+        return _label_entropy(counts)
 
     def _most_common_label(self, y_data: np.ndarray) -> Optional[int]:
-        """Find the most common label in the dataset."""
+        """Find the most common label in the dataset. Ties go to the label that occurs first.
+
+        >>> DecisionTree()._most_common_label(np.array([7, 10 ** 12, 10 ** 12, 7, 3]))
+        7
+        """
         if len(y_data) == 0:
             return None
-        counter = Counter(y_data)
-        return counter.most_common(1)[0][0]
+        labels, first_positions, counts = np.unique(y_data, return_index=True, return_counts=True)
+        most_common = np.flatnonzero(counts == np.max(counts))
+        return labels[most_common[np.argmin(first_positions[most_common])]].item()
 
     def predict(self, x_data: np.ndarray) -> np.ndarray:
         """Predict class labels for a given dataset using the trained decision tree.
 
         Preconditions:
-            - self.root is not None
+            - self.flat_tree is not None
+
+        >>> rng = np.random.default_rng(3)
+        >>> x, y = rng.normal(size=(500, 4)), rng.integers(0, 50, size=500)
+        >>> tree = DecisionTree(max_depth=6)
+        >>> tree.fit(x, y)
+        >>> queries = rng.normal(size=(200, 4))
+        >>> tree.predict(queries).tolist() == [tree._traverse_tree(q, tree.root) for q in queries]
+        True
+        """
+        return self.flat_tree.predict(x_data)
+
+    def leaf_members(self, x: np.ndarray) -> np.ndarray:
+        """Return the ids of the training samples in the leaf that the single sample x reaches.
+
+        This costs the depth of the tree plus the size of the leaf, however many samples the tree was
+        trained on.
+
+        Preconditions:
+            - self.flat_tree is not None
+
+        >>> x = np.array([[0.1], [0.2], [0.8], [0.9]])
+        >>> tree = DecisionTree(max_depth=1)
+        >>> tree.fit(x, np.array([0, 0, 1, 1]), sample_ids=np.array([10, 11, 12, 13]))
+        >>> sorted(tree.leaf_members(np.array([0.85])).tolist())
+        [12, 13]
         """
-        return np.array([self._traverse_tree(x, self.root) for x in x_data])
+        return self.flat_tree.members(self.flat_tree.apply(x.reshape(1, -1))[0])
 
     def _traverse_tree(self, x: np.ndarray, node: Node) -> int:
-        """Recursively traverse the decision tree to classify a single sample.
+        """Traverse the decision tree from node to classify a single sample.
 
-        If the current node is a leaf, return its stored class label. Otherwise, continue
-        traversing based on the feature's threshold.
+        Until the current node is a leaf, whose stored class label is returned, move to the child
+        chosen by the feature's threshold.
 
         Preconditions:
             - node is not None
             - x.size > 0 (the input sample must have at least one feature)
         """
-        if node.is_leaf_node():  # base case
-            return node.value
-        else:
+        while not (node.is_leaf_node() or node.feature is None):
             if x[node.feature] <= node.threshold:
-                return self._traverse_tree(x, node.left)
+                node = node.left
+            else:
+                node = node.right
+        return node.value
+
+
+class RandomForest:
+    """An ensemble of decision trees, each trained on a bootstrap sample of the training data, that
+    predicts the label most of its trees vote for.
+
+    The trees are trained in a pool of processes. The training data is copied once into shared memory,
+    which every process reads instead of receiving its own pickled copy.
+
+    Instance Attributes:
+        - n_trees: The number of trees in the forest.
+        - min_samples_split: The min_samples_split of every tree.
+        - max_depth: The max_depth of every tree.
+        - n_features: The number of features every tree considers at each split. If None, the square root
+        of the number of features, rounded up.
+        - splitter: The splitter of every tree.
+        - n_jobs: The number of processes used to train the trees, or -1 to use every CPU.
+        - random_state: The seed for the bootstrap samples and the trees. If None, a seed is drawn from
+        NumPy's global random state at the start of every fit.
+        - trees: The trained trees.
+
+    Representation Invariants:
+        - self.n_trees >= 1
+        - self.splitter in SPLITTERS
+        - self.n_jobs == -1 or self.n_jobs >= 1
+    """
+    n_trees: int
+    min_samples_split: int
+    max_depth: int
+    n_features: Optional[int]
+    splitter: str
+    n_jobs: int
+    random_state: Optional[int]
+    trees: list[FlatTree]
+
+    def __init__(self, n_trees: int = 10, min_samples_split: int = 2, max_depth: int = 5,
+                 n_features: Optional[int] = None, splitter: str = 'sorted', n_jobs: int = 1,
+                 random_state: Optional[int] = None) -> None:
+        """Initialize a RandomForest class."""
+        if n_trees < 1:
+            raise ValueError(f"n_trees must be at least 1, got {n_trees}.")
+        if splitter not in SPLITTERS:
+            raise ValueError(f"Unknown splitter '{splitter}', expected one of {SPLITTERS}.")
+        if n_jobs != -1 and n_jobs < 1:
+            raise ValueError(f"n_jobs must be -1 or at least 1, got {n_jobs}.")
+        self.n_trees = n_trees
+        self.min_samples_split = min_samples_split
+        self.max_depth = max_depth
+        self.n_features = n_features
+        self.splitter = splitter
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.trees = []
+
+    def fit(self, x_data: np.ndarray, y_data: np.ndarray, sample_ids: Optional[np.ndarray] = None) -> None:
+        """Train every tree of the forest on its own bootstrap sample of x_data and y_data.
+
+        sample_ids gives the id of every row of x_data, as in DecisionTree.fit.
+
+        >>> rng = np.random.default_rng(2)
+        >>> x, y = rng.normal(size=(800, 4)), rng.integers(0, 20, size=800)
+        >>> serial = RandomForest(n_trees=4, max_depth=5, random_state=0)
+        >>> pooled = RandomForest(n_trees=4, max_depth=5, random_state=0, n_jobs=2)
+        >>> serial.fit(x, y)
+        >>> pooled.fit(x, y)
+        >>> bool(np.all(serial.predict(x) == pooled.predict(x)))
+        True
+        """
+        n_features = self.n_features or int(np.ceil(np.sqrt(x_data.shape[1])))
+        params = {'min_samples_split': self.min_samples_split, 'max_depth': self.max_depth,
+                  'n_features': n_features, 'splitter': self.splitter}
+        seed = self.random_state if self.random_state is not None else np.random.randint(2 ** 31)
+        tree_seeds = [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(self.n_trees)]
+        n_jobs = min(os.cpu_count() if self.n_jobs == -1 else self.n_jobs, self.n_trees)
+
+        if n_jobs == 1:
+            self.trees = [_fit_bootstrap_tree(x_data, y_data, params, tree_seed) for tree_seed in tree_seeds]
+        else:
+            self._fit_in_processes(x_data, y_data, params, tree_seeds, n_jobs)
+
+        if sample_ids is not None:  # the trees only know the row positions of their samples
+            for tree in self.trees:
+                tree.samples = np.asarray(sample_ids)[tree.samples]
+
+    def _fit_in_processes(self, x_data: np.ndarray, y_data: np.ndarray, params: dict[str, Any],
+                          tree_seeds: list[int], n_jobs: int) -> None:
+        """Train the trees in a pool of n_jobs processes that share x_data and y_data."""
+        shared = [_share_array(np.ascontiguousarray(x_data)), _share_array(np.ascontiguousarray(y_data))]
+        try:
+            with ProcessPoolExecutor(n_jobs, initializer=_attach_shared_arrays,
+                                     initargs=({'x': shared[0][1], 'y': shared[1][1]},)) as pool:
+                self.trees = list(pool.map(_fit_forest_tree, [params] * self.n_trees, tree_seeds))
+        finally:
+            for memory, _ in shared:
+                memory.close()
+                memory.unlink()
+
+    def predict_all(self, x_data: np.ndarray) -> np.ndarray:
+        """Return the label every tree predicts for every row of x_data, as an array with one row per tree.
+
+        Preconditions:
+            - self.trees != []
+        """
+        return np.stack([tree.predict(x_data) for tree in self.trees])
+
+    def predict(self, x_data: np.ndarray) -> np.ndarray:
+        """Predict the label that most trees vote for, for every row of x_data. Ties go to the lower label.
+
+        Preconditions:
+            - self.trees != []
+        """
+        return _majority_vote(self.predict_all(x_data))
+
+    def leaf_members(self, x: np.ndarray) -> np.ndarray:
+        """Return the ids of the training samples in any of the leaves that the single sample x reaches,
+        without repeats.
+
+        Preconditions:
+            - self.trees != []
+        """
+        leaves = [tree.apply(x.reshape(1, -1))[0] for tree in self.trees]
+        return np.unique(np.concatenate([tree.members(leaf) for tree, leaf in zip(self.trees, leaves)]))
+
+
+def _share_array(array: np.ndarray) -> tuple[SharedMemory, tuple[str, tuple[int, ...], str]]:
+    """Copy array into a new block of shared memory, and return the block with the (name, shape, dtype)
+    that other processes need to attach to it.
+    """
+    memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+
+# the arrays that a RandomForest or cross_validate_grid put in shared memory, as seen by one of its worker
+# processes, by name
+_SHARED_DATA = {}
+
+
+def _attach_shared_arrays(specs: dict[str, tuple[str, tuple[int, ...], str]]) -> None:
+    """Attach a worker process to the arrays that its parent put in shared memory with _share_array, given
+    the (name, shape, dtype) of each by the name they are looked up under in _SHARED_DATA.
+    """
+    for key, (name, shape, dtype) in specs.items():
+        memory = SharedMemory(name=name)
+        _SHARED_DATA[key] = (memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+
+def _fit_forest_tree(params: dict[str, Any], seed: int) -> FlatTree:
+    """Train one tree of a RandomForest in a worker process, on the shared training data."""
+    return _fit_bootstrap_tree(_SHARED_DATA['x'][1], _SHARED_DATA['y'][1], params, seed)
+
+
+def _fit_bootstrap_tree(x_data: np.ndarray, y_data: np.ndarray, params: dict[str, Any], seed: int) -> FlatTree:
+    """Train a DecisionTree with the given parameters on a bootstrap sample of x_data and y_data drawn
+    with the given seed, and return the compiled tree. The samples of the tree are row positions in x_data.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(y_data), size=len(y_data))
+    tree = DecisionTree(**params, random_state=int(rng.integers(2 ** 31)))
+    tree.fit(x_data[rows], y_data[rows], sample_ids=rows)
+    return tree.flat_tree
+
+
+def _majority_vote(votes: np.ndarray) -> np.ndarray:
+    """Return the most common value in every column of votes, ignoring votes of -1. Ties go to the lower
+    value, and columns without any other vote get -1.
+
+    >>> _majority_vote(np.array([[4, 1, -1], [2, 1, -1], [2, 3, -1], [4, 3, -1]])).tolist()
+    [2, 1, -1]
+    """
+    ordered = np.sort(votes, axis=0)
+    best = np.full(votes.shape[1], -1, dtype=votes.dtype)
+    best_count = np.zeros(votes.shape[1], dtype=np.int64)
+    run = np.zeros(votes.shape[1], dtype=np.int64)
+
+    # walk down the sorted votes, tracking the length of the current run of equal labels
+    for i in range(len(ordered)):
+        continues_run = (ordered[i] == ordered[i - 1]) if i > 0 else np.zeros(votes.shape[1], dtype=bool)
+        run = np.where(continues_run, run + 1, 1)
+        is_better = (run > best_count) & (ordered[i] >= 0)
+        best = np.where(is_better, ordered[i], best)
+        best_count = np.where(is_better, run, best_count)
+
+    return best
+
+
+def parameter_grid(grid: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    """Return every combination of the values in grid as keyword arguments for DecisionTree, with the last
+    parameter of grid changing fastest.
+
+    >>> configs = parameter_grid({'max_depth': [5, 7], 'min_samples_split': [2, 10]})
+    >>> len(configs), configs[1]
+    (4, {'max_depth': 5, 'min_samples_split': 10})
+    """
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def cross_validate_grid(x_data: np.ndarray, y_data: np.ndarray, grid: dict[str, list[Any]] | list[dict[str, Any]],
+                        n_folds: int = 5, n_jobs: int = 1, random_state: Optional[int] = None) -> list[dict[str, Any]]:
+    """Evaluate every DecisionTree configuration of grid with n_folds-fold cross-validation on x_data and
+    y_data, and return one result per configuration, in the order of grid.
+
+    grid is either a list of keyword arguments for DecisionTree, or a dictionary of the values to try for
+    every hyperparameter, whose combinations are tried as parameter_grid lists them. Every result holds the
+    'params' of its configuration, the accuracy on every held-out fold ('fold_accuracy') with their mean
+    ('accuracy') and standard deviation ('accuracy_std'), the mean seconds taken to fit and to predict one
+    fold ('fit_seconds' and 'predict_seconds'), and the mean number of leaves ('leaves').
+
+    The folds are split once, and the training rows of every fold are sorted by every feature, or binned for
+    every max_bins and binning of the grid, once for all configurations rather than once per fit. With n_jobs
+    greater than 1 (or -1 for every CPU), the configurations and folds are evaluated in a pool of processes,
+    which read the data and the sorted and binned folds from shared memory instead of receiving copies.
+    Configurations without a random_state are fit with one drawn from random_state, which also shuffles the
+    folds, so the results do not depend on n_jobs.
+
+    Preconditions:
+        - x_data.shape[0] == y_data.shape[0]
+        - 2 <= n_folds <= x_data.shape[0]
+
+    >>> rng = np.random.default_rng(4)
+    >>> x = rng.normal(size=(600, 3))
+    >>> y = (x[:, 0] > 0).astype(int) + (x[:, 1] > 0.5).astype(int)
+    >>> results = cross_validate_grid(x, y, {'max_depth': [1, 3], 'splitter': ['sorted', 'histogram']},
+    ...                               n_folds=3, random_state=0)
+    >>> [(r['params']['max_depth'], r['params']['splitter'], r['accuracy'] > 0.9) for r in results]
+    [(1, 'sorted', False), (1, 'histogram', False), (3, 'sorted', True), (3, 'histogram', True)]
+    >>> pooled = cross_validate_grid(x, y, {'max_depth': [1, 3], 'splitter': ['sorted', 'histogram']},
+    ...                              n_folds=3, n_jobs=2, random_state=0)
+    >>> [r['fold_accuracy'] for r in pooled] == [r['fold_accuracy'] for r in results]
+    True
+    """
+    configs = parameter_grid(grid) if isinstance(grid, dict) else [dict(params) for params in grid]
+    rng = np.random.default_rng(random_state)
+    tree_seed = int(rng.integers(2 ** 31))
+    for params in configs:
+        DecisionTree(**params)  # raises ValueError for invalid hyperparameters before any work is done
+        params.setdefault('random_state', tree_seed)
+
+    # split the folds, and sort or bin the training rows of each once for every configuration that needs it
+    arrays = {'x': np.ascontiguousarray(x_data), 'y': np.ascontiguousarray(y_data),
+              'folds': (rng.permutation(len(y_data)) % n_folds).astype(np.int32)}
+    bin_thresholds = {}
+    order = None
+    for params in configs:
+        splitter, max_bins, binning = (params.get('splitter', 'sorted'), params.get('max_bins', 255),
+                                       params.get('binning', 'quantile'))
+        for fold in range(n_folds):
+            key = _fold_key(params, fold)
+            if key in arrays:
+                continue
+            train = arrays['folds'] != fold
+            if splitter == 'sorted':
+                if order is None:
+                    order = np.argsort(arrays['x'], axis=0, kind='stable').T
+                # the training rows keep their relative order, so filtering the sorted rows sorts them too
+                positions = np.cumsum(train) - 1
+                arrays[key] = positions[order[train[order]].reshape(order.shape[0], -1)].astype(np.int32)
+            elif splitter == 'histogram':
+                arrays[key], bin_thresholds[key] = bin_features(arrays['x'][train], max_bins, binning)
+
+    tasks = [(params, fold, bin_thresholds.get(_fold_key(params, fold)))
+             for params in configs for fold in range(n_folds)]
+    n_jobs = min(os.cpu_count() if n_jobs == -1 else n_jobs, len(tasks))
+    if n_jobs == 1:
+        scores = [_evaluate_fold(arrays, *task) for task in tasks]
+    else:
+        shared = {key: _share_array(array) for key, array in arrays.items()}
+        try:
+            with ProcessPoolExecutor(n_jobs, initializer=_attach_shared_arrays,
+                                     initargs=({key: spec for key, (_, spec) in shared.items()},)) as pool:
+                scores = list(pool.map(_evaluate_shared_fold, *zip(*tasks)))
+        finally:
+            for memory, _ in shared.values():
+                memory.close()
+                memory.unlink()
+
+    results = []
+    for i, params in enumerate(configs):
+        accuracies, fit_seconds, predict_seconds, leaves = zip(*scores[i * n_folds:(i + 1) * n_folds])
+        results.append({'params': params, 'accuracy': float(np.mean(accuracies)),
+                        'accuracy_std': float(np.std(accuracies)), 'fold_accuracy': list(accuracies),
+                        'fit_seconds': float(np.mean(fit_seconds)), 'predict_seconds': float(np.mean(predict_seconds)),
+                        'leaves': float(np.mean(leaves))})
+    return results
+
+
+def _fold_key(params: dict[str, Any], fold: int) -> str:
+    """Return the name that cross_validate_grid stores the sorted or binned training rows of fold under,
+    for a DecisionTree with the given parameters.
+    """
+    splitter = params.get('splitter', 'sorted')
+    if splitter == 'histogram':
+        return f"bins-{params.get('max_bins', 255)}-{params.get('binning', 'quantile')}-{fold}"
+    return f'{splitter}-{fold}'
+
+
+def _evaluate_fold(arrays: dict[str, np.ndarray], params: dict[str, Any], fold: int,
+                   bin_thresholds: Optional[list[np.ndarray]]) -> tuple[float, float, float, int]:
+    """Fit a DecisionTree with the given parameters on every row of arrays['x'] outside fold, and return
+    its accuracy on the rows in fold, the seconds taken to fit and to predict, and its number of leaves.
+    """
+    train = arrays['folds'] != fold
+    tree = DecisionTree(**{**params, 'n_jobs': 1})
+    started = time.perf_counter()
+    if tree.splitter == 'histogram':
+        tree.bin_thresholds = bin_thresholds
+        tree.fit_prepared(arrays[_fold_key(params, fold)], arrays['y'][train], started=started)
+    else:
+        tree.fit_prepared(arrays['x'][train], arrays['y'][train], started=started,
+                          presorted=arrays.get(_fold_key(params, fold)))
+    fit_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    predictions = tree.predict(arrays['x'][~train])
+    predict_seconds = time.perf_counter() - started
+    return (float(accuracy_score(arrays['y'][~train], predictions)), fit_seconds, predict_seconds,
+            tree.fit_report['leaves'])
+
+
+def _evaluate_shared_fold(params: dict[str, Any], fold: int,
+                          bin_thresholds: Optional[list[np.ndarray]]) -> tuple[float, float, float, int]:
+    """Run _evaluate_fold in a cross_validate_grid worker process, on the arrays in shared memory."""
+    return _evaluate_fold({key: array for key, (_, array) in _SHARED_DATA.items()}, params, fold, bin_thresholds)
+
+
+class _TrainingBuffers:
+    """The training data and working buffers shared by every node while a DecisionTree is grown.
+
+    Every node owns a contiguous range [start, end) of samples, and splitting a node reorders its range
+    in place, so the whole tree is grown with a constant amount of memory on top of the training data.
+
+    Instance Attributes:
+        - x_data: The training features, or their bin indices for the histogram splitter.
+        - y_data: The training labels.
+        - samples: A permutation of the training row indices, where every node's samples are contiguous.
+        - sorted_samples: For the sorted splitter, one row per feature holding the training row indices
+        such that every node's range of each row is sorted by that feature. None for other splitters.
+        - goes_left: Scratch space indexed by training row, used to partition sorted_samples.
+        - local_labels: Scratch space indexed by training row, holding the labels of the nodes being split
+        relabelled to the classes present at each node, so that they are small integers.
+        - seed: The seed that the random features chosen at every node are derived from.
+        - pool: The threads that ranges of the nodes of a level, or the features of a node, can be handed to,
+        or None to grow the tree serially. Nodes own disjoint ranges of the buffers, so the nodes of a level
+        can be searched and partitioned in parallel without locking.
+        - n_threads: The number of threads of pool, which is how many ranges the nodes of a level are
+        divided into.
+        - stats: The counts and timings to record while growing, or None to record nothing.
+    """
+    x_data: np.ndarray
+    y_data: np.ndarray
+    samples: np.ndarray
+    sorted_samples: Optional[np.ndarray]
+    goes_left: np.ndarray
+    local_labels: np.ndarray
+    seed: int
+    pool: Optional[Executor]
+    n_threads: int
+    stats: Optional[FitStats]
+
+    def __init__(self, x_data: np.ndarray, y_data: np.ndarray, splitter: str, seed: int = 0,
+                 pool: Optional[Executor] = None, presorted: Optional[np.ndarray] = None, n_threads: int = 1) -> None:
+        """Initialize the buffers for growing a tree on x_data and y_data with the given splitter.
+
+        For the sorted splitter, presorted can give the initial sorted_samples, which are copied rather than
+        sorted again.
+        """
+        n_samples = len(y_data)
+        index_dtype = np.int32 if n_samples < 2 ** 31 else np.int64
+
+        self.x_data = x_data
+        self.y_data = y_data
+        self.samples = np.arange(n_samples, dtype=index_dtype)
+        self.sorted_samples = None
+        self.goes_left = np.zeros(n_samples, dtype=bool)
+        self.local_labels = np.zeros(n_samples, dtype=index_dtype)
+        self.seed = seed
+        self.pool = pool
+        self.n_threads = n_threads
+        self.stats = None
+
+        if splitter == 'sorted' and presorted is not None:
+            self.sorted_samples = presorted.astype(index_dtype)
+        elif splitter == 'sorted':
+            self.sorted_samples = np.argsort(x_data, axis=0, kind='stable').T.astype(index_dtype)
+
+
+class _GrowableRows:
+    """The rows of an array that new rows are appended to, in time proportional to the new rows on average.
+
+    The rows are the first size rows of a larger array, whose capacity at least doubles whenever it runs out,
+    so every row is copied a constant number of times on average. The array given to __init__ is never
+    written to: the first append that needs room copies it.
+
+    Instance Attributes:
+        - size: The number of rows.
+
+    >>> rows = _GrowableRows(np.array([1, 2]))
+    >>> rows.append(np.array([3]))
+    >>> rows.append(np.array([4, 5, 6]))
+    >>> rows.view().tolist(), rows.size
+    ([1, 2, 3, 4, 5, 6], 6)
+    """
+    size: int
+    # Private Instance Attributes:
+    #     - _data: the array whose first size rows are the rows
+    _data: np.ndarray
+
+    def __init__(self, data: np.ndarray) -> None:
+        """Initialize a _GrowableRows holding the rows of data."""
+        self._data = data
+        self.size = len(data)
+
+    def append(self, rows: np.ndarray) -> None:
+        """Append rows, converted to the dtype of the existing rows.
+
+        Preconditions:
+            - rows.shape[1:] == self.view().shape[1:]
+        """
+        if self.size + len(rows) > len(self._data):
+            grown = np.empty((max(2 * len(self._data), self.size + len(rows)),) + self._data.shape[1:],
+                             dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def view(self) -> np.ndarray:
+        """Return the rows, as a view that later appends may stop sharing memory with."""
+        return self._data[:self.size]
+
+
+def _parent_ids(flat: FlatTree) -> np.ndarray:
+    """Return the id of the parent of every node of flat, or -1 for the root.
+
+    >>> flat = FlatTree.from_node(Node(feature=0, threshold=0.5, left=Node(value=3), right=Node(value=4)))
+    >>> _parent_ids(flat).tolist()
+    [-1, 0, 0]
+    """
+    parents = np.full(len(flat.feature), -1, dtype=np.int64)
+    internal = np.flatnonzero(flat.feature >= 0)
+    parents[flat.left[internal]] = internal
+    parents[flat.right[internal]] = internal
+    return parents
+
+
+class _SparseCounts:
+    """Counts of integer keys accumulated chunk by chunk, optionally together with the smallest position that
+    each key was seen at, keeping only the keys that occur.
+
+    Chunks are held back and merged when they add up to about as many keys as have been merged so far, so
+    that every key is merged a logarithmic number of times.
+
+    Instance Attributes:
+        - keys: The keys merged so far, sorted and without repeats.
+        - counts: The count of every key of keys.
+        - first: The smallest position given for every key of keys, or None if positions are not tracked.
+
+    >>> counts = _SparseCounts()
+    >>> counts.add(np.array([3, 7]), np.array([1, 2]), np.array([5, 0]))
+    >>> counts.add(np.array([1, 3]), np.array([4, 4]), np.array([9, 2]))
+    >>> [array.tolist() for array in counts.result()]
+    [[1, 3, 7], [4, 5, 2], [9, 2, 0]]
+    """
+    keys: np.ndarray
+    counts: np.ndarray
+    first: Optional[np.ndarray]
+    # Private Instance Attributes:
+    #     - _pending: the (keys, counts, first) of the chunks added since the last merge
+    _pending: list[tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]]
+
+    def __init__(self, track_first: bool = True) -> None:
+        """Initialize an empty _SparseCounts, which keeps the first position of every key if track_first."""
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.first = np.zeros(0, dtype=np.int64) if track_first else None
+        self._pending = []
+
+    def add(self, keys: np.ndarray, counts: np.ndarray, first: Optional[np.ndarray] = None) -> None:
+        """Add counts[i] occurrences of keys[i], first seen at position first[i].
+
+        Preconditions:
+            - (first is None) == (self.first is None)
+        """
+        self._pending.append((keys, counts, first))
+        if sum(len(pending_keys) for pending_keys, _, _ in self._pending) >= max(len(self.keys), 2 ** 16):
+            self._merge()
+
+    def result(self) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        """Return the keys, counts and first positions of everything added."""
+        self._merge()
+        return self.keys, self.counts, self.first
+
+    def _merge(self) -> None:
+        """Merge the pending chunks into keys, counts and first."""
+        if not self._pending:
+            return
+        all_keys = np.concatenate([self.keys] + [keys for keys, _, _ in self._pending])
+        all_counts = np.concatenate([self.counts] + [counts for _, counts, _ in self._pending])
+        self.keys, inverse = np.unique(all_keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.counts = np.bincount(inverse, all_counts, minlength=len(self.keys)).astype(np.int64)
+        if self.first is not None:
+            all_first = np.concatenate([self.first] + [first for _, _, first in self._pending])
+            self.first = np.full(len(self.keys), np.iinfo(np.int64).max)
+            np.minimum.at(self.first, inverse, all_first)
+        self._pending = []
+
+
+def _route_binned(binned: np.ndarray, routes: dict[str, np.ndarray]) -> np.ndarray:
+    """Return the id of the node that every row of binned reaches in a tree being grown by fit_stream, where
+    the node with id i sends rows whose bin of feature routes['feature'][i] is at most routes['bin'][i] to
+    routes['left'][i], and the rest to routes['right'][i], unless routes['feature'][i] is -1.
+    """
+    node = np.zeros(len(binned), dtype=np.int64)
+    rows = np.flatnonzero(routes['feature'][node] >= 0)
+    while len(rows) > 0:
+        current = node[rows]
+        goes_left = binned[rows, routes['feature'][current]] <= routes['bin'][current]
+        node[rows] = np.where(goes_left, routes['left'][current], routes['right'][current])
+        rows = rows[routes['feature'][node[rows]] >= 0]
+    return node
+
+
+def _run_parallel(pool: Executor, tasks: list[Callable[[], Any]]) -> list[Any]:
+    """Run tasks on pool and the calling thread, and return their results in order.
+
+    The first task runs on the calling thread while the others are queued. A queued task that no worker
+    has started by the time its result is needed is run on the calling thread instead, so the calling
+    thread keeps working rather than waiting for a busy pool.
+    """
+    futures = [pool.submit(task) for task in tasks[1:]]
+    results = [tasks[0]()]
+    for task, future in zip(tasks[1:], futures):
+        results.append(task() if future.cancel() else future.result())
+    return results
+
+
+def _node_ranges(sizes: np.ndarray, n_ranges: int) -> list[slice]:
+    """Divide consecutive nodes with the given numbers of samples into at most n_ranges contiguous ranges
+    with about as many samples each, and at least PARALLEL_MIN_SAMPLES samples per range on average.
+
+    >>> _node_ranges(np.array([5000, 100, 100, 4000, 3000]), 3)
+    [slice(0, 1, None), slice(1, 4, None), slice(4, 5, None)]
+    >>> _node_ranges(np.array([30000, 70000]), 8)
+    [slice(0, 1, None), slice(1, 2, None)]
+    >>> _node_ranges(np.array([1000, 1000]), 4)
+    [slice(0, 2, None)]
+    """
+    n_ranges = min(n_ranges, len(sizes), int(np.sum(sizes)) // PARALLEL_MIN_SAMPLES)
+    if n_ranges <= 1:
+        return [slice(0, len(sizes))]
+
+    # every node goes in the range whose share of the samples holds the middle of its own samples
+    totals = np.cumsum(sizes)
+    ends = np.searchsorted(totals - sizes / 2, totals[-1] * np.arange(1, n_ranges) / n_ranges)
+    bounds = np.unique(np.concatenate(([0], ends, [len(sizes)])))
+    return [slice(start, end) for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+
+def bin_features(x_data: np.ndarray, max_bins: int = 255,
+                 binning: str = 'quantile') -> tuple[np.ndarray, list[np.ndarray]]:
+    """Quantize every column of x_data into at most max_bins bins.
+
+    Return a uint8 matrix of the same shape holding the bin index of every value, and for every column
+    the upper cut point of each of its bins. These are the cut points between consecutive bins, which are
+    interpolated and need not be values of the column, followed by the column's maximum. A value v of
+    column j is in bin b exactly when v <= thresholds[j][b] and (b == 0 or v > thresholds[j][b - 1]).
+    Columns with at most max_bins unique values get one bin per value, so no split is lost.
+
+    Preconditions:
+        - binning in BINNINGS
+        - 2 <= max_bins <= 256
+        - x_data.shape[0] > 0
+
+    >>> x = np.array([[0.1, 5.0], [0.4, 5.0], [0.2, 7.0], [0.4, 9.0]])
+    >>> binned, thresholds = bin_features(x, max_bins=2, binning='uniform')
+    >>> binned.tolist()
+    [[0, 0], [1, 0], [0, 0], [1, 1]]
+    >>> [t.tolist() for t in thresholds]
+    [[0.25, 0.4], [7.0, 9.0]]
+    """
+    binned = np.empty(x_data.shape, dtype=np.uint8)
+    thresholds = []
+
+    for j in range(x_data.shape[1]):
+        column = x_data[:, j]
+        unique_values = np.unique(column)
+
+        if len(unique_values) <= max_bins:
+            cuts = unique_values[:-1]
+        elif binning == 'quantile':
+            cuts = np.unique(np.quantile(column, np.linspace(0, 1, max_bins + 1)[1:-1]))
+        else:
+            cuts = np.linspace(unique_values[0], unique_values[-1], max_bins + 1)[1:-1]
+        cuts = cuts[cuts < unique_values[-1]]
+
+        binned[:, j] = np.searchsorted(cuts, column, side='left')
+        thresholds.append(np.append(cuts, unique_values[-1]))
+
+    return binned, thresholds
+
+
+def _apply_bins(x_data: np.ndarray, thresholds: list[np.ndarray]) -> np.ndarray:
+    """Return the bin index of every value of x_data, under the bin thresholds returned by bin_features.
+    Values above the largest threshold of their column go in its last bin.
+
+    >>> binned, thresholds = bin_features(np.array([[0.1, 5.0], [0.4, 5.0], [0.2, 7.0], [0.4, 9.0]]), 2, 'uniform')
+    >>> _apply_bins(np.array([[0.3, 6.0], [0.5, 10.0]]), thresholds).tolist()
+    [[1, 0], [1, 1]]
+    """
+    binned = np.empty(x_data.shape, dtype=np.uint8)
+    for j, column_thresholds in enumerate(thresholds):
+        binned[:, j] = np.searchsorted(column_thresholds[:-1], x_data[:, j], side='left')
+    return binned
+
+
+class QuantileSketch:
+    """A fixed-size summary of every column of a stream of matrices, from which bin thresholds like those
+    of bin_features can be placed without keeping the whole stream.
+
+    Every column is summarized by sorted values with the number of samples each stands for. While a column
+    has at most capacity unique values, its summary is exact. Past that, neighbouring values are merged
+    into groups of about equal weight, each kept as its weighted median, so every quantile is off by about
+    1 / capacity of the samples, times the number of merges. The minimum and maximum stay exact.
+
+    Instance Attributes:
+        - n_columns: The number of columns summarized.
+        - capacity: The number of values that each column's summary is merged down to.
+        - exact: Whether every column's summary still holds every value that was added.
+
+    Representation Invariants:
+        - self.capacity >= 3
+
+    >>> sketch = QuantileSketch(1, capacity=64)
+    >>> column = np.random.default_rng(0).permutation(100_000).reshape(-1, 1).astype(float)
+    >>> for chunk in np.array_split(column, 10):
+    ...     sketch.update(chunk)
+    >>> quartiles = sketch.quantiles(0, np.array([0.25, 0.5, 0.75]))
+    >>> sketch.exact, bool(np.all(np.abs(quartiles - [25_000, 50_000, 75_000]) < 2_000))
+    (False, True)
+    >>> small = QuantileSketch(2)
+    >>> small.update(np.array([[0.1, 5.0], [0.4, 5.0], [0.2, 7.0], [0.4, 9.0]]))
+    >>> [t.tolist() for t in small.bin_thresholds(2, 'uniform')]
+    [[0.25, 0.4], [7.0, 9.0]]
+    """
+    n_columns: int
+    capacity: int
+    exact: bool
+    # Private Instance Attributes:
+    #     - _values: the sorted values summarizing each column
+    #     - _weights: the number of samples that each value of _values stands for
+    _values: list[np.ndarray]
+    _weights: list[np.ndarray]
+
+    def __init__(self, n_columns: int, capacity: int = 4096) -> None:
+        """Initialize an empty sketch of n_columns columns."""
+        if capacity < 3:
+            raise ValueError(f"capacity must be at least 3, got {capacity}.")
+        self.n_columns = n_columns
+        self.capacity = capacity
+        self.exact = True
+        self._values = [np.zeros(0) for _ in range(n_columns)]
+        self._weights = [np.zeros(0, dtype=np.int64) for _ in range(n_columns)]
+
+    def update(self, x_data: np.ndarray) -> None:
+        """Add every row of x_data to the summaries.
+
+        Preconditions:
+            - x_data.shape[1] == self.n_columns
+        """
+        for j in range(self.n_columns):
+            chunk_values, chunk_weights = np.unique(x_data[:, j], return_counts=True)
+            values, inverse = np.unique(np.concatenate([self._values[j], chunk_values]), return_inverse=True)
+            weights = np.bincount(inverse.reshape(-1), np.concatenate([self._weights[j], chunk_weights]),
+                                  minlength=len(values)).astype(np.int64)
+
+            if len(values) > self.capacity:
+                # merge runs of values of about equal weight into their weighted median, keeping the minimum and
+                # maximum on their own so that they stay exact
+                inner_weights = weights[1:-1]
+                ranks = np.cumsum(inner_weights) - inner_weights
+                groups = np.concatenate([[0], 1 + ranks * (self.capacity - 2) // np.sum(inner_weights),
+                                         [self.capacity - 1]])
+                starts = np.flatnonzero(np.append(True, groups[1:] != groups[:-1]))
+                cumulative = np.cumsum(weights)
+                group_weights = np.add.reduceat(weights, starts)
+                medians = np.searchsorted(cumulative, cumulative[starts] - weights[starts] + (group_weights + 1) // 2)
+                values, weights = values[medians], group_weights
+                self.exact = False
+            self._values[j], self._weights[j] = values, weights
+
+    def quantiles(self, column: int, qs: np.ndarray) -> np.ndarray:
+        """Return the quantiles qs of column, interpolated linearly between the closest values as np.quantile
+        does by default.
+
+        Preconditions:
+            - 0 <= column < self.n_columns
+            - the column has at least one value
+            - np.all((0 <= qs) & (qs <= 1))
+        """
+        values, cumulative = self._values[column], np.cumsum(self._weights[column])
+        positions = qs * (cumulative[-1] - 1)
+        below = np.floor(positions)
+        lower = values[np.searchsorted(cumulative, below, side='right')]
+        upper = values[np.minimum(np.searchsorted(cumulative, below + 1, side='right'), len(values) - 1)]
+        return lower + (positions - below) * (upper - lower)
+
+    def bin_thresholds(self, max_bins: int = 255, binning: str = 'quantile') -> list[np.ndarray]:
+        """Return for every column the upper cut point of each of its bins, placed as bin_features places
+        them on the values added to this sketch.
+
+        Preconditions:
+            - binning in BINNINGS
+            - 2 <= max_bins <= 256
+            - at least one row was added
+        """
+        thresholds = []
+        for j in range(self.n_columns):
+            unique_values = self._values[j]
+            if self.exact and len(unique_values) <= max_bins:
+                cuts = unique_values[:-1]
+            elif binning == 'quantile':
+                cuts = np.unique(self.quantiles(j, np.linspace(0, 1, max_bins + 1)[1:-1]))
             else:
-                return self._traverse_tree(x, node.right)
+                cuts = np.linspace(unique_values[0], unique_values[-1], max_bins + 1)[1:-1]
+            cuts = cuts[cuts < unique_values[-1]]
+            thresholds.append(np.append(cuts, unique_values[-1]))
+        return thresholds
+
+
+class CsvChunks:
+    """The rows of a CSV file, read chunk by chunk every time it is iterated over, as training data for
+    DecisionTree.fit_stream.
+
+    Every chunk is a tuple of the feature matrix and the labels of its rows, where the labels are the
+    values of label_column numbered in the order they first appear in the file. Rows missing a feature or
+    their label are skipped.
 
+    Instance Attributes:
+        - path: The path of the CSV file.
+        - features: The columns used as features, in order.
+        - label_column: The column whose values are the labels.
+        - chunksize: The number of rows read at a time.
+        - classes: The value of label_column that each label stands for, as far as the file has been read.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     path = os.path.join(directory, 'songs.csv')
+    ...     pd.DataFrame({'name': ['a', 'b', 'a', None, 'c'], 'tempo': [90, 120, 95, 100, 130],
+    ...                   'energy': [0.2, 0.8, 0.3, 0.5, None]}).to_csv(path, index=False)
+    ...     chunks = CsvChunks(path, ['tempo', 'energy'], 'name', chunksize=2)
+    ...     [y.tolist() for _, y in chunks], chunks.classes
+    ([[0, 1], [0]], ['a', 'b'])
+    """
+    path: str
+    features: list[str]
+    label_column: str
+    chunksize: int
+    classes: list[Any]
+    # Private Instance Attributes:
+    #     - _labels: the label of every value of label_column in classes
+    _labels: dict[Any, int]
+
+    def __init__(self, path: str, features: list[str], label_column: str, chunksize: int = 100_000) -> None:
+        """Initialize a CsvChunks reader of the file at path."""
+        self.path = path
+        self.features = features
+        self.label_column = label_column
+        self.chunksize = chunksize
+        self.classes = []
+        self._labels = {}
+
+    def __iter__(self) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Yield the features and labels of every chunk of rows of the file."""
+        for frame in pd.read_csv(self.path, usecols=self.features + [self.label_column], chunksize=self.chunksize):
+            frame = frame.dropna()
+            if frame.empty:
+                continue
+            for value in frame[self.label_column]:
+                if value not in self._labels:
+                    self._labels[value] = len(self.classes)
+                    self.classes.append(value)
+            labels = np.array([self._labels[value] for value in frame[self.label_column]], dtype=np.int64)
+            yield frame[self.features].to_numpy(dtype=float), labels
+
+
+class _LevelLabels:
+    """The labels of every node of a level of a tree being grown, counted together.
+
+    Every distinct (node, label) pair present is given a key, and the keys of each node are consecutive
+    and in increasing order of label, so that a node's keys relabel its classes the way _best_split does.
+
+    Instance Attributes:
+        - keys: The key of every sample of the level, in the order the samples were given.
+        - counts: The number of samples with each key.
+        - key_nodes: The node of each key.
+        - n_classes: The number of distinct labels at each node.
+        - majority: The most common label at each node, ties going to the label that occurs first, or -1 if
+        the node has no samples.
+        - n_samples: The number of samples at each node.
+        - xlogx_sums: The sum of c * log2(c) over the class counts c of each node.
+        - entropies: The entropy of the labels of each node.
+
+    >>> labels = _LevelLabels(np.array([5, 3, 5, 9, 9, 2]), np.array([0, 0, 0, 2, 2, 2]), 3)
+    >>> labels.keys.tolist(), labels.n_classes.tolist(), labels.majority.tolist()
+    ([1, 0, 1, 3, 3, 2], [2, 0, 2], [5, -1, 9])
+    """
+    keys: np.ndarray
+    counts: np.ndarray
+    key_nodes: np.ndarray
+    n_classes: np.ndarray
+    majority: np.ndarray
+    n_samples: np.ndarray
+    xlogx_sums: np.ndarray
+    entropies: np.ndarray
+
+    def __init__(self, y_data: np.ndarray, segments: np.ndarray, n_nodes: int) -> None:
+        """Count the labels y_data of a level, where segments gives the node of every sample.
+
+        Preconditions:
+            - np.all(segments[:-1] <= segments[1:])
+        """
+        order = np.lexsort((y_data, segments))
+        sorted_labels, sorted_segments = y_data[order], segments[order]
+        is_key_start = np.ones(len(y_data), dtype=bool)
+        is_key_start[1:] = (sorted_labels[1:] != sorted_labels[:-1]) | (sorted_segments[1:] != sorted_segments[:-1])
+        key_starts = np.flatnonzero(is_key_start)
+
+        self.keys = np.empty(len(y_data), dtype=np.int64)
+        self.keys[order] = np.cumsum(is_key_start) - 1
+        self.counts = np.diff(np.append(key_starts, len(y_data)))
+        self.key_nodes = sorted_segments[key_starts]
+        self.n_classes = np.bincount(self.key_nodes, minlength=n_nodes)
+        self.n_samples = np.bincount(segments, minlength=n_nodes)
+
+        # the most common label, taking the label that occurs first in the node among equally common ones
+        first_positions = np.full(len(self.counts), len(y_data))
+        np.minimum.at(first_positions, self.keys, np.arange(len(y_data)))
+        by_count = np.lexsort((first_positions, -self.counts, self.key_nodes))
+        is_node_first = np.ones(len(by_count), dtype=bool)
+        is_node_first[1:] = self.key_nodes[by_count][1:] != self.key_nodes[by_count][:-1]
+        best_keys = by_count[is_node_first]
+        self.majority = np.full(n_nodes, -1, dtype=np.int64)
+        self.majority[self.key_nodes[best_keys]] = sorted_labels[key_starts[best_keys]]
+
+        prob = self.counts / np.maximum(self.n_samples[self.key_nodes], 1)
+        self.xlogx_sums = np.bincount(self.key_nodes, weights=_xlog2x(self.counts), minlength=n_nodes)
+        self.entropies = -np.bincount(self.key_nodes, weights=prob * np.log2(prob + 1e-9), minlength=n_nodes)
+
+
+def _segment_positions(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return every position in the ranges [starts[i], ends[i]), range by range, and the index of the range
+    each one is in.
+
+    >>> segments, positions = _segment_positions(np.array([0, 5, 7]), np.array([2, 5, 10]))
+    >>> segments.tolist(), positions.tolist()
+    ([0, 0, 2, 2, 2], [0, 1, 7, 8, 9])
+    """
+    lengths = ends - starts
+    segments = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return segments, np.arange(np.sum(lengths)) - np.repeat(offsets - starts, lengths)
+
+
+def _segmented_cumsum(values: np.ndarray, segment_starts: np.ndarray) -> np.ndarray:
+    """Return the running sums of values, restarting at every position in segment_starts.
+
+    Floating-point segments are summed on their own rather than as differences of one long running sum,
+    so that each gives exactly the np.cumsum of the segment, however long the earlier segments are.
+
+    Preconditions:
+        - len(segment_starts) > 0 and segment_starts[0] == 0
+        - np.all(segment_starts[:-1] < segment_starts[1:])
+
+    >>> _segmented_cumsum(np.array([1, 2, 3, 4, 5]), np.array([0, 2])).tolist()
+    [1, 3, 3, 7, 12]
+    >>> _segmented_cumsum(np.array([1e20, 1.0, 0.5, 0.25]), np.array([0, 2])).tolist()
+    [1e+20, 1e+20, 0.5, 0.75]
+    """
+    lengths = np.diff(np.append(segment_starts, len(values)))
+    if values.dtype.kind != 'f':
+        sums = np.cumsum(values)
+        return sums - np.repeat(sums[segment_starts] - values[segment_starts], lengths)
+
+    # sum segments of similar length together as the rows of a matrix, padded with zeros at the end
+    sums = np.empty(len(values))
+    size_classes = np.ceil(np.log2(lengths)).astype(np.int64)
+    for size_class in np.unique(size_classes):
+        in_class = np.flatnonzero(size_classes == size_class)
+        columns = np.arange(np.max(lengths[in_class]))
+        valid = columns < lengths[in_class, None]
+        index = (segment_starts[in_class, None] + columns)[valid]
+        block = np.zeros(valid.shape)
+        block[valid] = values[index]
+        sums[index] = np.cumsum(block, axis=1)[valid]
+    return sums
+
+
+def _sweep_segments(segments: np.ndarray, values: np.ndarray, keys: np.ndarray, item_counts: np.ndarray,
+                    labels: _LevelLabels, nodes: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    """Return the highest information gain of every node over all thresholds of a feature, and the lowest
+    threshold that achieves it, like DecisionTree._sweep_thresholds and DecisionTree._sweep_bins do for a
+    single node, and the number of thresholds scored.
+
+    The items are sorted by segment and then by value, and item i stands for item_counts[i] samples of
+    segment segments[i] with the feature value values[i] and the label key keys[i] of labels. Segment s
+    holds the samples of the node nodes[s] of the level.
+
+    Preconditions:
+        - every segment has at least one item
+    """
+    segment_starts = np.flatnonzero(np.append(True, segments[1:] != segments[:-1]))
+
+    # seen[i] is the number of samples in earlier items of the segment that share the label of item i
+    seen = _occurrences_before(keys, item_counts)
+    remaining = labels.counts[keys] - seen
+
+    # sum of c * log2(c) over the class counts c of each child, updated one item at a time
+    left_sum = _segmented_cumsum(_xlog2x(seen + item_counts) - _xlog2x(seen), segment_starts)
+    right_sum = labels.xlogx_sums[nodes][segments] - _segmented_cumsum(
+        _xlog2x(remaining) - _xlog2x(remaining - item_counts), segment_starts)
+    left_classes = _segmented_cumsum((seen == 0).astype(np.int64), segment_starts)
+    right_classes = labels.n_classes[nodes][segments] - _segmented_cumsum(
+        (remaining == item_counts).astype(np.int64), segment_starts)
+    n_left = _segmented_cumsum(item_counts.astype(np.int64), segment_starts)
+
+    # a threshold is only evaluated at the last item of each run of equal values
+    boundaries = np.flatnonzero(np.append((values[1:] != values[:-1]) | (segments[1:] != segments[:-1]), True))
+    boundary_segments = segments[boundaries]
+    gains = _split_gains(labels.entropies[nodes][boundary_segments], n_left[boundaries], left_sum[boundaries],
+                         right_sum[boundaries], left_classes[boundaries], right_classes[boundaries],
+                         labels.n_samples[nodes][boundary_segments])
+
+    # the first boundary of each segment within GAIN_TOLERANCE of the segment's highest gain
+    segment_firsts = np.flatnonzero(np.append(True, boundary_segments[1:] != boundary_segments[:-1]))
+    highest = np.maximum.reduceat(gains, segment_firsts)
+    near_best = np.flatnonzero(gains >= highest[boundary_segments] - GAIN_TOLERANCE)
+    _, firsts = np.unique(boundary_segments[near_best], return_index=True)
+    best = near_best[firsts]
+    return gains[best], values[boundaries[best]], len(boundaries)
+
+
+def _split_gains(parent_entropy: float | np.ndarray, n_left: np.ndarray, left_sum: np.ndarray, right_sum: np.ndarray,
+                 left_classes: np.ndarray, right_classes: np.ndarray, n: Optional[np.ndarray] = None) -> np.ndarray:
+    """Return the information gain of a sequence of candidate splits of the same node, in increasing
+    order of n_left.
+
+    For every candidate, n_left is the size of the left child, left_sum and right_sum are the sums of
+    c * log2(c) over the class counts c of each child, and left_classes and right_classes are the number
+    of classes present in each child. The last candidate puts every sample in the left child.
+
+    Candidates of different nodes can be scored together by giving the parent entropy and size n of the
+    node of every candidate.
+    """
+    n = n_left[-1] if n is None else n
+    n_right = n - n_left
+    entropy_left = _count_entropy(n_left, left_sum, left_classes)
+    entropy_right = _count_entropy(np.maximum(n_right, 1), right_sum, right_classes)
+    child_entropy = (n_left / n) * entropy_left + (n_right / n) * entropy_right
+
+    # a threshold that leaves the right child empty has no information gain
+    return np.where(n_right == 0, 0, parent_entropy - child_entropy)
+
+
+def _first_best(gains: np.ndarray) -> int:
+    """Return the index of the first gain that is within GAIN_TOLERANCE of the highest gain.
+
+    Information gains that are mathematically equal can differ in their last few bits depending on
+    how they were computed, so they are compared with a tolerance to keep the chosen split stable.
+
+    >>> _first_best(np.array([0.2, 0.5, 0.5 + 1e-13, 0.4]))
+    1
+    """
+    return int(np.flatnonzero(gains >= np.max(gains) - GAIN_TOLERANCE)[0])
+
+
+def _label_entropy(counts: np.ndarray) -> float:
+    """Return the entropy of a set of labels from the number of times each label present occurs in it."""
+    prob = counts / np.sum(counts)
+    return float(-np.sum(prob * np.log2(prob + 1e-9)))
+
+
+def _xlog2x(counts: np.ndarray) -> np.ndarray:
+    """Return counts * log2(counts) elementwise, where 0 * log2(0) is taken to be 0."""
+    counts = np.asarray(counts, dtype=float)
+    return counts * np.log2(np.maximum(counts, 1))
+
+
+def _count_entropy(n: np.ndarray, xlogx_sum: np.ndarray, n_classes: np.ndarray) -> np.ndarray:
+    """Return the entropy of groups of n labels from the sum of c * log2(c) over their class counts c,
+    and the number of classes present in each group.
+
+    This matches DecisionTree._entropy, including the small offset that its 1e-9 smoothing term
+    subtracts for every class present.
+
+    Preconditions:
+        - np.all(n > 0)
+    """
+    return np.log2(n) - xlogx_sum / n - n_classes * (1e-9 / np.log(2))
+
+
+def _occurrences_before(labels: np.ndarray, counts: Optional[np.ndarray] = None) -> np.ndarray:
+    """Return, for every position i, the number of samples before position i that hold the same label,
+    where position j stands for counts[j] samples (one sample each if counts is None).
+
+    >>> _occurrences_before(np.array([3, 1, 3, 3, 1, 0])).tolist()
+    [0, 0, 1, 2, 1, 0]
+    >>> _occurrences_before(np.array([3, 1, 3, 3]), np.array([2, 1, 4, 1])).tolist()
+    [0, 0, 2, 6]
+    """
+    if counts is None:
+        counts = np.ones(len(labels), dtype=np.int64)
+
+    order = np.argsort(labels, kind='stable')
+    sorted_labels, sorted_counts = labels[order], counts[order]
+    group_starts = np.flatnonzero(np.append(True, sorted_labels[1:] != sorted_labels[:-1]))
+    group_sizes = np.diff(np.append(group_starts, len(labels)))
+
+    # exclusive running total of the counts, restarted at the beginning of every label's group
+    running = np.cumsum(sorted_counts) - sorted_counts
+    running -= np.repeat(running[group_starts], group_sizes)
+
+    occurrences = np.empty(len(labels), dtype=np.int64)
+    occurrences[order] = running
+    return occurrences
+
+
+class CatalogIndex:
+    """A lookup index over the songs of a dataset, built once and shared by get_song_features and
+    recommend_songs.
 
-def recommend_songs(dtree: DecisionTree, user_song: str, features: list[str],
-                    dataset: pd.DataFrame) -> Optional[list[tuple[str, str, float]]]:
-    """Recommend a similar song to the given user_song using the decision tree dtree and cosine similarity.
+    Songs are looked up by their name, or by their name and artist, after normalize_key, in constant time.
+    Several songs can share a name. Looking one up by name alone gives the first of them in the dataset,
+    like scanning the dataset would, and find_all gives all of them.
+
+    Instance Attributes:
+        - features: The names of the feature columns of the index, in order.
+        - feature_matrix: The features of every song, one row per row of the dataset.
+        - unit_features: The rows of feature_matrix scaled to unit length, as float32.
+        - song_ids: An id for every song, equal for songs whose names are equal after stripping whitespace.
+
+    Representation Invariants:
+        - self.feature_matrix.shape == (len(self.song_ids), len(self.features))
+        - self.unit_features.shape == self.feature_matrix.shape
+
+    >>> songs = pd.DataFrame({'name': ['Dreams', 'Creep', 'dreams ', 'Let Down'],
+    ...                       'artists': ['The Cranberries', 'Radiohead', 'Fleetwood Mac', 'Radiohead'],
+    ...                       'tempo': [1.0, 2.0, 3.0, 4.0]})
+    >>> index = CatalogIndex(songs, ['tempo'])
+    >>> index.find('DREAMS'), index.find('Dreams', 'fleetwood mac'), index.find_all('dreams').tolist()
+    (0, 2, [0, 2])
+    >>> get_song_features('Let Down', ['tempo'], songs, index)
+    {'tempo': 4.0}
+    """
+    features: list[str]
+    feature_matrix: np.ndarray
+    unit_features: np.ndarray
+    song_ids: np.ndarray
+    # Private Instance Attributes:
+    #     - _rows_by_name: maps every normalized name to the first row with that name
+    #     - _rows_by_song: maps every normalized (name, artist) pair to the first row with that name and artist
+    #     - _duplicate_rows: maps every normalized name shared by several rows to all of those rows
+    _rows_by_name: dict[str, int]
+    _rows_by_song: dict[tuple[str, str], int]
+    _duplicate_rows: dict[str, np.ndarray]
+
+    def __init__(self, dataset: pd.DataFrame, features: list[str]) -> None:
+        """Build the index of dataset, which must have 'name' and 'artists' columns and the given features."""
+        self.features = list(features)
+        self.feature_matrix = dataset[self.features].to_numpy(dtype=np.float64)
+        self.unit_features = normalize_features(self.feature_matrix)
+        self.song_ids, _ = pd.factorize(dataset['name'].astype(str).str.strip())
+
+        names = _normalize_keys(dataset['name'])
+        artists = _normalize_keys(dataset['artists'])
+        rows = range(len(dataset))
+
+        # insert the rows backwards, so that the first row with a key is the one that stays
+        self._rows_by_name = dict(zip(names[::-1], rows[::-1]))
+        self._rows_by_song = dict(zip(zip(names[::-1], artists[::-1]), rows[::-1]))
+
+        is_duplicate = pd.Series(names).duplicated(keep=False).to_numpy()
+        duplicates = pd.Series(np.flatnonzero(is_duplicate)).groupby(np.asarray(names, dtype=object)[is_duplicate])
+        self._duplicate_rows = {name: group.to_numpy() for name, group in duplicates}
+
+    def find(self, name: str, artist: Optional[str] = None) -> int:
+        """Return the row of the first song with the given name, and the given artist if it is not None.
+
+        Raise a ValueError if there is no such song.
+        """
+        if artist is None:
+            row = self._rows_by_name.get(normalize_key(name))
+        else:
+            row = self._rows_by_song.get((normalize_key(name), normalize_key(artist)))
+
+        if row is None:
+            by_artist = '' if artist is None else f" by {artist}"
+            raise ValueError(f"Song '{name}'{by_artist} not found in the dataset.")
+        return row
+
+    def find_all(self, name: str) -> np.ndarray:
+        """Return the rows of every song with the given name, in dataset order. Raise a ValueError if there is
+        no such song.
+        """
+        key = normalize_key(name)
+        if key in self._duplicate_rows:
+            return self._duplicate_rows[key]
+        return np.array([self.find(name)])
+
+
+def normalize_key(text: str) -> str:
+    """Return text in the form that CatalogIndex compares song names and artists in: without case, and with
+    runs of whitespace replaced by one space and removed from both ends.
+
+    >>> normalize_key('  Let   Down ')
+    'let down'
+    """
+    return ' '.join(str(text).casefold().split())
+
+
+def _normalize_keys(column: pd.Series) -> list[str]:
+    """Return normalize_key of every value of column."""
+    return column.astype(str).str.casefold().str.split().str.join(' ').tolist()
+
+
+def recommend_songs(dtree: DecisionTree | RandomForest, user_song: str, features: list[str],
+                    dataset: pd.DataFrame, k: int = 10, index: Optional[CatalogIndex] = None,
+                    artist: Optional[str] = None) -> Optional[list[tuple[str, str, float]]]:
+    """Recommend the k songs most similar to the given user_song using the decision tree dtree and cosine
+    similarity, most similar first.
+
+    The candidate songs are the training songs in the leaf that user_song reaches, or in any of the leaves
+    it reaches if dtree is a RandomForest. Every candidate is scored at once as a dot product of unit
+    feature vectors. Passing an index of dataset, built once, makes finding user_song a constant-time lookup
+    and lets artist pick between songs named user_song, as in get_song_features. Without one, user_song is
+    found by scanning the dataset, and only the candidates' features are read and normalized.
 
     Preconditions:
-        - dtree is a trained DecisionTree object
+        - dtree is a trained DecisionTree or RandomForest object, whose sample ids are row positions in dataset
         - user_song is a valid song name in the dataset
         - features is a list of feature names that exist in the dataset
         - dataset is a pandas DataFrame containing at least the column names: 'name', 'artists'
         and the specified features.
+        - k >= 1
+        - index is None or it was built from dataset and features
     """
-
     # find user_song features in the dataset
-    user_song_features = get_song_features(user_song, features, dataset)
+    user_song_features = get_song_features(user_song, features, dataset, index, artist)
 
-    # get the leaf nodes of the decision
-    user_song_features_df = pd.DataFrame([user_song_features])
-    leaf_node_prediction = dtree.predict(user_song_features_df.to_numpy())[0]
+    # read the songs in the leaf (or leaves, for a forest) that the user's song reaches
+    user_song_vector = np.array(list(user_song_features.values()))
+    leaf_node_rows = np.sort(dtree.leaf_members(user_song_vector))
 
-    # using LabelEncoder to map the leaf node back to the song name
-    encoder = LabelEncoder()
-    encoder.fit(dataset['name'])  # fit the encoder on the dataset's song names
-    predicted_song_name = encoder.inverse_transform([leaf_node_prediction])[0]
+    if len(leaf_node_rows) == 0:
+        print("No songs found in this leaf node.")
+        return None
 
-    # extract songs that belong to the predicted leaf node
-    leaf_node_songs = dataset[dataset['name'] == predicted_song_name]
+    if index is not None:
+        unit_features, song_ids = index.unit_features[leaf_node_rows], index.song_ids[leaf_node_rows]
+    else:
+        unit_features = normalize_features(dataset[features].iloc[leaf_node_rows].to_numpy(dtype=np.float64))
+        song_ids, _ = pd.factorize(dataset['name'].iloc[leaf_node_rows].astype(str).str.strip())
 
-    # remove duplicates
-    leaf_node_songs = leaf_node_songs.drop_duplicates(subset='name')
+    # score every candidate with one matrix-vector product of unit vectors
+    similarities = unit_features @ normalize_features(user_song_vector.reshape(1, -1))[0]
 
-    if len(leaf_node_songs) == 0:
-        print("No songs found in this leaf node.")
-        return None
+    # keep the k most similar songs, counting each song name once
+    best = top_k_unique(similarities, song_ids, k)
 
-    # begin finding similar songs
-    similarities = []
-    user_song_vector = np.array(list(user_song_features.values())).reshape(1, -1)
+    song_names = dataset['name'].iloc[leaf_node_rows[best]].str.strip()  # ensure no extra whitespace
+    artist_names = dataset['artists'].iloc[leaf_node_rows[best]]
+    return [(song_name, artist_name, float(similarity)) for song_name, artist_name, similarity
+            in zip(song_names, artist_names, similarities[best])]
 
-    for _, row in leaf_node_songs.iterrows():
-        song_features = row.to_dict()
-        song_features_values = {k: v for k, v in song_features.items() if k in user_song_features}
-        song_vector = np.array(list(song_features_values.values())).reshape(1, -1)
 
-        similarity = calculate_cosine_similarity(user_song_vector, song_vector)  # using helper function below
-        song_name = row['name'].strip()  # ensure no extra whitespace
-        artist_name = row['artists']
-        similarities.append((song_name, artist_name, similarity))  # append song name, artist, and similarity
+def recommend_songs_batch(dtree: DecisionTree | RandomForest, seeds: list[list[str | tuple[str, str]]],
+                          features: list[str], dataset: pd.DataFrame, k: int = 10,
+                          index: Optional[CatalogIndex] = None,
+                          batch_size: int = 256) -> list[Optional[list[tuple[str, str, float]]]]:
+    """Recommend k songs for each of many requests at once, where every request is seeded by a list of songs,
+    such as a user's top tracks. Each seed is a song name, or a (name, artist) pair.
 
-    # rank and filter by similarity
-    similarities = [item for item in similarities if item[2] != -1]  # filter out invalid similarities
-    similarities.sort(key=lambda x: x[2], reverse=True)
+    The candidates of a request are the training songs in the leaves its seeds reach, merged without repeats,
+    and they are ranked by cosine similarity to the average unit feature vector of its seeds. The request's
+    own seed songs are never recommended back. Seeds that are not in the dataset are skipped, and a request
+    without any seed in the dataset, or without any other candidate, gets None.
 
-    # remove duplicates
-    seen = set()
-    rec_songs = []
-    for song_name, artists_names, similarity in similarities:
-        if song_name not in seen:
-            rec_songs.append((song_name, artists_names, similarity))
-            seen.add(song_name)
+    All seeds are looked up in index and routed through the tree together. The candidates of up to batch_size
+    requests are then gathered into one block and scored together, each only against its own request's query,
+    so the work is proportional to the total number of candidates, and batch_size bounds the memory used.
+
+    Preconditions:
+        - dtree is a trained DecisionTree or RandomForest object, whose sample ids are row positions in dataset
+        - features is a list of feature names that exist in the dataset
+        - dataset is a pandas DataFrame containing at least the column names: 'name', 'artists'
+        and the specified features.
+        - k >= 1 and batch_size >= 1
+        - index is None or it was built from dataset and features
+
+    >>> rng = np.random.default_rng(4)
+    >>> songs = pd.DataFrame(rng.random((300, 3)), columns=['tempo', 'energy', 'danceability'])
+    >>> songs['name'], songs['artists'] = [f'song {i}' for i in range(300)], 'artist'
+    >>> tree = DecisionTree(max_depth=3, random_state=0)
+    >>> tree.fit(songs[['tempo', 'energy', 'danceability']].to_numpy(), np.arange(300))
+    >>> batch = recommend_songs_batch(tree, [['song 7'], ['song 8', ('song 9', 'artist')], ['no such song']],
+    ...                               ['tempo', 'energy', 'danceability'], songs, k=5)
+    >>> single = recommend_songs(tree, 'song 7', ['tempo', 'energy', 'danceability'], songs, k=6)
+    >>> [name for name, _, _ in batch[0]] == [name for name, _, _ in single if name != 'song 7'][:5]
+    True
+    >>> len(batch[1]), batch[2]
+    (5, None)
+    """
+    if index is None:
+        index = CatalogIndex(dataset, features)
+    trees = dtree.trees if isinstance(dtree, RandomForest) else [dtree.flat_tree]
+
+    # look up every seed of every request, skipping the ones that are not in the dataset
+    seed_rows, seed_requests = [], []
+    for request, request_seeds in enumerate(seeds):
+        for seed in request_seeds:
+            name, artist = (seed, None) if isinstance(seed, str) else seed
+            try:
+                seed_rows.append(index.find(name, artist))
+                seed_requests.append(request)
+            except ValueError:
+                continue
+    seed_rows, seed_requests = np.array(seed_rows, dtype=np.int64), np.array(seed_requests, dtype=np.int64)
+
+    # route every seed through every tree in one vectorized pass per tree
+    seed_leaves = [tree.apply(index.feature_matrix[seed_rows]) for tree in trees]
+
+    # the seeds were looked up request by request, so the seeds of every request are a contiguous range
+    seed_starts = np.searchsorted(seed_requests, np.arange(len(seeds) + 1))
+    seed_song_ids = index.song_ids[seed_rows]
+
+    recommendations = []
+    for batch_start in range(0, len(seeds), batch_size):
+        batch_requests = range(batch_start, min(batch_start + batch_size, len(seeds)))
+
+        # merge the leaf members of every seed of a request without its own songs, and its seeds into a query
+        candidates, queries = [], []
+        for request in batch_requests:
+            in_request = slice(seed_starts[request], seed_starts[request + 1])
+            members = [tree.members(node) for tree, leaves in zip(trees, seed_leaves) for node in leaves[in_request]]
+            rows = np.sort(np.concatenate(members)) if members else np.zeros(0, dtype=np.int64)
+            rows = rows[np.diff(rows, prepend=-1) != 0]
+            candidates.append(rows[~np.isin(index.song_ids[rows], seed_song_ids[in_request])])
+            queries.append(index.unit_features[seed_rows[in_request]].sum(axis=0))
+
+        # score every candidate of the batch against the query of its own request, in one pass
+        lengths = np.array([len(rows) for rows in candidates], dtype=np.int64)
+        candidate_starts = np.concatenate(([0], np.cumsum(lengths)))
+        query_of_row = np.repeat(np.arange(len(candidates)), lengths)
+        similarities = np.einsum('ij,ij->i', index.unit_features[np.concatenate(candidates)],
+                                 normalize_features(np.array(queries))[query_of_row])
+
+        for column, rows in enumerate(candidates):
+            if len(rows) == 0:
+                recommendations.append(None)
+                continue
+
+            request_similarities = similarities[candidate_starts[column]:candidate_starts[column + 1]]
+            best = top_k_unique(request_similarities, index.song_ids[rows], k)
+            song_names = dataset['name'].iloc[rows[best]].str.strip()  # ensure no extra whitespace
+            artist_names = dataset['artists'].iloc[rows[best]]
+            recommendations.append([(song_name, artist_name, float(similarity)) for song_name, artist_name, similarity
+                                    in zip(song_names, artist_names, request_similarities[best])])
+
+    return recommendations
+
+
+def normalize_features(feature_matrix: np.ndarray) -> np.ndarray:
+    """Return the rows of feature_matrix scaled to unit length as float32, so that the cosine similarity of
+    two rows is their dot product. Rows of zeros stay zero.
+
+    >>> normalize_features(np.array([[3.0, 4.0], [0.0, 0.0]])).tolist()
+    [[0.6000000238418579, 0.800000011920929], [0.0, 0.0]]
+    """
+    feature_matrix = np.asarray(feature_matrix, dtype=np.float32)
+    norms = np.linalg.norm(feature_matrix, axis=1, keepdims=True)
+    return feature_matrix / np.where(norms == 0, 1, norms)
 
-    return rec_songs
 
+def top_k_unique(scores: np.ndarray, ids: np.ndarray, k: int) -> np.ndarray:
+    """Return the positions of the k highest scores, highest first, taking only the best-scoring position
+    of every id. Ties go to the earlier position.
 
-def calculate_cosine_similarity(user_song_vector: np.ndarray, song_vector: np.ndarray) -> float:
-    """Calculates the cosine similarity between the feature vectors of the user's song and a song from the dataset.
-    If the shapes of the feature vectors for the user song and dataset song do not match, it returns -1.
+    >>> top_k_unique(np.array([0.5, 0.9, 0.8, 0.1, 0.9]), np.array([0, 1, 1, 2, 3]), 3).tolist()
+    [1, 4, 0]
     """
-    if user_song_vector.shape == song_vector.shape:  # check if user song and dataset song have the same dimensions
-        return cosine_similarity(user_song_vector, song_vector)
-    else:
-        return -1  # default value for missing similarity
+    # sort by id and then from the highest score, keeping positions in order, so the first of every id is the best
+    order = np.lexsort((-scores, ids))
+    sorted_ids = ids[order]
+    candidates = order[np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1]))] if len(ids) else order
+
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
 
 
-def get_song_features(user_song: str, features: list[str], dataset: pd.DataFrame) -> dict[str, float]:
+def get_song_features(user_song: str, features: list[str], dataset: pd.DataFrame,
+                      index: Optional[CatalogIndex] = None, artist: Optional[str] = None) -> dict[str, float]:
     """Returns the feature values for a specific song from the dataset.
 
+    With an index of the dataset, the song is found in constant time, its name and artist are matched
+    ignoring case and extra whitespace, and artist can pick between songs with the same name. Otherwise,
+    the dataset is scanned for the first song named exactly user_song, by exactly artist if it is not None.
+
     Representation Invariants:
         - `dataset` must contain a 'name' column and all features specified in `features`.
         - All elements in `features` must be valid column names in `dataset`.
+        - `index` is None or it was built from `dataset` and `features`.
     """
+    if index is not None:
+        return dict(zip(features, index.feature_matrix[index.find(user_song, artist)].tolist()))
 
     # filter the dataset to get the row corresponding to user_song
-    song_row = dataset[dataset['name'] == user_song]
+    matches = dataset['name'] == user_song
+    if artist is not None:
+        matches &= dataset['artists'] == artist
+    song_row = dataset[matches]
 
     if song_row.empty:
-        raise ValueError(f"Song '{user_song}' not found in the dataset.")
+        by_artist = '' if artist is None else f" by {artist}"
+        raise ValueError(f"Song '{user_song}'{by_artist} not found in the dataset.")
 
     # extract the requested features for the song and convert to a dictionary
     user_song_features = song_row[features].iloc[0].to_dict()
@@ -302,40 +2825,134 @@ def get_song_features(user_song: str, features: list[str], dataset: pd.DataFrame
     return user_song_features
 
 
-def visualize_custom_tree(node: Node, feature_names: list[str], classnames: list[str], dot_data: Optional[str] = None,
-                          parent: Optional[str] = None, depth: Optional[int] = 0) -> Optional[Source]:
-    """Recursively traverse the tree and create Graphviz dot representation."""
-    if dot_data is None:
-        dot_data = "digraph Tree {\n"  # indicates start of the tree representation
-
-    if node.is_leaf_node():  # if it is a leaf node, label with class name
-        class_name = classnames[node.value]
-        class_name = class_name.replace('"', '\\"')  # get rid of quotes in class name
-        dot_data += f'    node{depth} [label="{class_name}"];\n'
-        if parent is not None:  # if the node is not the root, add edge between parent node to current leaf node
-            dot_data += f'    node{parent} -> node{depth};\n'
-    else:  # if it is an internal node, label with feature names and thresholds
-        feature_name = feature_names[node.feature]
-        feature_name = feature_name.replace('"', '\\"')  # get rid of quotes in class name
-        dot_data += f'    node{depth} [label="{feature_name} <= {node.threshold:.2f}"];\n'
-        if parent is not None:
-            dot_data += f'    node{parent} -> node{depth};\n'
-
-        dot_data = visualize_custom_tree(node.left, feature_names, classnames, dot_data, parent=depth, depth=depth + 1)
-        dot_data = visualize_custom_tree(node.right, feature_names, classnames,
-                                         dot_data, parent=depth, depth=depth + 1)
-
-    if depth == 0:  # once all the nodes and edges are processed
-        dot_data += "}\n"
-        return Source(dot_data)
-
-    return dot_data  # return dot data when the function is not at root level (i.e. depth > 0)
-
-
-def plot_tree(dtree: DecisionTree, feature_names: list[str], classnames: list[str], filename: str = 'tree') -> None:
-    """Generate the tree visualization and save to a file."""
-    graph = visualize_custom_tree(dtree.root, feature_names, classnames)
-    print(graph.source)
+def _export_nodes(root: Node, max_depth: Optional[int] = None, max_nodes: Optional[int] = None
+                  ) -> Iterator[tuple[int, Node, Optional[int], Optional[tuple[int, int]]]]:
+    """Yield the nodes of the tree rooted at root in breadth-first order, each as a tuple of a unique id,
+    the node, the id of its parent (None for the root) and the ids of its children, or None if it is a
+    leaf or its children are left out.
+
+    The children of a node are left out if they would be deeper than max_depth or take the number of
+    nodes past max_nodes, so the nodes nearest the root are kept.
+
+    Preconditions:
+        - max_nodes is None or max_nodes >= 1
+
+    >>> tree = Node(feature=0, threshold=0.5, left=Node(value=1),
+    ...             right=Node(feature=1, threshold=2.0, left=Node(value=0), right=Node(value=1)))
+    >>> [(i, parent, children) for i, _, parent, children in _export_nodes(tree)]
+    [(0, None, (1, 2)), (1, 0, None), (2, 0, (3, 4)), (3, 2, None), (4, 2, None)]
+    >>> [(i, parent, children) for i, _, parent, children in _export_nodes(tree, max_nodes=4)]
+    [(0, None, (1, 2)), (1, 0, None), (2, 0, None)]
+    """
+    queue = deque([(root, 0, 0, None)])
+    n_ids = 1
+    while queue:
+        node, node_id, depth, parent = queue.popleft()
+        children = None
+
+        is_internal = not (node.is_leaf_node() or node.feature is None)
+        if is_internal and (max_depth is None or depth < max_depth) and (max_nodes is None or n_ids + 2 <= max_nodes):
+            children = (n_ids, n_ids + 1)
+            queue.extend([(node.left, n_ids, depth + 1, node_id), (node.right, n_ids + 1, depth + 1, node_id)])
+            n_ids += 2
+
+        yield node_id, node, parent, children
+
+
+def _export_label(node: Node, feature_names: list[str], classnames: list[str], truncated: bool) -> str:
+    """Return the text shown for node: its split for internal nodes, and its class name for leaves."""
+    if node.is_leaf_node():
+        return classnames[node.value]
+    if node.feature is None:
+        return '(no samples)'
+    label = f'{feature_names[node.feature]} <= {node.threshold:.2f}'
+    return label + f'\n... ({node.end - node.start} samples)' if truncated else label
+
+
+def export_dot(root: Node, out: TextIO, feature_names: list[str], classnames: list[str],
+               max_depth: Optional[int] = None, max_nodes: Optional[int] = None) -> int:
+    """Write the tree rooted at root to out as Graphviz DOT source, one line at a time, and return the
+    number of nodes written.
+
+    Every node has a unique id. Internal nodes whose children are left out because of max_depth or
+    max_nodes (see _export_nodes) are marked with the number of training samples below them.
+
+    >>> import io
+    >>> tree = Node(feature=0, threshold=0.5, left=Node(value=1), right=Node(value=0))
+    >>> out = io.StringIO()
+    >>> export_dot(tree, out, ['tempo'], ['Creep', 'Say "Hi"'])
+    3
+    >>> print(out.getvalue(), end='')
+    digraph Tree {
+        node0 [label="tempo <= 0.50"];
+        node1 [label="Say \\"Hi\\""];
+        node0 -> node1;
+        node2 [label="Creep"];
+        node0 -> node2;
+    }
+    """
+    n_nodes = 0
+    out.write('digraph Tree {\n')  # indicates start of the tree representation
+    for node_id, node, parent, children in _export_nodes(root, max_depth, max_nodes):
+        label = _export_label(node, feature_names, classnames, children is None)
+        label = label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')  # escape for DOT
+        out.write(f'    node{node_id} [label="{label}"];\n')
+        if parent is not None:  # if the node is not the root, add edge between parent node and current node
+            out.write(f'    node{parent} -> node{node_id};\n')
+        n_nodes += 1
+    out.write('}\n')
+    return n_nodes
+
+
+def export_json(root: Node, out: TextIO, feature_names: list[str], classnames: list[str],
+                max_depth: Optional[int] = None, max_nodes: Optional[int] = None) -> int:
+    """Write the tree rooted at root to out as a JSON object with a list of nodes, one node at a time,
+    and return the number of nodes written.
+
+    Every node has an "id" and a "samples" count. Internal nodes also have a "feature", a "threshold" and,
+    unless they are left out because of max_depth or max_nodes (see _export_nodes), the ids of their
+    "left" and "right" children. Leaves have a "class".
+
+    >>> import io
+    >>> tree = Node(feature=0, threshold=0.5, left=Node(value=1, end=2), right=Node(value=0, start=2, end=3), end=3)
+    >>> out = io.StringIO()
+    >>> export_json(tree, out, ['tempo'], ['Creep', 'Dreams'])
+    3
+    >>> json.loads(out.getvalue())['nodes'][0]
+    {'id': 0, 'samples': 3, 'feature': 'tempo', 'threshold': 0.5, 'left': 1, 'right': 2}
+    """
+    n_nodes = 0
+    out.write('{"nodes": [')
+    for node_id, node, _, children in _export_nodes(root, max_depth, max_nodes):
+        record = {'id': node_id, 'samples': node.end - node.start}
+        if node.is_leaf_node():
+            record['class'] = classnames[node.value]
+        elif node.feature is not None:
+            record['feature'], record['threshold'] = feature_names[node.feature], float(node.threshold)
+            if children is not None:
+                record['left'], record['right'] = children
+        out.write((',\n' if n_nodes else '\n') + json.dumps(record))
+        n_nodes += 1
+    out.write('\n]}\n')
+    return n_nodes
+
+
+def visualize_custom_tree(node: Node, feature_names: list[str], classnames: list[str],
+                          max_depth: Optional[int] = None, max_nodes: Optional[int] = None) -> Source:
+    """Create the Graphviz dot representation of the tree rooted at node, down to max_depth and with at
+    most max_nodes nodes (see export_dot).
+    """
+    dot_data = io.StringIO()
+    export_dot(node, dot_data, feature_names, classnames, max_depth, max_nodes)
+    return Source(dot_data.getvalue())
+
+
+def plot_tree(dtree: DecisionTree, feature_names: list[str], classnames: list[str], filename: str = 'tree',
+              max_depth: Optional[int] = None, max_nodes: Optional[int] = None) -> None:
+    """Generate the tree visualization, down to max_depth and with at most max_nodes nodes, and save it
+    to a file.
+    """
+    graph = visualize_custom_tree(dtree.root, feature_names, classnames, max_depth, max_nodes)
     graph.render(filename, format='png')
     print(f"Tree visualization saved to {filename}.png")
 
@@ -343,9 +2960,9 @@ def plot_tree(dtree: DecisionTree, feature_names: list[str], classnames: list[st
 if __name__ == "__main__":
     # python_ta.check_all(config={
     #     'extra-imports': [
-    #         'os', 'random', 'collections', 'typing', 'numpy', 'pandas',
-    #         'sklearn.model_selection', 'sklearn.metrics', 'sklearn.metrics.pairwise',
-    #         'sklearn.preprocessing', 'graphviz', 'python_ta'
+    #         'heapq', 'io', 'itertools', 'json', 'os', 'random', 'time', 'collections', 'concurrent.futures',
+    #         'contextlib', 'multiprocessing.shared_memory', 'typing', 'numpy', 'pandas', 'sklearn.model_selection',
+    #         'sklearn.metrics', 'sklearn.preprocessing', 'graphviz', 'python_ta'
     #     ],
     #     'allowed-io': ['plot_tree', 'recommend_songs'],
     #     'max-line-length': 120
@@ -384,18 +3001,21 @@ if __name__ == "__main__":
 
     assert np.min(y_encoded) >= 0, "y should contain non-negative values"
 
-    # split the data into training and testing sets (80% train, 20% test)
-    X_train, X_test, y_train, y_test = train_test_split(X, y_encoded, test_size=0.2, random_state=4321)
+    # split the data into training and testing sets (80% train, 20% test), keeping each song's row in df
+    X_train, X_test, y_train, y_test, rows_train, _ = train_test_split(X, y_encoded, np.arange(len(df)),
+                                                                       test_size=0.2, random_state=4321)
 
     # initialize the decision tree
     clf = DecisionTree(min_samples_split=2, max_depth=7)
-    clf.fit(X_train, y_train)
+    clf.fit(X_train, y_train, sample_ids=rows_train)
 
     # (Optional) visualize tree
     plot_tree(dtree=clf, feature_names=FEATURES, classnames=class_names, filename="song_recommendation_tree")
 
-    # get song recommendations
-    recommended_songs = recommend_songs(dtree=clf, user_song=SONG, features=FEATURES, dataset=df)
+    # get song recommendations, indexing the songs once for every lookup
+    catalog_index = CatalogIndex(df, FEATURES)
+    recommended_songs = recommend_songs(dtree=clf, user_song=SONG, features=FEATURES, dataset=df,
+                                        index=catalog_index, artist=ARTISTS)
 
     print("Recommended songs:")
     for song, artists, _ in recommended_songs:
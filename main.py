@@ -11,6 +11,8 @@ import oauth_activation as oauth
 from spotipy import SpotifyOAuth
 import recommender_graph_v2 as user_recs
 import decision_tree as song_recs
+import model_store
+import catalog_store
 import pandas as pd
 import os
 import random
@@ -67,6 +69,8 @@ class ECHOESgui(CTk):
         self.song_recommendation_features = ['speechiness', 'tempo', 'energy', 'loudness', 'acousticness',
                                              'danceability', 'instrumentalness']
         self.LIMIT = 500  # limit the dataset size to LIMIT rows to reduce running time during testing
+        self.song_recommendation_params = {'min_samples_split': 2, 'max_depth': 7}
+        self.model_store = model_store.ModelStore('.models')  # trained trees, reused across clicks and restarts
 
     def create_login_tab(self):
         """Create login tab UI"""
@@ -266,7 +270,8 @@ class ECHOESgui(CTk):
         """Fetch song-based recommendations from Spotify API"""
         try:
             # data wrangling
-            df = pd.read_csv('songs_with_attributes_and_lyrics.csv')
+            df = catalog_store.load_catalog('songs_with_attributes_and_lyrics.csv',
+                                            ['name', 'artists'] + self.song_recommendation_features)
             df = df.dropna(subset=self.song_recommendation_features)
             df = df.head(self.LIMIT)
 
@@ -304,17 +309,19 @@ class ECHOESgui(CTk):
 
             assert song_recs.np.min(y_encoded) >= 0, "y should contain non-negative values"
 
-            # split the data into training and testing sets (80% train, 20% test)
-            X_train, X_test, y_train, y_test = song_recs.train_test_split(X, y_encoded, test_size=0.2,
-                                                                          random_state=4321)
+            # split the data into training and testing sets (80% train, 20% test), keeping each song's row in df
+            X_train, X_test, y_train, y_test, rows_train, _ = song_recs.train_test_split(
+                X, y_encoded, song_recs.np.arange(len(df)), test_size=0.2, random_state=4321)
 
-            # initialize the decision tree
-            clf = song_recs.DecisionTree(min_samples_split=2, max_depth=7)
-            clf.fit(X_train, y_train)
+            # load the decision tree trained on this data, training and saving it if it is not stored yet
+            clf = self.model_store.load_or_train(X_train, y_train, class_names, self.song_recommendation_features,
+                                                 self.song_recommendation_params, sample_ids=rows_train).tree
 
             # get song recommendations
+            catalog_index = song_recs.CatalogIndex(df, self.song_recommendation_features)
             recommended_songs = song_recs.recommend_songs(dtree=clf, user_song=SONG,
-                                                          features=self.song_recommendation_features, dataset=df)
+                                                          features=self.song_recommendation_features, dataset=df,
+                                                          index=catalog_index, artist=ARTISTS)
             recommendations_text = "\n".join(f"Song: {song} by: {artists}" for song, artists, _ in recommended_songs)
 
             song_based_recommendations_output_label = CTkLabel(
@@ -0,0 +1,173 @@
+"""CSC111 Project 2: Spotify Recommendation System - Model Store
+
+This module saves trained song recommendation trees to disk and loads them back, so that the
+decision tree only has to be retrained when the songs it is trained on or its settings change.
+
+Every model is stored in a single .npz file named after a fingerprint of its training data, features
+and hyperparameters. The file holds the compiled tree with the songs in each of its leaves, the song
+names its labels stand for, the feature names and the hyperparameters, and can be loaded without
+unpickling any Python objects.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+import numpy as np
+
+from decision_tree import DecisionTree, FlatTree
+
+# the version of the model file layout, which is part of every fingerprint
+FORMAT_VERSION = 2
+
+# hyperparameters that do not change the trained tree, and so are left out of the fingerprint
+_UNFINGERPRINTED_PARAMS = ('n_jobs', 'collect_stats')
+
+
+class SavedModel:
+    """A trained song recommendation tree together with everything needed to use it.
+
+    Instance Attributes:
+        - tree: The trained decision tree.
+        - classes: The song name that each label predicted by the tree stands for.
+        - features: The names of the features the tree was trained on, in column order.
+        - params: The hyperparameters the tree was initialized with.
+        - fingerprint: The fingerprint of the training data and settings the tree was trained with.
+    """
+    tree: DecisionTree
+    classes: list[str]
+    features: list[str]
+    params: dict[str, Any]
+    fingerprint: str
+
+    def __init__(self, tree: DecisionTree, classes: list[str], features: list[str], params: dict[str, Any],
+                 fingerprint: str) -> None:
+        """Initialize a SavedModel."""
+        self.tree = tree
+        self.classes = classes
+        self.features = features
+        self.params = params
+        self.fingerprint = fingerprint
+
+
+class ModelStore:
+    """A directory of saved models, keyed by the fingerprint of what they were trained on.
+
+    Instance Attributes:
+        - directory: The directory that the model files are stored in.
+
+    >>> import tempfile
+    >>> rng = np.random.default_rng(0)
+    >>> x, y = rng.normal(size=(100, 3)), rng.integers(0, 10, size=100)
+    >>> classes = [f'song {i}' for i in range(10)]
+    >>> params = {'max_depth': 4, 'random_state': 0}
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     store = ModelStore(directory)
+    ...     trained = store.load_or_train(x, y, classes, ['a', 'b', 'c'], params)
+    ...     loaded = store.load_or_train(x, y, classes, ['a', 'b', 'c'], params)
+    ...     retrained = store.load_or_train(x, y, classes, ['a', 'b', 'c'], {'max_depth': 3, 'random_state': 0})
+    >>> loaded is not trained and bool(np.all(loaded.tree.predict(x) == trained.tree.predict(x)))
+    True
+    >>> loaded.classes == classes and loaded.tree.max_depth == 4 and retrained.tree.max_depth == 3
+    True
+    """
+    directory: str
+
+    def __init__(self, directory: str = '.models') -> None:
+        """Initialize a ModelStore that keeps its files in directory, creating it if needed."""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, fingerprint: str) -> str:
+        """Return the path of the file that the model with the given fingerprint is stored in."""
+        return os.path.join(self.directory, f'song_tree_{fingerprint}.npz')
+
+    def save(self, model: SavedModel) -> str:
+        """Save model to the file for its fingerprint, and return the path of that file.
+
+        The file is written under a temporary name first, so a reader never sees a partial model.
+        """
+        metadata = {'format_version': FORMAT_VERSION, 'features': model.features, 'params': model.tree.get_params(),
+                    'fingerprint': model.fingerprint}
+
+        path = self.path_for(model.fingerprint)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez_compressed(file, nodes=model.tree.flat_tree.to_records(), samples=model.tree.flat_tree.samples,
+                                classes=np.array(model.classes, dtype=str), metadata=np.array(json.dumps(metadata)))
+        os.replace(temporary_path, path)
+        return path
+
+    def load(self, fingerprint: str) -> Optional[SavedModel]:
+        """Return the model saved with the given fingerprint, or None if there is none or it was saved
+        in an older format.
+        """
+        path = self.path_for(fingerprint)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as contents:
+            metadata = json.loads(contents['metadata'].item())
+            if metadata['format_version'] != FORMAT_VERSION:
+                return None
+            records = contents['nodes']
+            samples = contents['samples']
+            classes = contents['classes'].tolist()
+
+        tree = DecisionTree(**metadata['params'])
+        tree.flat_tree = FlatTree.from_records(records, samples, copy=True)
+        tree.root = tree.flat_tree.to_node()
+        return SavedModel(tree, classes, metadata['features'], metadata['params'], fingerprint)
+
+    def load_or_train(self, x_data: np.ndarray, y_data: np.ndarray, classes: list[str], features: list[str],
+                      params: dict[str, Any], sample_ids: Optional[np.ndarray] = None) -> SavedModel:
+        """Return the model trained on x_data and y_data with the given hyperparameters, loading it from
+        this store if it was saved before, and otherwise training and saving it. sample_ids is passed on to
+        DecisionTree.fit.
+
+        Preconditions:
+            - x_data.shape[0] == y_data.shape[0]
+            - x_data.shape[1] == len(features)
+            - all(0 <= label < len(classes) for label in y_data)
+            - sample_ids is None or sample_ids.shape == y_data.shape
+        """
+        if sample_ids is None:
+            sample_ids = np.arange(len(y_data))
+        fingerprint = model_fingerprint(x_data, y_data, classes, features, params, sample_ids)
+        model = self.load(fingerprint)
+
+        if model is None:
+            tree = DecisionTree(**params)
+            tree.fit(x_data, y_data, sample_ids)
+            model = SavedModel(tree, list(classes), list(features), tree.get_params(), fingerprint)
+            self.save(model)
+
+        return model
+
+
+def model_fingerprint(x_data: np.ndarray, y_data: np.ndarray, classes: list[str], features: list[str],
+                      params: dict[str, Any], sample_ids: Optional[np.ndarray] = None) -> str:
+    """Return a short hexadecimal fingerprint that changes whenever the training data, the ids of the
+    training samples, the song names, the features, the hyperparameters or the model file format change.
+
+    >>> x, y = np.array([[0.5, 1.0], [0.25, 2.0]]), np.array([0, 1])
+    >>> fingerprint = model_fingerprint(x, y, ['a', 'b'], ['tempo', 'energy'], {'max_depth': 7})
+    >>> fingerprint == model_fingerprint(x, y, ['a', 'b'], ['tempo', 'energy'], {'max_depth': 7, 'n_jobs': 4})
+    True
+    >>> fingerprint == model_fingerprint(x, y, ['a', 'b'], ['tempo', 'energy'], {'max_depth': 6})
+    False
+    >>> fingerprint == model_fingerprint(x[::-1], y, ['a', 'b'], ['tempo', 'energy'], {'max_depth': 7})
+    False
+    """
+    settings = {'format_version': FORMAT_VERSION, 'features': list(features),
+                'params': {key: value for key, value in params.items() if key not in _UNFINGERPRINTED_PARAMS}}
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    digest.update(np.ascontiguousarray(x_data, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(y_data, dtype=np.int64).tobytes())
+    if sample_ids is not None:
+        digest.update(np.ascontiguousarray(sample_ids, dtype=np.int64).tobytes())
+    digest.update('\0'.join(classes).encode('utf-8'))
+    return digest.hexdigest()
@@ -7,82 +7,60 @@ file is the _Vertex and Graph classes that we will be using in our main function
 """
 from __future__ import annotations
 import csv
+from array import array
 from typing import Any, Optional
 
+import numpy as np
+
 from spotipy import Spotify
 from spotipy.exceptions import SpotifyException
 
 
-class _UserVertex:
-    """
-    This class defines the vertex of the graph for the spotify recommender. This class
-    represents the general user vertices in the recommender graph.
-
-    Instance Attributes:
-        - item: The data stored in this vertex - in this case user_id.
-        - neighbours: The song vertices that are adjacent to this user vertex.
-
-    Representation Invariants:
-        - self not in self.neighbours
-        - all(self in u.neighbours for u in self.neighbours)
-    """
-    item: Any
-    neighbours: set[_SongVertex]
-
-    def __init__(self, item: Any, neighbours: set[_SongVertex]) -> None:
-        """
-        This is the initializer method for this class -- setting the vertex with given item
-        and given neighbours.
-        """
-        self.item = item
-        self.neighbours = neighbours
-
-
-class _SongVertex:
-    """
-    This class defines the vertices for songs in the recommender graph
-
-    Instance Attributes:
-        - title: a string value representing the title of the song
-        - artist: a string value representing the name of the artist of the song
-        - neighbours: The user vertices that are adjacent to this user vertex.
-
-    Representation Invariants:
-        - self not in self.neighbours
-        - all(self in u.neighbours for u in self.neighbours)
-    """
-    title: str
-    artist: str
-    neighbours: set[_UserVertex]
-
-    def __init__(self, song_title: str, artist: str, neighbours: set[_UserVertex]) -> None:
-        """
-        This initializer method creates an instance of the _SongVertex class with the given
-        song_title, artist, and neighbours
-        """
-        self.title = song_title
-        self.artist = artist
-        self.neighbours = neighbours
-
-
 class Graph:
     """
     This graph connects two types of vertices: songs and their associated listeners. This graph
     represents a network of songs and the listeners to those songs. This network highlights
     one user vertex -- which is the current user's vertex -- to find recommendations for the current user
 
+    Users, artists and songs are interned: each is given a dense integer id the first time it is added, and
+    a song is identified by its title together with the id of its artist. Edges are appended to two int32
+    arrays of user ids and song ids, and the adjacency of both sides is built from them as compressed
+    sparse rows only when the graph is queried after new edges were added. This keeps millions of edges in
+    a few bytes each, instead of a Python object and a set entry per vertex and edge.
+
     Instance Attributes:
         - user_vertex_id: the id of the user vertex representing the current user using the program
 
     (Private) Instance Attributes:
-        - _user_vertices: a dictionary mapping the item/username of a user vertices to its
-        associated _UserVertex object
-        - _song_vertices: a dictionary mapping the string id of the song (in the format
-        "title:<song_title>artist:<artist_name>") to the associated _SongVertex object
+        - _user_ids: a dictionary mapping the item/username of every user vertex to its integer id
+        - _users: the item/username of every user vertex, indexed by its integer id
+        - _artist_ids: a dictionary mapping the name of every artist to its integer id
+        - _artists: the name of every artist, indexed by its integer id
+        - _song_ids: a dictionary mapping the (title, artist id) of every song vertex to its integer id
+        - _song_titles: the title of every song vertex, indexed by its integer id
+        - _song_artists: the artist id of every song vertex, indexed by its integer id
+        - _edge_users: the user id of every edge added, in the order they were added, repeats included
+        - _edge_songs: the song id of every edge added, in the same order as _edge_users
+        - _adjacency: None if edges were added since the adjacency was last built, and otherwise the
+        (user_starts, user_songs, song_starts, song_users) arrays such that the songs adjacent to user u
+        are user_songs[user_starts[u]:user_starts[u + 1]], and similarly for the users adjacent to a song
+
+    Representation Invariants:
+        - len(self._user_ids) == len(self._users)
+        - len(self._song_ids) == len(self._song_titles) == len(self._song_artists)
+        - len(self._edge_users) == len(self._edge_songs)
     """
     user_vertex_id: Optional[str]
-    _user_vertices: dict[Any, _UserVertex]
-    _song_vertices: dict[str, _SongVertex]
+    _user_ids: dict[Any, int]
+    _users: list[Any]
+    _artist_ids: dict[str, int]
+    _artists: list[str]
+    _song_ids: dict[tuple[str, int], int]
+    _song_titles: list[str]
+    _song_artists: array
+    _edge_users: array
+    _edge_songs: array
+    _adjacency: Optional[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]
 
     def __init__(self) -> None:
         """
@@ -90,24 +68,31 @@ class Graph:
         values to the default values for an empty graph.
         """
         self.user_vertex_id = None
-        self._song_vertices = {}
-        self._user_vertices = {}
+        self._user_ids = {}
+        self._users = []
+        self._artist_ids = {}
+        self._artists = []
+        self._song_ids = {}
+        self._song_titles = []
+        self._song_artists = array('i')
+        self._edge_users = array('i')
+        self._edge_songs = array('i')
+        self._adjacency = None
 
     def add_edge(self, username: str, song_title: str, artist: str) -> None:
         """
         This method creates an edge between the user vertex with the specified username and the
         song vertex with the specified song_title and artist.
         """
-        song_id = "title:" + song_title + "artist:" + artist
-        if username in self._user_vertices and song_id in self._song_vertices:
-            user = self._user_vertices[username]
-            song = self._song_vertices[song_id]
-
-            user.neighbours.add(song)
-            song.neighbours.add(user)
-        else:
+        user = self._user_ids.get(username)
+        song = self._song_ids.get((song_title, self._artist_ids.get(artist, -1)))
+        if user is None or song is None:
             raise ValueError
 
+        self._edge_users.append(user)
+        self._edge_songs.append(song)
+        self._adjacency = None
+
     def add_song_vertex(self, title: str, artist: str) -> None:
         """
         This method adds a song vertex to the graph with the given title and artist.
@@ -115,21 +100,64 @@ class Graph:
         This song vertex is not adjacent to any user vertices. If the vertex is already in
         the graph, the method does not modify the current song vertices.
         """
-        song_id = "title:" + title + "artist:" + artist
-        if song_id not in self._song_vertices:
-            self._song_vertices[song_id] = _SongVertex(title, artist, set())
+        artist_id = self._artist_ids.setdefault(artist, len(self._artists))
+        if artist_id == len(self._artists):
+            self._artists.append(artist)
+
+        key = (title, artist_id)
+        if key not in self._song_ids:
+            self._song_ids[key] = len(self._song_titles)
+            self._song_titles.append(title)
+            self._song_artists.append(artist_id)
+            self._adjacency = None
 
     def add_user_vertex(self, item: Any, main_user: bool) -> None:
         """
         This method adds a user vertex to the graph with the given item and whether
         the vertex is the vertex of the current user depending on the given main_user parameter.
         """
-        if item not in self._user_vertices:
-            self._user_vertices[item] = _UserVertex(item, set())
+        if item not in self._user_ids:
+            self._user_ids[item] = len(self._users)
+            self._users.append(item)
+            self._adjacency = None
 
         if main_user:
             self.user_vertex_id = item
 
+    def _build_adjacency(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        This method returns the compressed sparse rows of the songs adjacent to every user and the users
+        adjacent to every song, building them from the edges first if edges were added since they were last
+        built. Repeated edges are kept once, and the neighbours of every vertex are in increasing id order.
+        """
+        if self._adjacency is None:
+            n_users, n_songs = len(self._users), len(self._song_titles)
+            users = np.frombuffer(self._edge_users, dtype=np.int32) if self._edge_users else np.zeros(0, np.int32)
+            songs = np.frombuffer(self._edge_songs, dtype=np.int32) if self._edge_songs else np.zeros(0, np.int32)
+
+            # sorting the edges by user then song puts each user's songs together and repeated edges next to
+            # each other, so they can be dropped
+            edges = np.sort(users.astype(np.int64) * n_songs + songs)
+            edges = edges[np.diff(edges, prepend=-1) != 0]
+            edge_users, edge_songs = (edges // n_songs).astype(np.int32), (edges % n_songs).astype(np.int32)
+            user_starts = np.zeros(n_users + 1, dtype=np.int64)
+            np.cumsum(np.bincount(edge_users, minlength=n_users), out=user_starts[1:])
+
+            # and sorting them by song then user puts each song's users together
+            edges = np.sort(edge_songs.astype(np.int64) * n_users + edge_users)
+            song_starts = np.zeros(n_songs + 1, dtype=np.int64)
+            np.cumsum(np.bincount(edge_songs, minlength=n_songs), out=song_starts[1:])
+            self._adjacency = (user_starts, edge_songs, song_starts, (edges % max(n_users, 1)).astype(np.int32))
+
+        return self._adjacency
+
+    def _user_songs(self, user: int) -> np.ndarray:
+        """
+        This method returns the ids of the song vertices adjacent to the user vertex with the given id.
+        """
+        user_starts, user_songs, _, _ = self._build_adjacency()
+        return user_songs[user_starts[user]:user_starts[user + 1]]
+
     def _get_connected_users(self) -> dict[Any, int]:
         """
         This method gets all connected users who are connected with one song vertex in between them and the user
@@ -155,23 +183,19 @@ class Graph:
         >>> graph._get_connected_users() == {"user_2": 1, "user_3": 2}
         True
         """
-        user_vertex = self._user_vertices[self.user_vertex_id]
-        connected_so_far = {}
+        _, _, song_starts, song_users = self._build_adjacency()
+        user = self._user_ids[self.user_vertex_id]
+        songs = self._user_songs(user)
 
-        for song in user_vertex.neighbours:
-            # removes the main user vertex from a copy of the song neighbours so that
-            # the main user is not included in the final dictionary (we can't give recommendations from
-            # someone's own library)
-            connected_users = song.neighbours.copy()
-            connected_users.remove(user_vertex)
+        # the users adjacent to every song of the current user, one entry per shared song
+        lengths = song_starts[songs + 1] - song_starts[songs]
+        positions = np.repeat(song_starts[songs] - np.cumsum(lengths) + lengths, lengths) + np.arange(np.sum(lengths))
+        connected_users, counts = np.unique(song_users[positions], return_counts=True)
 
-            for connected_user in connected_users:
-                if connected_user.item in connected_so_far:
-                    connected_so_far[connected_user.item] += 1
-                else:
-                    connected_so_far[connected_user.item] = 1
-
-        return connected_so_far
+        # the main user is not included in the final dictionary (we can't give recommendations from
+        # someone's own library)
+        return {self._users[connected]: count for connected, count in zip(connected_users.tolist(), counts.tolist())
+                if connected != user}
 
     def _get_most_similar_user(self, seen: dict[str, list[tuple[str, str]]]) -> str:
         """
@@ -210,16 +234,17 @@ class Graph:
         'user_1'
         """
         connected_users = self._get_connected_users()
+        user_starts = self._build_adjacency()[0]
         most_similar_user = self.user_vertex_id
         max_score_so_far = 0
 
         for user_id in connected_users:
+            n_neighbours = int(user_starts[self._user_ids[user_id] + 1] - user_starts[self._user_ids[user_id]])
             # if the number of connections is the same as the number of neighbours of the current user's id
             # then there are no new recommendations to be
-            if len(self._user_vertices[user_id].neighbours) == connected_users[user_id]:
+            if n_neighbours == connected_users[user_id]:
                 continue
-            elif user_id in seen and connected_users[user_id] == (len(self._user_vertices[user_id].neighbours)
-                                                                  - len(seen[user_id])):
+            elif user_id in seen and connected_users[user_id] == n_neighbours - len(seen[user_id]):
                 # if we've seen every song recommendation in the current user vertex, skip over it
                 # number of connections is equal to the number of neighbours - songs we've seen
                 continue
@@ -240,7 +265,7 @@ class Graph:
         only this item if there are no possible song recommendations.
 
         Preconditions:
-            - similar_user in self._user_vertices
+            - similar_user in self._user_ids
 
         >>> graph = Graph()
         >>> graph.add_user_vertex("user_1", True)
@@ -262,10 +287,12 @@ class Graph:
 
         song_ids_seen = {song_info[0] + song_info[1] for user in seen for song_info in seen[user]}
 
-        for song in self._user_vertices[similar_user].neighbours:
-            if (song not in self._user_vertices[self.user_vertex_id].neighbours
-                    and song.title + song.artist not in song_ids_seen):
-                lst_so_far.append((song.title, song.artist))
+        songs = self._user_songs(self._user_ids[similar_user])
+        songs = songs[~np.isin(songs, self._user_songs(self._user_ids[self.user_vertex_id]))]
+        for song in songs.tolist():
+            title, artist = self._song_titles[song], self._artists[self._song_artists[song]]
+            if title + artist not in song_ids_seen:
+                lst_so_far.append((title, artist))
 
         return lst_so_far
 
@@ -284,10 +311,10 @@ class Graph:
 
         Preconditions:
             - limit >= 0
-            - all("title:" + song_info[0] + "artist:" + song_info[1] in self._song_vertices \
-            for user in seen for song_info in seen[user])
-            - all("title:" + song_info[0] + "artist:" + song_info[1] in self._user_vertices[user].neighbours \
+            - all((song_info[0], self._artist_ids[song_info[1]]) in self._song_ids \
             for user in seen for song_info in seen[user])
+            - all(self._song_ids[(song_info[0], self._artist_ids[song_info[1]])] in \
+            self._user_songs(self._user_ids[user]) for user in seen for song_info in seen[user])
 
         >>> graph = Graph()
         >>> graph.add_user_vertex("user_1", True)
@@ -0,0 +1,270 @@
+"""CSC111 Project 2: Spotify Recommendation System - Song Neighbours
+
+This module finds the songs whose audio features are most similar to a song's, by cosine similarity,
+without comparing the song with every song in the catalog. It is an alternative to recommending songs
+from the leaves of the song recommendation tree, which needs one class per song name, and so does not
+scale to a catalog of about a million songs.
+
+The songs are hashed with random-projection locality-sensitive hashing: every hash table splits the
+feature space with n_bits random hyperplanes, and songs on the same side of all of them share a bucket.
+A query only compares the song with the songs in its bucket in every table, and in the n_probes - 1
+neighbouring buckets it is closest to, so more tables and probes give better recall, and more bits
+give faster queries.
+"""
+from __future__ import annotations
+import json
+import time
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from decision_tree import CatalogIndex, normalize_features, top_k_unique
+
+# the version of the file layout written by SongNeighbours.save
+FORMAT_VERSION = 1
+
+
+class SongNeighbours:
+    """A random-projection hashing index over the unit feature vectors of a catalog of songs.
+
+    The hyperplanes of the hash tables pass through the mean of the unit feature vectors rather than
+    the origin. Nearby vectors are still unlikely to be separated, but the buckets stay balanced even
+    when every song points in roughly the same direction, as songs do when one feature like tempo
+    dwarfs the others.
+
+    Instance Attributes:
+        - n_tables: The number of hash tables.
+        - n_bits: The number of hyperplanes, and so of bits in a bucket code, of every hash table.
+        - n_probes: The number of buckets of every hash table a query looks in.
+        - unit_features: The feature vectors of the songs, scaled to unit length.
+        - song_ids: An id for every song, equal for songs that should only be recommended once.
+
+    Representation Invariants:
+        - self.n_tables >= 1 and 1 <= self.n_bits <= 62 and 1 <= self.n_probes <= self.n_bits + 1
+        - self.unit_features.shape[0] == self.song_ids.shape[0]
+
+    >>> rng = np.random.default_rng(0)
+    >>> features = rng.random((2000, 7))
+    >>> engine = SongNeighbours(normalize_features(features), np.arange(2000), n_tables=6, n_bits=8,
+    ...                         random_state=0)
+    >>> [rows], [similarities] = engine.query(features[:1], k=3)
+    >>> int(rows[0]), round(float(similarities[0]), 4)
+    (0, 1.0)
+    >>> report = benchmark(engine, features[:50], k=10)
+    >>> report['recall'] > 0.9 and report['mean_candidates'] < 2000
+    True
+    """
+    n_tables: int
+    n_bits: int
+    n_probes: int
+    unit_features: np.ndarray
+    song_ids: np.ndarray
+    # Private Instance Attributes:
+    #     - _centre: the point that every hyperplane passes through
+    #     - _planes: the normals of the hyperplanes, one column per bit of every table
+    #     - _codes: the bucket code of every song in every table, sorted within each table
+    #     - _orders: the rows of the songs in the order of _codes, one row per table
+    _centre: np.ndarray
+    _planes: np.ndarray
+    _codes: np.ndarray
+    _orders: np.ndarray
+
+    def __init__(self, unit_features: np.ndarray, song_ids: np.ndarray, n_tables: int = 8, n_bits: int = 12,
+                 n_probes: int = 4, random_state: Optional[int] = None) -> None:
+        """Build the hash tables of the songs with the given unit feature vectors and ids.
+
+        Raise a ValueError if n_tables, n_bits or n_probes is out of range.
+        """
+        if n_tables < 1:
+            raise ValueError(f"n_tables must be at least 1, got {n_tables}")
+        if not 1 <= n_bits <= 62:
+            raise ValueError(f"n_bits must be between 1 and 62, got {n_bits}")
+        if not 1 <= n_probes <= n_bits + 1:
+            raise ValueError(f"n_probes must be between 1 and n_bits + 1, got {n_probes}")
+
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.unit_features = np.asarray(unit_features, dtype=np.float32)
+        self.song_ids = np.asarray(song_ids)
+
+        rng = np.random.default_rng(random_state)
+        self._centre = self.unit_features.mean(axis=0) if len(self.unit_features) else \
+            np.zeros(self.unit_features.shape[1], dtype=np.float32)
+        self._planes = rng.standard_normal((self.unit_features.shape[1], n_tables * n_bits)).astype(np.float32)
+
+        codes, _ = self._hash(self.unit_features)
+        self._orders = np.argsort(codes, axis=0, kind='stable').T.astype(np.int32)
+        self._codes = np.take_along_axis(codes, self._orders.T, axis=0).T.copy()
+
+    @classmethod
+    def from_catalog(cls, index: CatalogIndex, **settings: Any) -> SongNeighbours:
+        """Return a SongNeighbours over the songs of index, with the given settings for __init__."""
+        return cls(index.unit_features, index.song_ids, **settings)
+
+    def _hash(self, unit_vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Return the bucket code of every vector in every table, with one row per vector, and the
+        signed distance of every vector from every hyperplane, of shape (vectors, tables, bits).
+        """
+        margins = ((unit_vectors - self._centre) @ self._planes).reshape(-1, self.n_tables, self.n_bits)
+        codes = (margins > 0).astype(np.int64) @ (np.int64(1) << np.arange(self.n_bits, dtype=np.int64))
+        return codes, margins
+
+    def candidates(self, vectors: np.ndarray) -> list[np.ndarray]:
+        """Return the rows of the songs that share a probed bucket with each of the given feature vectors,
+        sorted and without repeats.
+        """
+        codes, margins = self._hash(normalize_features(vectors))
+
+        # probe the vector's own bucket, and the buckets across the hyperplanes it is closest to
+        closest = np.argsort(np.abs(margins), axis=2)[:, :, :self.n_probes - 1]
+        probes = np.concatenate([codes[:, :, None], codes[:, :, None] ^ (np.int64(1) << closest)], axis=2)
+
+        starts = np.empty(probes.shape, dtype=np.int64)
+        ends = np.empty(probes.shape, dtype=np.int64)
+        for table in range(self.n_tables):
+            starts[:, table] = np.searchsorted(self._codes[table], probes[:, table], side='left')
+            ends[:, table] = np.searchsorted(self._codes[table], probes[:, table], side='right')
+
+        rows = []
+        for query_starts, query_ends in zip(starts, ends):
+            buckets = [self._orders[table, start:end] for table in range(self.n_tables)
+                       for start, end in zip(query_starts[table], query_ends[table]) if start < end]
+            rows.append(np.unique(np.concatenate(buckets)) if buckets else np.zeros(0, dtype=np.int32))
+        return rows
+
+    def query(self, vectors: np.ndarray, k: int = 10) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """Return the rows of the at most k songs most similar to each of the given feature vectors, most
+        similar first and with one row per song id, and their cosine similarities to the vector.
+
+        Preconditions:
+            - vectors.shape[1] == self.unit_features.shape[1]
+            - k >= 1
+        """
+        unit_vectors = normalize_features(vectors)
+        rows, similarities = [], []
+        for unit_vector, candidate_rows in zip(unit_vectors, self.candidates(vectors)):
+            if len(candidate_rows) == 0:
+                rows.append(candidate_rows)
+                similarities.append(np.zeros(0, dtype=np.float32))
+                continue
+
+            candidate_similarities = self.unit_features[candidate_rows] @ unit_vector
+            best = top_k_unique(candidate_similarities, self.song_ids[candidate_rows], k)
+            rows.append(candidate_rows[best])
+            similarities.append(candidate_similarities[best])
+        return rows, similarities
+
+    def save(self, file: str) -> None:
+        """Save the hash tables and the songs they index to file, in the .npz format."""
+        settings = {'format_version': FORMAT_VERSION, 'n_tables': self.n_tables, 'n_bits': self.n_bits,
+                    'n_probes': self.n_probes}
+        np.savez(file, settings=np.array(json.dumps(settings)), unit_features=self.unit_features,
+                 song_ids=self.song_ids, centre=self._centre, planes=self._planes, codes=self._codes,
+                 orders=self._orders)
+
+    @classmethod
+    def load(cls, file: str, n_probes: Optional[int] = None) -> SongNeighbours:
+        """Return the SongNeighbours saved in file, looking in n_probes buckets of every table if it is
+        not None, and in as many as when it was saved otherwise.
+
+        Raise a ValueError if file was saved in another format.
+        """
+        with np.load(file, allow_pickle=False) as contents:
+            settings = json.loads(contents['settings'].item())
+            if settings['format_version'] != FORMAT_VERSION:
+                raise ValueError(f"{file} was saved in format {settings['format_version']}, not {FORMAT_VERSION}")
+
+            engine = cls.__new__(cls)
+            engine.n_tables, engine.n_bits = settings['n_tables'], settings['n_bits']
+            engine.n_probes = settings['n_probes'] if n_probes is None else n_probes
+            engine.unit_features, engine.song_ids = contents['unit_features'], contents['song_ids']
+            engine._centre, engine._planes = contents['centre'], contents['planes']
+            engine._codes, engine._orders = contents['codes'], contents['orders']
+
+        if not 1 <= engine.n_probes <= engine.n_bits + 1:
+            raise ValueError(f"n_probes must be between 1 and n_bits + 1, got {engine.n_probes}")
+        return engine
+
+
+def recommend_songs(engine: SongNeighbours, user_song: str, dataset: pd.DataFrame, index: CatalogIndex,
+                    k: int = 10, artist: Optional[str] = None) -> list[tuple[str, str, float]]:
+    """Recommend the k songs whose features are most similar to user_song's, like
+    decision_tree.recommend_songs, but finding them with engine instead of a tree.
+
+    Raise a ValueError if user_song, or user_song by artist if artist is not None, is not in the dataset.
+
+    Preconditions:
+        - dataset is a pandas DataFrame containing at least the column names: 'name', 'artists'
+        - engine and index were built from the songs of dataset, in order
+        - k >= 1
+
+    >>> songs = pd.DataFrame({'name': ['Dreams', 'Creep', 'Linger', 'Let Down'],
+    ...                       'artists': ['The Cranberries', 'Radiohead', 'The Cranberries', 'Radiohead'],
+    ...                       'tempo': [1.0, 5.0, 1.1, 4.0], 'energy': [1.0, 1.0, 1.0, 1.0]})
+    >>> catalog = CatalogIndex(songs, ['tempo', 'energy'])
+    >>> engine = SongNeighbours.from_catalog(catalog, n_tables=2, n_bits=1, n_probes=2, random_state=0)
+    >>> [name for name, _, _ in recommend_songs(engine, 'dreams', songs, catalog, k=2)]
+    ['Dreams', 'Linger']
+    """
+    [rows], [similarities] = engine.query(index.feature_matrix[[index.find(user_song, artist)]], k)
+    song_names = dataset['name'].iloc[rows].str.strip()  # ensure no extra whitespace
+    artist_names = dataset['artists'].iloc[rows]
+    return [(song_name, artist_name, float(similarity))
+            for song_name, artist_name, similarity in zip(song_names, artist_names, similarities)]
+
+
+def brute_force_query(unit_features: np.ndarray, song_ids: np.ndarray, vectors: np.ndarray,
+                      k: int = 10) -> list[np.ndarray]:
+    """Return the rows of the k songs most similar to each of the given feature vectors, found by comparing
+    every vector with every song, most similar first and with one row per song id.
+    """
+    similarities = unit_features @ normalize_features(vectors).T
+    return [top_k_unique(column, song_ids, k) for column in similarities.T]
+
+
+def benchmark(engine: SongNeighbours, vectors: np.ndarray, k: int = 10) -> dict[str, float]:
+    """Query engine and an exact brute-force search for the k songs most similar to each of the given
+    feature vectors, and return the recall@k of engine, the mean query time of both in milliseconds,
+    and the mean number of songs engine compared with every vector.
+    """
+    start = time.perf_counter()
+    rows, _ = engine.query(vectors, k)
+    engine_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact_rows = brute_force_query(engine.unit_features, engine.song_ids, vectors, k)
+    exact_time = time.perf_counter() - start
+
+    found = sum(len(np.intersect1d(approximate, exact)) for approximate, exact in zip(rows, exact_rows))
+    return {'recall': found / max(sum(len(exact) for exact in exact_rows), 1),
+            'engine_ms': 1000 * engine_time / len(vectors),
+            'brute_force_ms': 1000 * exact_time / len(vectors),
+            'mean_candidates': float(np.mean([len(candidates) for candidates in engine.candidates(vectors)]))}
+
+
+if __name__ == '__main__':
+    # import python_ta
+    # python_ta.check_all(config={
+    #     'extra-imports': ['json', 'time', 'typing', 'numpy', 'pandas', 'decision_tree'],
+    #     'allowed-io': [],
+    #     'max-line-length': 120
+    # })
+
+    # compare a few settings against brute force on a synthetic catalog the size of the full song dataset
+    N_SONGS, N_QUERIES, K = 1_000_000, 200, 10
+    generator = np.random.default_rng(111)
+    catalog_features = generator.random((N_SONGS, 7), dtype=np.float32)
+    queries = catalog_features[generator.choice(N_SONGS, N_QUERIES, replace=False)]
+
+    for tables, bits, probes in [(4, 18, 1), (8, 18, 3), (8, 16, 4)]:
+        build_start = time.perf_counter()
+        neighbours = SongNeighbours(normalize_features(catalog_features), np.arange(N_SONGS), n_tables=tables,
+                                    n_bits=bits, n_probes=probes, random_state=0)
+        build_time = time.perf_counter() - build_start
+        results = benchmark(neighbours, queries, K)
+        print(f"tables={tables:2} bits={bits} probes={probes}: build {build_time:.1f}s, "
+              f"recall@{K} {results['recall']:.3f}, {results['engine_ms']:.2f} ms/query "
+              f"vs {results['brute_force_ms']:.2f} ms/query brute force, "
+              f"{results['mean_candidates']:.0f} candidates/query")